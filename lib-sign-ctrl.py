@@ -7,36 +7,505 @@ import httplib						# for talking to our server
 import time							# for timing how often data is refreshed
 from threading import Thread
 from threading import Lock
+from threading import Condition
+from threading import Event
+from threading import current_thread
+import Queue
 import os
 import sys
+import hashlib
+import re
+import unicodedata
+import heapq
+import zlib
+import gzip
+import base64
+import asyncore
+import socket
+import fcntl
+import select
+import signal
+try:
+	import ctypes						# for inotify, if we have it
+except ImportError:
+	ctypes = None
 from datetime import datetime
-from xml.etree import ElementTree as ET
-import xml.dom.minidom
-from xml.dom.minidom import Node
-from xml.dom.minidom import parse, parseString
+from cStringIO import StringIO
+try:
+	from xml.etree import cElementTree as ET
+except ImportError:
+	from xml.etree import ElementTree as ET
+from xml.parsers import expat
 import logging
+import json
 
 # what config file should we initialize from
 CONFIG_FILE_PATH = "config.ini"
 
 # global instance
-config = None
 controller = None
 CODE_VERSION = "2.0.0"			# increment when you change this file
 PROTOCOL_VERSION = "1.1"		# increment if you change the XML file structure from the server
 
 '''
-HACK: this file actually is used to indicate that we want to restart the process, NOT that the 
-process is running.  The xmlrestart.sh script will check if this file exists and if it does
-it will kill this process and restart it.  This lets us restart remotely without a VPN connection
-to the installated sign.  Eventually we should get an OpenVPN server setup.
+When the server tells us to restart, we exec a fresh copy of ourselves (see
+SignController.restart).  What we were showing is left in this file for the new process, which
+finds it through the HANDOFF_ENV environment variable.
 '''
-NEED_TO_RESTART_FLAG_FILE = '/var/run/lib-sign-ctrl-restart.pid'
+HANDOFF_FILE = '/var/run/lib-sign-ctrl-handoff.json'
+HANDOFF_ENV = 'LIB_SIGN_CTRL_HANDOFF'
 
 LOG_FILE = '/var/log/lib-sign-ctrl.log'
 
+STATUS_FILE = '/var/run/lib-sign-ctrl-status.json'	# where the metrics get written, see Metrics
+
+CONTENT_CACHE_FILE = 'content-cache.json'	# the last good content, kept for boot, see ContentCache
+
 logfile = None
 
+class Histogram:
+	'''
+	Counts of timings (in secs) falling into fixed buckets, plus their total, min and max
+	'''
+
+	BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60]	# upper bounds, in secs
+
+	def __init__(self):
+		self.count = 0
+		self.total = 0.0
+		self.min = None
+		self.max = None
+		self.buckets = [0 for bound in self.BUCKETS] + [0]	# the last one is everything longer
+
+	def observe(self, value):
+		self.count += 1
+		self.total += value
+		if (self.min == None) or (value < self.min):
+			self.min = value
+		if (self.max == None) or (value > self.max):
+			self.max = value
+		for i in range(len(self.BUCKETS)):
+			if value <= self.BUCKETS[i]:
+				self.buckets[i] += 1
+				return
+		self.buckets[-1] += 1
+
+	def mean(self):
+		if self.count == 0:
+			return None
+		return self.total / self.count
+
+	def toDict(self):
+		return {'count': self.count, 'total': self.total, 'mean': self.mean(), 'min': self.min,
+				'max': self.max, 'buckets': self.buckets}
+
+
+class Metrics:
+	'''
+	In-memory counters and timing histograms for the serial, fetch and display paths, so we can
+	see where the time goes.  There is one of these for the whole process (the global metrics).
+	A full snapshot gets written to STATUS_FILE and a compact summary goes to the server with
+	each request.
+	'''
+
+	# what goes in the summary sent to the server: short name -> (metric, what to report)
+	SUMMARY = [('sf', 'serial.frames', 'count'),
+			   ('sb', 'serial.bytes', 'count'),
+			   ('af', 'serial.ack_failures', 'count'),
+			   ('pr', 'serial.port_resets', 'count'),
+			   ('al', 'serial.ack_latency', 'mean'),
+			   ('fe', 'fetch.errors', 'count'),
+			   ('fr', 'fetch.response', 'mean'),
+			   ('fp', 'fetch.parse', 'mean'),
+			   ('pd', 'display.page_dwell', 'mean'),
+			   ('pg', 'display.page_gap', 'max'),
+			   ('sk', 'display.skew', 'max'),
+			   ('cl', 'display.cycle', 'mean'),
+			   ('it', 'display.idle', 'total'),
+			   ('rs', 'restart.duration', 'max'),
+			   ('pf', 'push.failures', 'count')]
+
+	def __init__(self):
+		self._lock = Lock()
+		self.reset()
+
+	def reset(self):
+		with self._lock:
+			self._started = time.time()
+			self._counters = {}
+			self._histograms = {}
+
+	def count(self, name, amount=1):
+		'''
+		Public method to add to a counter
+		'''
+		with self._lock:
+			self._counters[name] = self._counters.get(name, 0) + amount
+
+	def observe(self, name, secs):
+		'''
+		Public method to add a timing to a histogram
+		'''
+		with self._lock:
+			histogram = self._histograms.get(name)
+			if histogram == None:
+				histogram = Histogram()
+				self._histograms[name] = histogram
+			histogram.observe(secs)
+
+	def snapshot(self):
+		'''
+		Public method to return everything as a dict, ready to be written out as JSON
+		'''
+		with self._lock:
+			histograms = dict([(name, histogram.toDict())
+							   for name, histogram in self._histograms.items()])
+			return {'uptime': time.time() - self._started, 'counters': dict(self._counters),
+					'histograms': histograms, 'buckets': Histogram.BUCKETS}
+
+	def summary(self):
+		'''
+		Public method to return a short "name=value,..." string of the most telling numbers,
+		with timings in ms
+		'''
+		parts = []
+		with self._lock:
+			for short, name, field in self.SUMMARY:
+				if field == 'count':
+					value = self._counters.get(name)
+				else:
+					histogram = self._histograms.get(name)
+					value = None
+					if histogram != None:
+						value = getattr(histogram, field)
+						if callable(value):
+							value = value()
+						value = int(round(value * 1000))
+				if value != None:
+					parts.append("%s=%d" % (short, value))
+		return ','.join(parts)
+
+	def writeStatus(self, path, extra={}):
+		'''
+		Public method to write the snapshot (plus anything in extra) to a file, swapping it in
+		whole so readers never see half of one - returns True if it worked
+		'''
+		status = self.snapshot()
+		status.update(extra)
+		tmpPath = path + '.tmp'
+		try:
+			f = open(tmpPath, 'w')
+			try:
+				json.dump(status, f, sort_keys=True, indent=1)
+			finally:
+				f.close()
+			os.rename(tmpPath, path)
+		except (IOError, OSError), e:
+			logging.debug("couldn't write status to %s: %s" % (path, e))
+			return False
+		return True
+
+metrics = Metrics()
+
+
+class Trace:
+	'''
+	A record of a run, for scripts/replay_trace.py to play back: every response from the server
+	and the content it gave, and every frame sent to a sign with how the sign answered, each
+	with the secs since recording started.  There is one of these for the whole process (the
+	global trace), and it records nothing until it is opened.  The file is gzipped JSON, one
+	event per line, and a restarted process adds a new run to the end of it.  Content that was
+	seen before is recorded as a reference to the first time.
+	'''
+
+	def __init__(self):
+		self._lock = Lock()
+		self._file = None
+		self._path = None
+		self._started = None
+		self._contents = {}			# md5 of each content recorded -> its number, in order
+
+	def open(self, path, ports=[]):
+		'''
+		Public method to start recording to path (None to stop), noting the serial ports the
+		frames will go to - does nothing if we're already recording there
+		'''
+		with self._lock:
+			if path == self._path:
+				return
+			self._close()
+			if path == None:
+				return
+			try:
+				self._file = gzip.open(path, 'ab')
+			except IOError, e:
+				logging.warning("couldn't record a trace to %s: %s" % (path, e))
+				return
+			self._path = path
+			self._started = time.time()
+			self._contents = {}
+			self._write({'e': 'start', 't': 0, 'at': self._started, 'version': CODE_VERSION,
+						 'ports': ports})
+
+	def close(self):
+		'''
+		Public method to stop recording, finishing off the file
+		'''
+		with self._lock:
+			self._close()
+
+	def _close(self):
+		if self._file != None:
+			self._file.close()
+		self._file = None
+		self._path = None
+
+	def isRecording(self):
+		return self._file != None
+
+	def response(self, status, headers):
+		'''
+		Public method to record a response from the server, as it arrives
+		'''
+		if self._file == None:
+			return
+		with self._lock:
+			self._write({'e': 'response', 't': self._secs(time.time()), 'status': status,
+						 'etag': headers.get('etag'),
+						 'encoding': headers.get('content-encoding')})
+
+	def content(self, body):
+		'''
+		Public method to record the document the last response gave, once it was decoded
+		'''
+		if self._file == None:
+			return
+		with self._lock:
+			event = {'e': 'content', 't': self._secs(time.time())}
+			digest = hashlib.md5(body).digest()
+			if digest in self._contents:
+				event['ref'] = self._contents[digest]
+			else:
+				self._contents[digest] = len(self._contents)
+				event['body'] = body
+			self._write(event)
+			self._file.flush()		# once a refresh, so a crash loses little
+
+	def frame(self, port, frame, commitTime, acknowledged, reply=None):
+		'''
+		Public method to record a (header, data, footer) frame sent to the sign on port, and
+		whether it acknowledged it (now), or what it answered a read with
+		'''
+		if (self._file == None) or (commitTime == None):
+			return
+		now = time.time()
+		with self._lock:
+			event = {'e': 'frame', 't': self._secs(commitTime), 'port': port,
+					 'frame': ''.join(frame), 'ack': acknowledged,
+					 'secs': round(now - commitTime, 4)}
+			if reply != None:
+				event['reply'] = reply
+			self._write(event)
+
+	def _secs(self, when):
+		return round(when - self._started, 4)
+
+	def _write(self, event):
+		'''
+		Helper to add an event to the file - call with _lock held.  Frames and documents are
+		kept byte for byte as latin-1.
+		'''
+		if self._file == None:
+			return
+		try:
+			self._file.write(json.dumps(event, encoding='latin-1', separators=(',', ':')) + '\n')
+		except IOError, e:
+			logging.warning("couldn't write to the trace, stopping it: %s" % e)
+			self._close()
+
+trace = Trace()
+
+
+class SignConfig:
+	'''
+	A checked snapshot of the settings in config.ini, each one converted to its type.  It is
+	built once (see loadconfig) and never changed: a reload builds a new one and hands it to
+	SignController.setConfig, which swaps it in whole, so nothing ever sees half a change.
+	Settings that aren't set are None unless a default is given below, so the classes using
+	them fall back on their own defaults.
+	'''
+
+	DISPLAY_SPEEDS = ['1', '2', '3', '4', '5']
+	PAUSE_TIMES = [str(secs) for secs in range(10)]
+	RUNTIMES = ['threaded', 'async']
+	# these are only read at startup, so changing them needs a restart
+	RESTART_SETTINGS = ['serialPaths', 'writeToSerial', 'runtime', 'residentPages',
+						'contentCacheFile']
+
+	def __init__(self, parser=None):
+		if parser == None:
+			parser = ConfigParser.ConfigParser()
+		# [Communication]
+		self.serialPaths = self._serialPaths(parser)
+		self.writeToSerial = self._get(parser, 'Communication', 'write_to_serial', True, self._bool)
+		self.runtime = self._get(parser, 'Communication', 'runtime', 'threaded',
+								 self._choice(self.RUNTIMES))
+		self.residentPages = self._get(parser, 'Communication', 'resident_pages', False,
+									   self._bool)
+		self.displaySpeed = self._get(parser, 'Communication', 'display_speed', '2',
+									  self._choice(self.DISPLAY_SPEEDS))
+		self.pauseTime = self._get(parser, 'Communication', 'pause_time', '9',
+								   self._choice(self.PAUSE_TIMES))
+		self.secsPerChar = self._get(parser, 'Communication', 'secs_per_char', None,
+									 self._atLeast(float, 0))
+		self.minDisplaySecs = self._get(parser, 'Communication', 'min_display_secs', None,
+										self._atLeast(float, 0))
+		self.timingFile = self._get(parser, 'Communication', 'timing_file', None, str)
+		self.syncSigns = self._get(parser, 'Communication', 'sync_signs', False, self._bool)
+		self.syncTimeoutSecs = self._get(parser, 'Communication', 'sync_timeout_secs', None,
+										 self._atLeast(float, 0))
+		self.pipelinePages = self._get(parser, 'Communication', 'pipeline_pages', None,
+									   self._atLeast(int, 0))
+		self.signColumns = self._get(parser, 'Communication', 'sign_columns', None,
+									 self._atLeast(int, 1))
+		self.readback = self._get(parser, 'Communication', 'readback', False, self._bool)
+		self.cacheMaxAgeSecs = self._get(parser, 'Communication', 'cache_max_age_secs', None,
+										 self._atLeast(float, 0))
+		# [Server]
+		self.serverHost = self._get(parser, 'Server', 'host', None, str)
+		self.serverPort = self._get(parser, 'Server', 'port', 80, self._atLeast(int, 0))
+		self.serverPath = self._get(parser, 'Server', 'path', '/x', str)
+		self.serialNum = self._get(parser, 'Server', 'serial_num', None, str)
+		self.secret = self._get(parser, 'Server', 'secret', None, str)
+		self.refreshInterval = self._get(parser, 'Server', 'refresh_interval', None,
+										 self._atLeast(int, 1))
+		self.contentCacheFile = self._get(parser, 'Server', 'content_cache', None, str) # '' for none
+		self.push = self._get(parser, 'Server', 'push', False, self._bool)
+		self.pushWaitSecs = self._get(parser, 'Server', 'push_wait_secs', None,
+									  self._atLeast(int, 1))
+		# [Debug]
+		self.statusFile = self._get(parser, 'Debug', 'status_file', None, str)	# '' for none
+		self.traceFile = self._get(parser, 'Debug', 'trace_file', None, str)		# '' for none
+		self._frozen = True
+
+	def __setattr__(self, name, value):
+		if self.__dict__.get('_frozen'):
+			raise AttributeError("settings can't be changed, load new ones instead")
+		self.__dict__[name] = value
+
+	def _get(self, parser, section, option, default, convert):
+		'''
+		Helper to read one setting with convert, raising ValueError if it doesn't make sense
+		'''
+		if not parser.has_option(section, option):
+			return default
+		value = parser.get(section, option).strip()
+		try:
+			return convert(value)
+		except ValueError, e:
+			raise ValueError("[%s] %s=%s: %s" % (section, option, value, e))
+
+	def _bool(self, value):
+		if value.lower() in ['yes', 'true', 'on']:
+			return True
+		if value.lower() in ['no', 'false', 'off']:
+			return False
+		return int(value) != 0
+
+	def _choice(self, choices):
+		def convert(value):
+			if value not in choices:
+				raise ValueError("should be one of %s" % ', '.join(choices))
+			return value
+		return convert
+
+	def _atLeast(self, kind, minimum):
+		def convert(value):
+			value = kind(value)
+			if value < minimum:
+				raise ValueError("should be at least %s" % minimum)
+			return value
+		return convert
+
+	def _serialPaths(self, parser):
+		'''
+		Helper to list the serial ports, top sign first: serial_path_1 (or serial_path), then
+		serial_path_2, serial_path_3 and so on for as many as are set
+		'''
+		path = '/dev/ttyS0'
+		if parser.has_option('Communication', 'serial_path_1'):
+			path = parser.get('Communication', 'serial_path_1')
+		elif parser.has_option('Communication', 'serial_path'):
+			path = parser.get('Communication', 'serial_path')
+		paths = [path]
+		while parser.has_option('Communication', 'serial_path_%d' % (len(paths) + 1)):
+			paths.append(parser.get('Communication', 'serial_path_%d' % (len(paths) + 1)))
+		return paths
+
+	def changes(self, other):
+		'''
+		Public method to list the settings that are different in other (another SignConfig)
+		'''
+		return sorted([name for name, value in self.__dict__.items()
+					   if (not name.startswith('_')) and (getattr(other, name, None) != value)])
+
+
+class ConfigWatcher:
+	'''
+	Notices when config.ini should be read again: on a SIGHUP, or when the file changes (judged
+	by its inode, size and mtime, like LocalContentSource).  The signal handler only sets a flag,
+	and check() does the reading from the main loop, so new settings are swapped in between
+	pages rather than in the middle of one.
+	'''
+
+	def __init__(self, path):
+		self._path = path
+		self._key = self._stat()
+		self._hangup = False
+		try:
+			signal.signal(signal.SIGHUP, self._hangupReceived)
+			# don't let the signal break a fetch or a serial write that's under way
+			signal.siginterrupt(signal.SIGHUP, False)
+		except (ValueError, AttributeError):
+			logging.warning("Can't reload settings on SIGHUP here, only when %s changes" % path)
+
+	def _hangupReceived(self, signum, frame):
+		self._hangup = True
+
+	def _stat(self):
+		try:
+			st = os.stat(self._path)
+		except OSError:
+			return None
+		return (st.st_ino, st.st_size, st.st_mtime)
+
+	def check(self):
+		'''
+		Public method to return new settings if we got a SIGHUP or the file changed - None if
+		not, or if the file can't be used or has no server host (then we keep the old settings,
+		and log why)
+		'''
+		key = self._stat()
+		if (not self._hangup) and (key == self._key):
+			return None
+		self._hangup = False
+		self._key = key
+		if key == None:
+			logging.error("Keeping the old settings, %s isn't there" % self._path)
+			return None
+		try:
+			config = loadconfig(self._path)
+		except ValueError, e:
+			logging.error("Keeping the old settings, %s can't be used: %s" % (self._path, e))
+			return None
+		# a file caught half written can parse, but without what we can't run without
+		if config.serverHost == None:
+			logging.error("Keeping the old settings, %s has no host in its [Server] section" %
+						  self._path)
+			return None
+		return config
+
+
 class LedSign:
 	'''
 	This class can be used to display information on a MovingSign led sign (supporting the v2.1 
@@ -50,11 +519,42 @@ class LedSign:
 
 	_writeToSerial = True	# set to false if testing without a serial port
 	_serial = None			# the serial port for this sign
-	_portname = None		# the /dev/ttyXXX name of this port
+	_portname = None		# the /dev/ttyXXX name of this port (or usb:vendor:product[:serial])
+	_supervisor = None		# PortSupervisor deciding when and where to reopen the port
 	_working = False		# true if we can talk to the sign
+	_sentFrames = None		# text file name -> digest of the last frame the sign acknowledged
+	_sentChecksums = None	# text file name -> checksum of that frame, which the sign reads back
+	_pendingChecksums = None	# text file name -> checksum of the frame on its way to the sign
+	_lastCommitTime = None	# when we last finished sending a frame
+	_residentFiles = None	# how many text files we've left on the sign to cycle through (None if unknown)
+	_showingAllFiles = False	# if we've told the sign to show all its text files in turn
+	_suspect = False		# true once the sign may have lost what we think it holds
+	_cacheStarted = None	# when we last forgot what the sign holds and started over
+	_readback = None		# if the sign answers COMM_READ_STATUS (None until we've asked)
+	_everAcked = False		# if the sign has ever acked a frame we sent it
+	_variableSlots = None	# template variable name -> the sign variable it's kept in
+	_slotUses = None		# template variable name -> when it was last given its sign variable
+	_slotEpoch = 0			# bumped each time a sign variable is given to another name
+	_fileSlots = None		# text file name -> sign variables its text on the sign refers to
+	_pendingSlots = None	# text file name -> sign variables the frame on its way refers to
+	_inlineNames = None		# template variables we've warned are going out as text
+	_sentVariables = None	# sign variable -> value the sign acknowledged
+	_fullFrames = None		# text file name -> digest of the frame a full rewrite would have sent
+	_framesSent = 0			# frames that went out, text and commands
+	_bytesSent = 0			# bytes in those frames
+	_fullBytes = 0			# bytes we'd have sent rewriting the text with the values filled in
+	_updates = 0			# writes that sent anything
+	_updateSecs = 0.0		# total secs those writes took, to the sign's ack
+
+	COMMAND_ACK_TIMEOUT = 3	# secs to wait for a special command to be done (the sign can take 2)
+	READ_TIMEOUT = 3		# secs to wait for the sign's whole answer to a read
+	CACHE_MAX_AGE_SECS = 300	# secs we trust what we think a sign that can't read back holds
 
 	# header constants for comms to the sign
 	COMM_TEXT_FILE_NAME_0 = ['0']
+	COMM_TEXT_FILE_NAMES = [[c] for c in '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ']
+	COMM_VARIABLE_NAMES = [[c] for c in '0123456789ABCDEFGHIJKLMNOPQRSTUV']
+	MAX_VARIABLE_LENGTH = 30
 	COMM_CMD_START = ['\x00','\x00','\x00','\x00','\x00']
 	COMM_START_OF_HEAD = ['\x01']
 	COMM_SEND_ADDR_PC = ['F','F']
@@ -68,6 +568,28 @@ class LedSign:
 	COMM_CMD_WRITE_SPECIAL = ['W']
 	COMM_CMD_READ_SPECIAL = ['R']
 
+	# subcommands for COMM_CMD_WRITE_SPECIAL
+	COMM_SPECIAL_DISPLAY_MODE = ['F']	# which text files to show, followed by one of these:
+	COMM_SHOW_ALL_FILES = ['A']			# every text file in turn
+	COMM_SPECIAL_CLEAR_ALL = ['L']		# delete all the text files
+
+	# subcommands for COMM_CMD_READ_SPECIAL
+	COMM_READ_STATUS = ['S']			# what the sign holds, answered with a frame (see parseStatus)
+
+	# the sign's answer to COMM_READ_STATUS, after its EOT: <SOH>, its address and ours, then
+	# <STX>RS, one of these, an entry for each text file and variable it holds, and <ETX> and
+	# a checksum like any other frame.  This layout hasn't been checked against a real sign yet,
+	# which is why readback is off unless config.ini turns it on.
+	STATUS_SHOWING_ALL = 'A'			# it shows every text file in turn ('-' if not)
+	STATUS_TEXT_FILE = 'T'				# followed by the file name and the checksum of the
+	STATUS_VARIABLE = 'V'				# frame that wrote it, as 4 hex digits
+	STATUS_ENTRY_LENGTH = 6
+
+	# steps in loading text files onto the sign, see residentSteps
+	STEP_CLEAR = 'clear'
+	STEP_TEXT = 'text'
+	STEP_SHOW_ALL = 'show all'
+
 	# use these to control how a body of text is shown
 	COMM_DISPLAY_MODE_AUTO = ['A']
 	COMM_DISPLAY_MODE_FLASH = ['B'] 
@@ -116,6 +638,7 @@ class LedSign:
 	COMM_ALIGN_MODE_RIGHT = ['3']
 
 	COMM_TEXT_DATA_FONT_SS7 = ['\xfe','E']
+	COMM_TEXT_DATA_VARIABLE = '\xfb'		# followed by the variable name
 	COMM_TEXT_DATA_COLOR_AUTO = ['\xfd','A']
 	
 	# footer constants for comms to the sign
@@ -156,347 +679,3956 @@ class LedSign:
 	# use this for two-line signs
 	COMM_TEXT_LINE_BREAK = '\x7f'
 
-	def __init__(self, port, writeToSerial=True):
+	def __init__(self, port, writeToSerial=True, config=None):
 		'''
 		Constructor doesn't do much
 		'''
+		self._config = config or SignConfig()
 		self._serial = None
 		self._portname = port
+		self._supervisor = PortSupervisor(port)
 		self._writeToSerial = writeToSerial
+		self._encoder = FrameEncoder()
+		self._sentFrames = {}
+		self._sentChecksums = {}
+		self._pendingChecksums = {}
+		self._variableSlots = {}
+		self._slotUses = {}
+		self._fileSlots = {}
+		self._pendingSlots = {}
+		self._inlineNames = set()
+		self._sentVariables = {}
+		self._fullFrames = {}
+		self._cacheStarted = time.time()
 		self._open()
 		
 	def _open(self):
 		'''
-		Open the serial port by name
+		Open the serial port by name, or wherever its adapter has moved to
 		'''
+		path = self._supervisor.resolve()
 		try:
-			self._serial = serial.Serial(self._portname, self.BAUDRATE, timeout=1)
+			if path == None:
+				raise IOError("no such adapter plugged in")
+			self._serial = serial.Serial(path, self.BAUDRATE, timeout=1)
 			self._working = True
+			self._supervisor.opened(path)
 		except Exception as e:
 			self._working = False
+			self._supervisor.failed()
 		return self.isWorking()
 	
 	def resetPort(self):
 		'''
 		Handy shortcut to close and reopen the port
 		'''
+		metrics.count('serial.port_resets')
+		self.suspect()
 		self._close()
 		self._open()
+
+	def ensureOpen(self):
+		'''
+		Public method to make sure the port is working before a write, reopening it if it isn't
+		and it is time to try again - returns False straight away while we're backing off, so a
+		dead sign doesn't hold anything up
+		'''
+		if self.isWorking():
+			return True
+		if not self._supervisor.isDue():
+			return False
+		self.resetPort()
+		return self.isWorking()
+
+	def getPortHealth(self):
+		'''
+		Public method to return the PortSupervisor's view of the port, see its getHealth
+		'''
+		return self._supervisor.getHealth()
 	
 	def isWorking(self):
 		'''
 		Public method to return if the serial comms are working or not
 		'''
 		return self._working
-	
-	def _close(self):
+
+	def isWritingToSerial(self):
 		'''
-		Close the previously opened serial port
+		Public method to return if we actually send anything (False when testing without a sign)
 		'''
-		if self._serial:
-			self._working = False
-			self._serial.close()
+		return self._writeToSerial
 	
-	def write(self, text, displayMode=COMM_DISPLAY_MODE_AUTO):
+	def invalidateCache(self):
 		'''
-		Pulic method to write text to the sign - returns True if sign acknowledges it worked
+		Forget what we think the sign is showing, so the next write of every file goes out
 		'''
-		
-		if self._serial == None:
-			return False
-		
-		if not self._writeToSerial:
-			return True
-	
-		# try to re-open it if it wasn't working
-		if not self.isWorking():
-			self.resetPort()
+		self._sentFrames.clear()
+		self._sentChecksums.clear()
+		self._sentVariables.clear()
+		self._residentFiles = None
+		self._showingAllFiles = False
+		self._suspect = False
+		self._cacheStarted = time.time()
 
-		align=self.COMM_ALIGN_MODE_LEFT
-		displaySpeed=self.COMM_DISPLAY_SPEED_2
-		if config.has_option('Communication', 'display_speed'):
-			displaySpeed = [config.get('Communication', 'display_speed')]
-		pauseTime=self.COMM_PAUSE_TIME_9
-		if config.has_option('Communication', 'pause_time'):
-			pauseTime = [config.get('Communication', 'pause_time')]
-
-		newText = text.encode('ascii','ignore')
-		#assemble the message		
-		msgHeader = self.COMM_CMD_START + self.COMM_START_OF_HEAD + self.COMM_SEND_ADDR_PC 
-		msgHeader+= self.COMM_RECEIVER_ADDR_BCAST
-		#print msgHeader
-		msgData = self.COMM_START_OF_TEXT + self.COMM_CMD_WRITE_TEXT + self.COMM_TEXT_FILE_NAME_0 
-		msgData+= displayMode + displaySpeed + pauseTime
-		msgData+= self.COMM_SHOW_DATE_NONE +  self.COMM_START_SHOW_TIME_NONE
-		msgData+= self.COMM_END_SHOW_TIME_NONE + self.COMM_PREPARATAVE_PLACEHOLDER
-		msgData+= align
-		msgData+= self.COMM_TEXT_DATA_FONT_SS7 + self.COMM_TEXT_DATA_COLOR_AUTO
-		[msgData.append(c) for c in newText]
-		msgData+= self.COMM_END_OF_TEXT			
-		#print msgData
-		msgFooter = []
-		msgFooter+= self.COMM_EFFICACY_START
-		checksumInt = 0
-		for c in msgData:
-			checksumInt += ord(c)
-		checksumStr = "%0.4X" % checksumInt
-		[msgFooter.append(c) for c in checksumStr]
-		msgFooter+= self.COMM_END_OF_TRANSMISSION
-		#print msgFooter
-		
-		
-		# send the message to the sign
-		try:
-			
-			# for some reason, these need to be sent separately, it fails if I send them all at once
-			self._serial.write( str(''.join(msgHeader)) )
-			self._serial.write( str(''.join(msgData)) )
-			self._serial.write( str(''.join(msgFooter)) )
-			self._serial.flush()
-						
-			# now check for ok and done signs back
-			#time.sleep(1)
-			result = self._serial.read()
-			if len(result)==0 or ord(result) != 4 :			
-				logging.warning( "Didn't get EOT (0x04) in response!")
-				if len(result) > 0:
-					logging.warning("  got ", str(ord(result)))
-				self._working = False
-			else:
-			#	time.sleep(1)
-				result = self._serial.read()
-				if len(result)==0 or ord(result) != 1:
-					logging.warning("Didn't get SOH (0x01) in response!")
-					if len(result) > 0:
-						logging.warning("  got ", str(ord(result)))
-					self._working = False
-				else:
-					self._working = True
+	def cacheMaxAge(self):
+		'''
+		Public method to return how many secs we trust what we think the sign holds before
+		sending it all again (None to trust it for good, as we can ask a sign that reads back)
+		'''
+		if self.canReadBack():
+			return None
+		maxAge = self._config.cacheMaxAgeSecs
+		if maxAge == None:
+			maxAge = self.CACHE_MAX_AGE_SECS
+		return maxAge or None
 
-		except Exception as e:
-			logging.warning(str(e))
-			self._working = False
+	def expireCache(self):
+		'''
+		Public method to forget what we think the sign holds once that is older than
+		cacheMaxAge, so a sign that lost it (to a power cut that left the serial link up, say)
+		gets it all back from the next write even if the content never changes
+		'''
+		maxAge = self.cacheMaxAge()
+		if (maxAge == None) or (time.time() - self._cacheStarted < maxAge):
+			return
+		if (len(self._sentFrames) > 0) or (len(self._sentVariables) > 0):
+			metrics.count('serial.cache_expired')
+		self.invalidateCache()
 
-		#time.sleep(1)
-		
-		return self.isWorking()
+	def suspect(self):
+		'''
+		Public method to say the sign may have lost what we think it holds (it missed an ack,
+		or may have lost power).  If it can read back, the next write asks it what it still has
+		first, see verify; if not, everything is sent again.
+		'''
+		if self.canReadBack():
+			self._suspect = True
+		else:
+			self.invalidateCache()
 
+	def isSuspect(self):
+		'''
+		Public method to return if we need to check with the sign before trusting what we think
+		it holds
+		'''
+		return self._suspect
 
-class SignManager(Thread):
-	'''
-	This class is a thread wrapper around a serial-port based LedSign.  The point is 
-	to allows sign content updates to happen asyncronously from the content fetching.
-	'''
+	def canReadBack(self):
+		'''
+		Public method to return if we can ask the sign what it holds: we're talking to a real
+		sign, readback isn't turned off, and the sign hasn't shown it can't answer
+		'''
+		return self._writeToSerial and bool(self._config.readback) and self._readback != False
 
-	_contentLock = Lock()		# use when changing the content
-	_content = None				# the text to display on the sign
-	
-	_signLock = Lock()			# use when talking to the LED sign
-	_sign1 = None				# the LedSign object
-	_sign1Working = None
-	
-	def _hasSigns(self):
+	def getTrafficStats(self):
 		'''
-		Helper to see if the signs have been instantiated
+		Public method to return how much we've sent (frames, bytes), how many bytes rewriting
+		the text with its variables filled in would have taken (fullBytes), and how many
+		writes sent anything and how many secs they took in all (updates, updateSecs)
 		'''
-		hasSigns = False
-		with self._signLock:
-			if (self._sign1 != None):
-				hasSigns = True
-		return hasSigns
+		return {'frames': self._framesSent, 'bytes': self._bytesSent, 'fullBytes': self._fullBytes,
+				'updates': self._updates, 'updateSecs': self._updateSecs}
 
-	def _hasContent(self):
+	def recordUpdate(self, secs):
 		'''
-		Helper to see if we have content set
+		Public method to note how long a write that sent something took
 		'''
-		hasContent = False
-		with self._contentLock:
-			if self._content != None:
-				hasContent = True
-		return hasContent
-		
-	def run(self):
+		self._updates += 1
+		self._updateSecs += secs
+
+	def getLastCommitTime(self):
 		'''
-		Loop showing the content
+		Public method to return when the end of the last frame went out (None if never)
 		'''
-		while True:
+		return self._lastCommitTime
 
-			# wait until we have signs
-			if not self._hasSigns():
-				time.sleep(1)
-				continue
-	
-			# wait until we have content
-			if not self._hasContent():
-				time.sleep(1)
-			else:
-				self._updateSign()
-				time.sleep(1)
+	def _close(self):
+		'''
+		Close the previously opened serial port
+		'''
+		if self._serial:
+			self._working = False
+			self._serial.close()
+			self._serial = None
 	
-	def _updateSign(self):
+	def getPortName(self):
+		return self._portname
+
+	def getSerial(self):
 		'''
-		Send the content to the sign - override this for different sign configurations
+		Public method to return the underlying serial port (None if it couldn't be opened)
 		'''
-		content = ""
-		with self._contentLock:
-			content = self._content
-		
-		transition = LedSign.COMM_DISPLAY_MODE_ROLLLEFT
-		# if the content is multi-line that means we're on a two-line sign, so 
-		# use a rollup transition
-		if content.find(LedSign.COMM_TEXT_LINE_BREAK) != -1:
-			transition = LedSign.COMM_DISPLAY_MODE_ROLLUP		
-		
-		with self._signLock:
-			self._sign1Working = self._sign1.write(content, transition)
-		
-		with self._contentLock:
-			self._content = None
+		return self._serial
 
-	def setLedSigns(self, signList):
+	def saveState(self):
 		'''
-		Signs are actually created outside of this thread and passed in via this method
+		Public method to return what we know the sign holds, and the serial port's file
+		descriptor, for a restarted process to pick up with loadState (all JSON-friendly)
 		'''
-		with self._signLock:
-			self._sign1 = signList[0]
-		
-	def setContent(self, msgs):
+		fd = None
+		if self._serial != None:
+			fd = self._serial.fileno()
+		return {'port': self._portname, 'fd': fd,
+				'frames': dict([(key, digest.encode('hex'))
+								for key, digest in self._sentFrames.items()]),
+				'checksums': self._sentChecksums, 'suspect': self._suspect,
+				'readback': self._readback, 'cacheStarted': self._cacheStarted,
+				'variableSlots': self._variableSlots, 'variables': self._sentVariables,
+				'fileSlots': self._fileSlots,
+				'residentFiles': self._residentFiles, 'showingAllFiles': self._showingAllFiles}
+
+	def loadState(self, state):
 		'''
-		Public method to set the content of the sign
+		Public method to carry on from saveState in the process we were restarted from.  Its
+		serial port was left open across the restart, so the sign never saw the line drop;
+		now that we have opened our own, that one is closed.
 		'''
-		with self._contentLock:
-			self._content = msgs
-		
-	def clear(self):
+		if state.get('fd') != None:
+			try:
+				os.close(state['fd'])
+			except OSError:
+				pass
+		if not self.isWorking():
+			return		# we'll find out what the sign has once the port is back
+		self._sentFrames = dict([(str(key), digest.decode('hex'))
+								 for key, digest in state.get('frames', {}).items()])
+		self._sentChecksums = dict([(str(key), str(checksum))
+									for key, checksum in state.get('checksums', {}).items()])
+		self._suspect = state.get('suspect', False)
+		self._readback = state.get('readback')
+		self._cacheStarted = state.get('cacheStarted', self._cacheStarted)
+		self._variableSlots = dict([(name, str(slot))
+									for name, slot in state.get('variableSlots', {}).items()])
+		self._sentVariables = dict([(str(slot), str(value))
+									for slot, value in state.get('variables', {}).items()])
+		self._fileSlots = dict([(str(key), [str(slot) for slot in slots])
+								for key, slots in state.get('fileSlots', {}).items()])
+		self._residentFiles = state.get('residentFiles')
+		self._showingAllFiles = state.get('showingAllFiles', False)
+
+	def setConfig(self, config):
 		'''
-		Public method to remove all the content from the sign
+		Public method to switch to new settings (a SignConfig), from the next frame on
 		'''
-		with self._contentLock:
-			self._content = None	
-	
-	def isSignOk(self):
+		self._config = config
+
+	def displaySettings(self):
 		'''
-		Was the last sign comms successful?
+		Public method to return the (display speed, pause time) text is sent with
 		'''
-		lastStatus = None
-		with self._signLock:
-			lastStatus = self._sign1Working
-		return lastStatus
-		
-	def loopingContent(self):
+		config = self._config
+		return ([config.displaySpeed], [config.pauseTime])
+
+	def encodeText(self, text, displayMode=COMM_DISPLAY_MODE_AUTO,
+				   fileName=COMM_TEXT_FILE_NAME_0, variables=None):
 		'''
-		Override this to say if we are still showing the content
+		Public method to do the work of turning text into a frame ahead of time, without
+		sending or counting anything - returns a ReadyFrame to hand to prepareFrame later
 		'''
-		return False
+		align=self.COMM_ALIGN_MODE_LEFT
+		displaySpeed, pauseTime = self.displaySettings()
 
-class TwoSignManager(SignManager):
-	'''
-	This is a special case SignManager to handle two 1-line led signs used to create
-	a two-line sign.  This is because the two-line sign can't hold one line fixed
-	while scrolling the other horizontally.  So annoying.
-	'''
+		encodeStarted = time.time()
+		newText = translator.translate(text, variables)
+		fullText = newText
+		if variables:
+			newText = self._fillTemplate(newText, variables, True)
+			fullText = self._fillTemplate(fullText, variables, False)
+		#assemble the message
+		ready = ReadyFrame(self._frameKey(text, displayMode, fileName, variables,
+										  (displaySpeed, pauseTime)),
+						   self._encoder.encode(newText, displayMode, displaySpeed, pauseTime,
+												align, fileName))
+		# translated text has no other use for this byte, so what follows each is a variable
+		ready.slots = [part[:1] for part in newText.split(self.COMM_TEXT_DATA_VARIABLE)[1:]]
 
-	MIN_DURATION = 5			# if the computed display time is less than this, don't respect it
-	SECS_PER_CHAR = 0.17		# used to computer amount of time for a msg to scroll across
-	MAX_CHARS_PER_LINE = 13		# used to figure out if a msg is longer than one display
-	
-	_sign2 = None
-	_sign2Working = None
-	_currContentIdx = 0
-	_loopingContent = False
+		# keep track of what a full rewrite (values in the text, no variables) would have sent
+		ready.fullDigest = ready.digest
+		ready.fullBytes = ready.length
+		if fullText != newText:
+			fullFrame = self._encoder.encode(fullText, displayMode, displaySpeed, pauseTime, align,
+											 fileName)
+			ready.fullDigest = hashlib.md5(fullFrame[1]).digest()
+			ready.fullBytes = len(fullFrame[0]) + len(fullFrame[1]) + len(fullFrame[2])
 
-	def _hasSigns(self):
+		metrics.observe('serial.encode', time.time() - encodeStarted)
+		return ready
+
+	def _frameKey(self, text, displayMode, fileName, variables, settings):
+		'''
+		Helper to return what a ReadyFrame depends on, to tell if it's still good to send
+		'''
+		values = None
+		if variables:
+			values = tuple(sorted(variables.items()))
+		return (text, ''.join(displayMode), ''.join(fileName), values, ''.join(settings[0]),
+				''.join(settings[1]), self._slotEpoch)
+
+	def prepareFrame(self, text, displayMode=COMM_DISPLAY_MODE_AUTO,
+					 fileName=COMM_TEXT_FILE_NAME_0, variables=None, ready=None):
+		'''
+		Turn text into a frame for this sign.  Returns None if the sign already acknowledged this
+		exact frame for this file, otherwise a (header, data, footer, cacheKey, digest) tuple -
+		send the first three in order, then report the outcome with frameSent.  Any {name} in
+		the text with a value in variables refers to that sign variable instead (see
+		variableSteps for setting them).  Pass the ReadyFrame from encodeText to skip encoding,
+		which is only used if it was made from the same text and settings.
+		'''
+		if (ready == None) or (ready.key != self._frameKey(text, displayMode, fileName, variables,
+														   self.displaySettings())):
+			ready = self.encodeText(text, displayMode, fileName, variables)
+		msgHeader, msgData, msgFooter = ready.frame
+
+		cacheKey = ''.join(fileName)
+		if self._fullFrames.get(cacheKey) != ready.fullDigest:
+			self._fullFrames[cacheKey] = ready.fullDigest
+			self._fullBytes += ready.fullBytes
+
+		# don't resend a frame the sign already has, it just restarts the scrolling
+		if self.isWorking() and (not self._suspect) and \
+				self._sentFrames.get(cacheKey) == ready.digest:
+			metrics.count('serial.cache_hits')
+			return None
+		metrics.count('serial.cache_misses')
+		self._sentFrames.pop(cacheKey, None)
+		self._sentChecksums.pop(cacheKey, None)
+		self._pendingChecksums[cacheKey] = self._encoder.checksum(msgFooter)
+		self._pendingSlots[cacheKey] = ready.slots
+		self._countFrame(ready.length)
+		return (msgHeader, msgData, msgFooter, cacheKey, ready.digest)
+
+	def _fillTemplate(self, text, variables, useSlots):
+		'''
+		Helper to replace each {name} in already-encoded text with a reference to its sign
+		variable (or with the value itself if useSlots is False, or we're out of variables)
+		'''
+		placeholders = dict([(name, '{' + translator.translate(name) + '}')
+							 for name in variables])
+		used = [name for name in variables if placeholders[name] in text]
+		for name in used:
+			placeholder = placeholders[name]
+			slot = None
+			if useSlots:
+				slot = self._slotFor(name, used)
+			if slot == None:
+				text = text.replace(placeholder, self._variableValue(variables[name]))
+			else:
+				text = text.replace(placeholder, self.COMM_TEXT_DATA_VARIABLE + slot)
+		return text
+
+	def _slotFor(self, name, keep):
+		'''
+		Helper to return the sign variable we keep this template variable in, picking a free one
+		the first time we see it.  Once they're all taken, the one given out longest ago to a
+		name that no text on the sign (or on its way) refers to is taken back, as long as that
+		name isn't in keep (the other names the text being worked out uses).  None if every one
+		is still in use, and then the value goes out as text.
+		'''
+		self._slotUses[name] = time.time()
+		slot = self._variableSlots.get(name)
+		if slot != None:
+			return slot
+		taken = set(self._variableSlots.values())
+		free = [''.join(slot) for slot in self.COMM_VARIABLE_NAMES if ''.join(slot) not in taken]
+		if len(free) > 0:
+			slot = free[0]
+		else:
+			inUse = set([slot for slots in self._fileSlots.values() + self._pendingSlots.values()
+						 for slot in slots])
+			unused = [(self._slotUses.get(other, 0), other)
+					  for other, otherSlot in self._variableSlots.items()
+					  if (otherSlot not in inUse) and (other not in keep)]
+			if len(unused) == 0:
+				if name not in self._inlineNames:
+					self._inlineNames.add(name)
+					logging.warning("All %d sign variables are in use on %s, sending {%s} as text" %
+									(len(self.COMM_VARIABLE_NAMES), self._portname, name))
+				return None
+			other = min(unused)[1]
+			slot = self._variableSlots.pop(other)
+			self._slotUses.pop(other, None)
+			self._slotEpoch += 1	# frames encoded ahead may refer to it as the old name's
+			logging.debug("Sign variable %s on %s goes from {%s} to {%s}" %
+						  (slot, self._portname, other, name))
+		self._variableSlots[name] = slot
+		self._inlineNames.discard(name)
+		return slot
+
+	def _variableValue(self, value):
+		return translator.translate(value)[:self.MAX_VARIABLE_LENGTH]
+
+	def variableSteps(self, texts, variables):
+		'''
+		Public method to list the (sign variable, value) pairs that need writing before texts
+		(a list of text using {name} variables) can be shown - only the values the sign doesn't
+		already have.  Record each one that worked with variableSent.
+		'''
+		steps = []
+		if not variables:
+			return steps
+		used = [name for name in sorted(variables.keys())
+				if len([text for text in texts if ('{' + name + '}') in text]) > 0]
+		for name in used:
+			slot = self._slotFor(name, used)
+			value = self._variableValue(variables[name])
+			if (slot != None) and (self._suspect or self._sentVariables.get(slot) != value):
+				steps.append((slot, value))
+		return steps
+
+	def prepareVariable(self, slot, value):
+		'''
+		Turn a sign variable's new value into a frame, like prepareCommand
+		'''
+		return self.prepareCommand(self.COMM_CMD_WRITE_VAR, [slot, value])
+
+	def variableSent(self, slot, value):
+		'''
+		Public method to record that the sign took this value for this variable
+		'''
+		self._sentVariables[slot] = value
+
+	def _variableChecksum(self, slot, value):
+		'''
+		Helper to return the checksum of the frame that set this variable, which the sign reads
+		back for it
+		'''
+		return self._encoder.checksum(self._encoder.encodeCommand(self.COMM_CMD_WRITE_VAR,
+																  [slot, value])[2])
+
+	def prepareCommand(self, command, data):
+		'''
+		Turn a special function command into a frame for this sign, as a (header, data, footer,
+		None, None) tuple to match prepareFrame - commands aren't cached
+		'''
+		msgHeader, msgData, msgFooter = self._encoder.encodeCommand(command, data)
+		self._countFrame(len(msgHeader) + len(msgData) + len(msgFooter))
+		return (msgHeader, msgData, msgFooter, None, None)
+
+	def prepareRead(self):
+		'''
+		Turn a request for the sign's status into a frame, like prepareCommand - send it, then
+		hand what the sign answers after its EOT to statusRead
+		'''
+		return self.prepareCommand(self.COMM_CMD_READ_SPECIAL, self.COMM_READ_STATUS)
+
+	def _countFrame(self, frameBytes):
+		self._framesSent += 1
+		self._bytesSent += frameBytes
+		metrics.count('serial.frames')
+		metrics.count('serial.bytes', frameBytes)
+
+	def frameSent(self, cacheKey, frameDigest, acknowledged, commitTime=None):
+		'''
+		Record how the sign responded to a frame from prepareFrame or prepareCommand
+		'''
+		if commitTime != None:
+			self._lastCommitTime = commitTime
+		self._working = acknowledged
+		if acknowledged:
+			self._everAcked = True
+		if acknowledged and (commitTime != None):
+			metrics.observe('serial.ack_latency', time.time() - commitTime)
+		if not acknowledged:
+			metrics.count('serial.ack_failures')
+			self._supervisor.failed()
+			self.suspect()
+			return
+		self._supervisor.succeeded()
+		if cacheKey != None:
+			self._sentFrames[cacheKey] = frameDigest
+			self._sentChecksums[cacheKey] = self._pendingChecksums.pop(cacheKey, None)
+			if cacheKey in self._pendingSlots:
+				self._fileSlots[cacheKey] = self._pendingSlots.pop(cacheKey)
+
+	def isReplyDone(self, reply):
+		'''
+		Public method to return if reply (what the sign has sent after the EOT so far) is all
+		of its answer to a read
+		'''
+		soh = ''.join(self.COMM_START_OF_HEAD)
+		return reply.endswith(''.join(self.COMM_END_OF_TRANSMISSION)) or \
+			((self._readback == False) and (reply == soh))
+
+	def parseStatus(self, reply):
+		'''
+		Public method to turn the sign's answer to COMM_READ_STATUS into a dict of
+		showingAllFiles (a bool), files (text file name -> checksum) and variables (sign
+		variable -> checksum) - returns None if it isn't a good answer
+		'''
+		data = self._encoder.decodeReply(reply)
+		if (data == None) or (not data.startswith(''.join(self.COMM_CMD_READ_SPECIAL +
+														   self.COMM_READ_STATUS))):
+			return None
+		data = data[2:]
+		if len(data) == 0 or (len(data) - 1) % self.STATUS_ENTRY_LENGTH != 0:
+			return None
+		status = {'showingAllFiles': data[0] == self.STATUS_SHOWING_ALL, 'files': {},
+				  'variables': {}}
+		for start in range(1, len(data), self.STATUS_ENTRY_LENGTH):
+			entry = data[start:start + self.STATUS_ENTRY_LENGTH]
+			if entry[0] == self.STATUS_TEXT_FILE:
+				status['files'][entry[1]] = entry[2:]
+			elif entry[0] == self.STATUS_VARIABLE:
+				status['variables'][entry[1]] = entry[2:]
+		return status
+
+	def statusRead(self, reply, commitTime=None):
+		'''
+		Record how the sign answered a frame from prepareRead: reply is everything it sent after
+		its EOT, or None if it didn't answer.  Returns its status (see parseStatus), or None.
+		Anything we thought the sign held that it doesn't is forgotten, so the next write sends
+		just that.  A sign that has acked our writes but never answered a read is taken to be
+		one that can't, so it isn't counted as gone: what it holds is forgotten instead, and the
+		next write sends everything again.
+		'''
+		if (reply == None) and self._everAcked and (self._readback != True):
+			if self._readback != False:
+				logging.info("The sign on %s doesn't answer reads, so it can't read back what "
+							 "it holds" % self._portname)
+			self._readback = False
+			self.invalidateCache()
+			return None
+		self.frameSent(None, None, reply != None, commitTime)
+		if reply == None:
+			return None
+		metrics.count('serial.reads')
+		status = self.parseStatus(reply)
+		if status == None:
+			if reply == ''.join(self.COMM_START_OF_HEAD):
+				if self._readback != False:
+					logging.info("The sign on %s can't read back what it holds" % self._portname)
+				self._readback = False		# it acks a read like any other frame
+			if self._suspect:
+				self.invalidateCache()		# so we can't tell what it has
+			return None
+		self._readback = True
+		self._suspect = False
+		lost = self._reconcile(status)
+		if lost > 0:
+			metrics.count('serial.readback_lost', lost)
+			logging.info("The sign on %s had lost %d of the things we sent it" %
+						 (self._portname, lost))
+		return status
+
+	def _reconcile(self, status):
+		'''
+		Helper to forget what we thought the sign held that its status says it doesn't - returns
+		how many things that was
+		'''
+		lost = 0
+		for fileName in self._sentFrames.keys():
+			if status['files'].get(fileName) != self._sentChecksums.get(fileName):
+				del self._sentFrames[fileName]
+				self._sentChecksums.pop(fileName, None)
+				lost += 1
+		for slot, value in self._sentVariables.items():
+			if status['variables'].get(slot) != self._variableChecksum(slot, value):
+				del self._sentVariables[slot]
+				lost += 1
+		if self._showingAllFiles and not status['showingAllFiles']:
+			self._showingAllFiles = False
+			lost += 1
+		if self._residentFiles != None:
+			ours = [''.join(name) for name in self.COMM_TEXT_FILE_NAMES[:self._residentFiles]]
+			if len([name for name in status['files'] if name not in ours]) > 0:
+				self._residentFiles = None		# files we didn't leave there, so start over
+		return lost
+
+	def probe(self):
+		'''
+		Public method to check the sign is still there by reading its status, a frame of 20
+		bytes or so instead of a whole text frame - returns True if it answered.  What it says
+		it holds is checked against what we think, like verify.
+		'''
+		if not self.ensureOpen():
+			return False
+
+		if not self._writeToSerial:
+			return True
+
+		msgHeader, msgData, msgFooter, cacheKey, frameDigest = self.prepareRead()
+		reply, commitTime = self._read(msgHeader, msgData, msgFooter)
+		self.statusRead(reply, commitTime)
+		return self.isWorking()
+
+	def verify(self):
+		'''
+		Public method to ask the sign what it still holds if it may have lost some of it (see
+		suspect), so the next write sends only what's missing - returns False if it didn't
+		answer.  Does nothing if there's nothing to check, and if the sign turns out not to
+		answer reads at all, the next write just sends everything again.  What we think it
+		holds is forgotten first if it's too old, see expireCache.
+		'''
+		self.expireCache()
+		if not self._suspect:
+			return True
+		return self.probe() or not self.canReadBack()
+
+	def write(self, text, displayMode=COMM_DISPLAY_MODE_AUTO, fileName=COMM_TEXT_FILE_NAME_0,
+			  barrier=None, variables=None, ready=None):
+		'''
+		Pulic method to write text to the sign - returns True if sign acknowledges it worked.  If
+		the sign already acknowledged this exact frame for this file, nothing is sent.  Pass in a
+		PageBarrier to hold back the end of the frame (which is what makes the sign switch) until
+		the other signs sharing that barrier are ready too.  Any {name} in the text with a value
+		in variables is shown from a sign variable, so when only the values change just they
+		get sent.  ready is the frame from encodeText, if it was encoded ahead of time.
+		'''
+		
+		# try to re-open it if it wasn't working
+		if not self.ensureOpen():
+			return False
+		
+		if not self._writeToSerial:
+			return True
+
+		if not self.verify():
+			return False
+		started = time.time()
+		sentVariables = self._writeVariables([text], variables)
+		if sentVariables == None:
+			return False
+		frame = self.prepareFrame(text, displayMode, fileName, variables, ready)
+		if frame == None:
+			if sentVariables > 0:
+				self.recordUpdate(time.time() - started)
+			return True
+		msgHeader, msgData, msgFooter, cacheKey, frameDigest = frame
+		acknowledged, commitTime = self._send(msgHeader, msgData, msgFooter, barrier)
+		self.frameSent(cacheKey, frameDigest, acknowledged, commitTime)
+		self.recordUpdate(time.time() - started)
+
+		#time.sleep(1)
+		
+		return self.isWorking()
+
+	def _writeVariables(self, texts, variables):
+		'''
+		Helper to send the variable values texts need that the sign doesn't have yet - returns
+		how many went out, or None if the sign didn't take one
+		'''
+		steps = self.variableSteps(texts, variables)
+		for slot, value in steps:
+			msgHeader, msgData, msgFooter, cacheKey, frameDigest = self.prepareVariable(slot, value)
+			acknowledged, commitTime = self._send(msgHeader, msgData, msgFooter)
+			self.frameSent(cacheKey, frameDigest, acknowledged, commitTime)
+			if not acknowledged:
+				return None
+			self.variableSent(slot, value)
+		return len(steps)
+
+	def writeCommand(self, command, data):
+		'''
+		Public method to send a special function command (eg. COMM_CMD_WRITE_SPECIAL with a
+		subcommand and its data) - returns True if the sign acknowledges it worked
+		'''
+		if not self.ensureOpen():
+			return False
+		
+		if not self._writeToSerial:
+			return True
+
+		msgHeader, msgData, msgFooter, cacheKey, frameDigest = self.prepareCommand(command, data)
+		acknowledged, commitTime = self._send(msgHeader, msgData, msgFooter,
+											  ackTimeout=self.COMMAND_ACK_TIMEOUT)
+		self.frameSent(cacheKey, frameDigest, acknowledged, commitTime)
+		return self.isWorking()
+
+	def _send(self, msgHeader, msgData, msgFooter, barrier=None, ackTimeout=None):
+		'''
+		Helper to send a frame and wait for the sign to answer - returns (acknowledged,
+		commitTime).  ackTimeout is how long to wait for the sign to finish with the frame, if
+		that can take longer than the serial port's timeout.
+		'''
+		acknowledged = False
+		commitTime = None
+		try:
+
+			# for some reason, these need to be sent separately, it fails if I send them all at once
+			self._serial.write(msgHeader)
+			self._serial.write(msgData)
+			if barrier != None:
+				# get the data onto the wire, then line up with the other signs
+				self._serial.flush()
+				barrier.wait(self)
+			self._serial.write(msgFooter)
+			self._serial.flush()
+			commitTime = time.time()
+						
+			# now check for ok and done signs back
+			#time.sleep(1)
+			result = self._serial.read()
+			if len(result)==0 or ord(result) != 4 :			
+				logging.warning( "Didn't get EOT (0x04) in response!")
+				if len(result) > 0:
+					logging.warning("  got %s", str(ord(result)))
+			else:
+			#	time.sleep(1)
+				result = self._serial.read()
+				if ackTimeout != None:
+					deadline = commitTime + ackTimeout
+					while len(result)==0 and time.time() < deadline:
+						result = self._serial.read()
+				if len(result)==0 or ord(result) != 1:
+					logging.warning("Didn't get SOH (0x01) in response!")
+					if len(result) > 0:
+						logging.warning("  got %s", str(ord(result)))
+				else:
+					acknowledged = True
+
+		except Exception as e:
+			logging.warning(str(e))
+
+		trace.frame(self._portname, (msgHeader, msgData, msgFooter), commitTime, acknowledged)
+		return (acknowledged, commitTime)
+
+	def _read(self, msgHeader, msgData, msgFooter):
+		'''
+		Helper to send a read and collect the sign's answer - returns (reply, commitTime), with
+		reply everything the sign sent after its EOT, or None if it didn't answer
+		'''
+		reply = None
+		commitTime = None
+		try:
+			self._serial.write(msgHeader)
+			self._serial.write(msgData)
+			self._serial.write(msgFooter)
+			self._serial.flush()
+			commitTime = time.time()
+
+			result = self._serial.read()
+			if len(result)==0 or ord(result) != 4 :
+				logging.warning( "Didn't get EOT (0x04) in response!")
+			else:
+				reply = ''
+				deadline = commitTime + self.READ_TIMEOUT
+				while (not self.isReplyDone(reply)) and time.time() < deadline:
+					result = self._serial.read()
+					if len(result) == 0:
+						break
+					reply += result
+
+		except Exception as e:
+			logging.warning(str(e))
+
+		trace.frame(self._portname, (msgHeader, msgData, msgFooter), commitTime, reply != None,
+					reply)
+		return (reply, commitTime)
+
+	def residentSteps(self, files):
+		'''
+		Public method to plan loading files (a list of (text, displayMode)) into the sign's own
+		text files, one each, for the sign to cycle through by itself.  Returns a list of
+		(STEP_*, args) to do in order: files the sign already has are left alone, and since a
+		single file can't be deleted, having fewer files than last time means clearing them all
+		and starting over.  Call residentLoaded once all the steps worked.
+		'''
+		steps = []
+		clearing = self._suspect or (self._residentFiles == None) or \
+			(len(files) < self._residentFiles)
+		if clearing:
+			steps.append((self.STEP_CLEAR, None))
+		for i in range(len(files)):
+			text, displayMode = files[i]
+			steps.append((self.STEP_TEXT, (text, displayMode, self.COMM_TEXT_FILE_NAMES[i])))
+		# clearing wipes all the display data, which may include the setting to show every file
+		if clearing or (not self._showingAllFiles):
+			steps.append((self.STEP_SHOW_ALL, None))
+		return steps
+
+	def residentLoaded(self, fileCount):
+		'''
+		Public method to record that the steps from residentSteps all worked
+		'''
+		self._residentFiles = fileCount
+		self._showingAllFiles = True
+		# any files past these were cleared, so their variables are free to go to other names
+		ours = [''.join(name) for name in self.COMM_TEXT_FILE_NAMES[:fileCount]]
+		for fileName in self._fileSlots.keys():
+			if fileName not in ours:
+				del self._fileSlots[fileName]
+
+	def writeFiles(self, files, variables=None):
+		'''
+		Public method to load files (a list of (text, displayMode)) into the sign's own text
+		files and have it cycle through them by itself, sending only what changed - returns
+		True if the sign took all of it.  variables works like it does for write.
+		'''
+		files = files[:len(self.COMM_TEXT_FILE_NAMES)]
+		if not self.verify():
+			return False
+		for step, args in self.residentSteps(files):
+			if step == self.STEP_CLEAR:
+				self.invalidateCache()
+				worked = self.writeCommand(self.COMM_CMD_WRITE_SPECIAL, self.COMM_SPECIAL_CLEAR_ALL)
+			elif step == self.STEP_TEXT:
+				text, displayMode, fileName = args
+				worked = self.write(text, displayMode, fileName, variables=variables)
+			else:
+				worked = self.writeCommand(self.COMM_CMD_WRITE_SPECIAL,
+										   self.COMM_SPECIAL_DISPLAY_MODE + self.COMM_SHOW_ALL_FILES)
+			if not worked:
+				return False
+		self.residentLoaded(len(files))
+		return True
+
+
+class FrameEncoder:
+	'''
+	Builds the byte frames for the MovingSign v2.1 "write text" command.  Everything in a frame
+	except the message text and checksum is constant for a given file name, display mode, speed,
+	pause time and alignment, so those blocks are assembled once per combination and cached.
+	'''
+
+	HEADER = ''.join(LedSign.COMM_CMD_START + LedSign.COMM_START_OF_HEAD +
+					 LedSign.COMM_SEND_ADDR_PC + LedSign.COMM_RECEIVER_ADDR_BCAST)
+	END_OF_TEXT = ''.join(LedSign.COMM_END_OF_TEXT)
+	REPLY_HEADER = ''.join(LedSign.COMM_START_OF_HEAD + LedSign.COMM_RECEIVER_ADDR_BCAST +
+						   LedSign.COMM_SEND_ADDR_PC + LedSign.COMM_START_OF_TEXT)
+	FOOTER_START = ''.join(LedSign.COMM_EFFICACY_START)
+	FOOTER_END = ''.join(LedSign.COMM_END_OF_TRANSMISSION)
+
+	def __init__(self):
+		self._preambles = {}	# (file, mode, speed, pause, align) -> data block before the text
+
+	def _preamble(self, fileName, displayMode, displaySpeed, pauseTime, align):
+		'''
+		Return the cached data block that goes between <STX> and the message text
+		'''
+		key = (''.join(fileName), ''.join(displayMode), ''.join(displaySpeed),
+			   ''.join(pauseTime), ''.join(align))
+		preamble = self._preambles.get(key)
+		if preamble == None:
+			preamble = ''.join(LedSign.COMM_START_OF_TEXT + LedSign.COMM_CMD_WRITE_TEXT +
+							   list(key[0]) + list(key[1]) + list(key[2]) + list(key[3]) +
+							   LedSign.COMM_SHOW_DATE_NONE + LedSign.COMM_START_SHOW_TIME_NONE +
+							   LedSign.COMM_END_SHOW_TIME_NONE +
+							   LedSign.COMM_PREPARATAVE_PLACEHOLDER + list(key[4]) +
+							   LedSign.COMM_TEXT_DATA_FONT_SS7 + LedSign.COMM_TEXT_DATA_COLOR_AUTO)
+			self._preambles[key] = preamble
+		return preamble
+
+	def encodeCommand(self, command, data):
+		'''
+		Public method to build the (header, data, footer) strings for any other command, from
+		its command code and data field
+		'''
+		payload = bytearray(''.join(LedSign.COMM_START_OF_TEXT + command + data))
+		payload += self.END_OF_TEXT
+		footer = self.FOOTER_START + ("%0.4X" % sum(payload)) + self.FOOTER_END
+		return (self.HEADER, str(payload), footer)
+
+	def checksum(self, footer):
+		'''
+		Public method to return the checksum in a footer, which is how the sign tells us which
+		frame it holds for a file or variable
+		'''
+		return footer[len(self.FOOTER_START):-len(self.FOOTER_END)]
+
+	def decodeReply(self, reply):
+		'''
+		Public method to return the command code and data of a frame the sign sent us, or None
+		if it isn't a whole frame with the right checksum
+		'''
+		end = reply.rfind(self.END_OF_TEXT)
+		if (not reply.startswith(self.REPLY_HEADER)) or (end < 0) or \
+				(reply[end + 1:] != self.FOOTER_START + reply[end + 2:end + 6] + self.FOOTER_END):
+			return None
+		payload = bytearray(reply[len(self.REPLY_HEADER) - 1:end + 1])
+		if reply[end + 2:end + 6] != ("%0.4X" % sum(payload)):
+			return None
+		return str(payload[1:-1])
+
+	def encode(self, text, displayMode=LedSign.COMM_DISPLAY_MODE_AUTO,
+			   displaySpeed=LedSign.COMM_DISPLAY_SPEED_2, pauseTime=LedSign.COMM_PAUSE_TIME_9,
+			   align=LedSign.COMM_ALIGN_MODE_LEFT, fileName=LedSign.COMM_TEXT_FILE_NAME_0):
+		'''
+		Public method to turn already-translated text (see TextTranslator) into a (header, data,
+		footer) tuple of strings, ready to be written to the serial port in that order
+		'''
+		payload = bytearray(self._preamble(fileName, displayMode, displaySpeed, pauseTime, align))
+		payload += text
+		payload += self.END_OF_TEXT
+		# checksum is the sum of every byte from <STX> to <ETX> (ie. the whole payload)
+		footer = self.FOOTER_START + ("%0.4X" % sum(payload)) + self.FOOTER_END
+		return (self.HEADER, str(payload), footer)
+
+
+class TextTranslator:
+	'''
+	Turns text from the server into the bytes the sign shows.  The sign's special symbols can be
+	written as {name} markup, with the name of one of LedSign's COMM_SPECIAL_ glyphs in lower
+	case (eg. {clock}, {right_arrow}), or as the unicode character for them where there is one.
+	Accented letters lose their accents, a few others are spelled out, and anything else the
+	sign can't show is dropped.  Characters go through a table worked out ahead of time, so
+	translating is one pass in C, plus a search for each glyph's markup if the text has any.
+	Translations are cached by text.
+	'''
+
+	CACHE_SIZE = 256			# texts to remember
+	# characters worked out ahead of time: Latin-1, Latin Extended-A and B, and punctuation
+	TABLE_RANGES = [(0x80, 0x250), (0x2000, 0x2070)]
+	# unicode characters for the sign's glyphs, by glyph name
+	SYMBOL_CHARS = {'asterix': u'\u2731', 'clock': u'\u231a\u23f0', 'phone': u'\u260e\u260f',
+					'key': u'\u26bf', 'car': u'\u26df', 'crown': u'\u265a\u265b',
+					'right_arrow': u'\u2192\u27a1', 'left_arrow': u'\u2190\u2b05',
+					'down_left_arrow': u'\u2199', 'up_left_arrow': u'\u2196', 'tea_cup': u'\u2615',
+					'envelope': u'\u2709', 'bell': u'\u237e', 'smiley': u'\u263a\u263b'}
+	# letters with no ascii decomposition, and punctuation that has a plainer form
+	SPELLED = {u'\xdf': 'ss', u'\xe6': 'ae', u'\xc6': 'AE', u'\u0153': 'oe', u'\u0152': 'OE',
+			   u'\xf8': 'o', u'\xd8': 'O', u'\u0142': 'l', u'\u0141': 'L', u'\u0111': 'd',
+			   u'\u0110': 'D', u'\xf0': 'd', u'\xd0': 'D', u'\xfe': 'th', u'\xde': 'Th',
+			   u'\u2018': "'", u'\u2019': "'", u'\u201c': '"', u'\u201d': '"', u'\u2013': '-',
+			   u'\u2014': '-', u'\u2212': '-', u'\u2026': '...', u'\xb0': 'o'}
+
+	def __init__(self):
+		self._symbols = {}		# markup name -> glyph
+		for attr in dir(LedSign):
+			value = getattr(LedSign, attr)
+			if attr.startswith('COMM_SPECIAL_') and isinstance(value, str) and \
+					('KNOWN' not in attr):
+				self._symbols[attr[len('COMM_SPECIAL_'):].lower()] = unicode(value, 'latin-1')
+		# character code -> what it becomes (u'' if it's dropped), for unicode.translate
+		self._table = dict([(code, code) for code in range(0x80)])
+		for start, end in self.TABLE_RANGES:
+			for code in range(start, end):
+				self._table[code] = self._char(unichr(code))
+		for name, chars in self.SYMBOL_CHARS.items():
+			for c in chars:
+				self._table[ord(c)] = self._symbols[name]
+		self._markup = [(name, u'{' + name + u'}', glyph) for name, glyph in self._symbols.items()]
+		self._unknown = re.compile(u'[^\\x00-\\xff]')
+		self._cache = {}		# (text, kept names) -> translation
+		self._cacheOrder = []	# keys, oldest first
+		self._lock = Lock()
+
+	def symbols(self):
+		'''
+		Public method to return the markup names the sign has glyphs for
+		'''
+		return sorted(self._symbols.keys())
+
+	def translate(self, text, variables=None):
+		'''
+		Public method to return text as sign bytes.  Any {name} with a value in variables is left
+		for the variable, even if the sign has a glyph by that name.  A str is taken as latin-1.
+		'''
+		if '{' not in text:
+			try:
+				return text.encode('ascii')		# nothing to translate, or to cache
+			except UnicodeError:
+				pass
+		if isinstance(text, str):
+			text = unicode(text, 'latin-1')
+		kept = ()
+		if variables:
+			kept = tuple(sorted([name for name in variables if name in self._symbols]))
+		key = (text, kept)
+		translated = self._cache.get(key)
+		if translated != None:
+			return translated
+		translated = self._translate(text, kept)
+		with self._lock:
+			if key not in self._cache:
+				self._cache[key] = translated
+				self._cacheOrder.append(key)
+				if len(self._cacheOrder) > self.CACHE_SIZE:
+					del self._cache[self._cacheOrder.pop(0)]
+		return translated
+
+	def _translate(self, text, kept):
+		translated = text.translate(self._table)
+		if self._unknown.search(translated) != None:
+			# characters the table hasn't seen yet, so work them out and go again
+			for c in set(self._unknown.findall(translated)):
+				self._table[ord(c)] = self._char(c)
+			translated = text.translate(self._table)
+		if u'{' in translated:
+			for name, markup, glyph in self._markup:
+				if (markup in translated) and (name not in kept):
+					translated = translated.replace(markup, glyph)
+		return translated.encode('latin-1')
+
+	def _char(self, c):
+		'''
+		Helper to work out what a non-ascii character becomes
+		'''
+		translated = self.SPELLED.get(c)
+		if translated == None:
+			translated = unicodedata.normalize('NFKD', c).encode('ascii', 'ignore')
+		return unicode(translated)
+
+translator = TextTranslator()
+
+
+class ReadyFrame:
+	'''
+	A text frame LedSign.encodeText built ahead of time, with what it was built from (key) so
+	prepareFrame can tell if it's still the frame to send
+	'''
+
+	def __init__(self, key, frame):
+		self.key = key
+		self.frame = frame			# (header, data, footer)
+		self.length = len(frame[0]) + len(frame[1]) + len(frame[2])
+		self.digest = hashlib.md5(frame[1]).digest()
+		self.fullDigest = None		# digest and length of the frame without sign variables
+		self.fullBytes = None
+		self.slots = []				# sign variables the text refers to
+
+
+class PortSupervisor:
+	'''
+	Decides when a LedSign should try to (re)open its serial port, and which device to open.
+	After a failure it waits longer each time (up to MAX_BACKOFF secs) before trying again, so a
+	dead or missing sign costs almost nothing per write.  A new device showing up in /dev (an
+	adapter being plugged back in) cuts the wait short.  USB adapters can come back under a
+	different /dev/ttyUSBn name, so once a port has opened we remember the adapter's USB vendor,
+	product, serial number and hub position from sysfs, and find it again by those.  A port can
+	also be named by USB identity from the start, as "usb:vendor:product" or
+	"usb:vendor:product:serial" (ids in hex, like lsusb shows them).
+	'''
+
+	MIN_BACKOFF = 1				# secs to wait after the first failure
+	MAX_BACKOFF = 60			# longest we'll wait between tries
+	DEV_DIR = '/dev'
+	SYSFS_TTY_DIR = '/sys/class/tty'
+	USB_PREFIX = 'usb:'
+
+	def __init__(self, portname):
+		self._portname = portname		# what we were configured with
+		self._path = portname			# the device we last opened (or will try first)
+		self._identity = None			# USB identity of the adapter, once we know it
+		self._failures = 0				# failures in a row
+		self._nextTry = 0				# when we can try again
+		self._rebinds = 0				# times we found the adapter under a new name
+		self._devWatch = None			# inotify descriptor for DEV_DIR, once we need one
+		self._devEntries = None			# what was in DEV_DIR when we failed, without inotify
+		if portname.startswith(self.USB_PREFIX):
+			parts = portname[len(self.USB_PREFIX):].split(':')
+			self._identity = {'vendor': parts[0].lower(), 'product': parts[1].lower(),
+							  'serial': None, 'location': None}
+			if len(parts) > 2:
+				self._identity['serial'] = ':'.join(parts[2:]).lower()
+			self._path = None
+
+	def isDue(self):
+		'''
+		Public method to say if it is worth trying to open the port now - True unless we're
+		backing off after a failure and no new device has shown up since
+		'''
+		if self._failures == 0:
+			return True
+		if time.time() >= self._nextTry:
+			return True
+		return self._devicesChanged()
+
+	def resolve(self):
+		'''
+		Public method to return the device path to open, or None if the adapter isn't plugged in
+		'''
+		if (self._path != None) and os.path.exists(self._path) and \
+				((self._identity == None) or self._matches(self._path)):
+			return self._path
+		if self._identity == None:
+			return self._path
+		path = self._find()
+		if (path != None) and (path != self._path):
+			if self._path != None:
+				self._rebinds += 1
+				metrics.count('serial.rebinds')
+				logging.warning("Serial adapter for %s is now at %s" % (self._portname, path))
+			self._path = path
+		return path
+
+	def opened(self, path):
+		'''
+		Public method to record that the port at path opened, and remember which adapter it is
+		'''
+		identity = self.usbIdentity(path)
+		if identity != None:
+			if (self._identity == None) or (self._identity['serial'] == None):
+				self._identity = identity
+		self._path = path
+
+	def succeeded(self):
+		'''
+		Public method to record that the sign answered, so the next failure starts backing off
+		from the beginning
+		'''
+		if self._failures > 0:
+			logging.info("Serial port %s is working again" % self._path)
+		self._failures = 0
+		self._closeWatch()
+
+	def failed(self):
+		'''
+		Public method to record that the port couldn't be opened or the sign didn't answer
+		'''
+		self._failures += 1
+		backoff = min(self.MAX_BACKOFF, self.MIN_BACKOFF * (2 ** (self._failures - 1)))
+		self._nextTry = time.time() + backoff
+		if self._failures == 1 or backoff < self.MAX_BACKOFF:
+			logging.warning("Serial port %s isn't working, trying again in %d secs" %
+							(self._portname, backoff))
+		self._startWatch()
+
+	def getHealth(self):
+		'''
+		Public method to return the device in use, failures in a row, secs until the next try
+		and how many times the adapter moved
+		'''
+		retryIn = 0
+		if self._failures > 0:
+			retryIn = max(0, self._nextTry - time.time())
+		return {'path': self._path, 'failures': self._failures, 'retryIn': retryIn,
+				'rebinds': self._rebinds}
+
+	def _startWatch(self):
+		'''
+		Helper to start noticing new devices, with inotify if we can or by listing DEV_DIR
+		'''
+		if self._devWatch == None:
+			self._devWatch = inotifyWatch(self.DEV_DIR, LocalContentSource.IN_CREATE |
+										  LocalContentSource.IN_ATTRIB)
+		if self._devWatch == None:
+			self._devEntries = self._listDevices()
+
+	def _closeWatch(self):
+		if self._devWatch != None:
+			os.close(self._devWatch)
+			self._devWatch = None
+		self._devEntries = None
+
+	def _devicesChanged(self):
+		'''
+		Helper to say if a device showed up in DEV_DIR since we last checked
+		'''
+		if self._devWatch != None:
+			changed = False
+			try:
+				while os.read(self._devWatch, 4096):
+					changed = True
+			except OSError:
+				pass
+			return changed
+		entries = self._listDevices()
+		changed = (self._devEntries != None) and (len(entries - self._devEntries) > 0)
+		self._devEntries = entries
+		return changed
+
+	def _listDevices(self):
+		try:
+			return set(os.listdir(self.DEV_DIR))
+		except OSError:
+			return set()
+
+	def _find(self):
+		'''
+		Helper to look through the tty devices for our adapter - returns its path, or None
+		'''
+		try:
+			names = sorted(os.listdir(self.SYSFS_TTY_DIR))
+		except OSError:
+			return None
+		matches = []
+		for name in names:
+			path = os.path.join(self.DEV_DIR, name)
+			if self._matches(path):
+				matches.append(path)
+		if len(matches) == 1:
+			return matches[0]
+		# more than one adapter of the same kind, so go by where it's plugged in
+		for path in matches:
+			identity = self.usbIdentity(path)
+			if identity['location'] == self._identity['location']:
+				return path
+		return None
+
+	def _matches(self, path):
+		'''
+		Helper to say if the device at path is our adapter - by serial number if it has one,
+		otherwise by vendor and product
+		'''
+		identity = self.usbIdentity(path)
+		if identity == None:
+			return False
+		if (identity['vendor'] != self._identity['vendor']) or \
+				(identity['product'] != self._identity['product']):
+			return False
+		return (self._identity['serial'] == None) or (identity['serial'] == self._identity['serial'])
+
+	def usbIdentity(self, path):
+		'''
+		Public method to return the USB vendor, product, serial number (None if it has none)
+		and hub location of the adapter behind a tty device, or None if it isn't a USB one
+		'''
+		name = os.path.basename(os.path.realpath(path))
+		device = os.path.join(self.SYSFS_TTY_DIR, name, 'device')
+		if not os.path.exists(device):
+			return None
+		usbDevice = os.path.realpath(device)
+		while not os.path.exists(os.path.join(usbDevice, 'idVendor')):
+			parent = os.path.dirname(usbDevice)
+			if parent == usbDevice:
+				return None
+			usbDevice = parent
+		return {'vendor': self._readAttribute(usbDevice, 'idVendor'),
+				'product': self._readAttribute(usbDevice, 'idProduct'),
+				'serial': self._readAttribute(usbDevice, 'serial'),
+				'location': os.path.basename(usbDevice)}
+
+	def _readAttribute(self, directory, name):
+		try:
+			f = open(os.path.join(directory, name))
+			try:
+				return f.read().strip().lower() or None
+			finally:
+				f.close()
+		except IOError:
+			return None
+
+
+class PageBarrier:
+	'''
+	Lets several signs finish sending their frames at (nearly) the same moment, so they switch
+	pages together.  Each sign waits here after sending all but the last few bytes of its frame.
+	A sign that won't be sending anything (or gave up) leaves instead, so nobody waits on it.
+	'''
+
+	def __init__(self, parties, timeout):
+		self._parties = parties
+		self._timeout = timeout
+		self._arrived = set()
+		self._cond = Condition()
+
+	def wait(self, who):
+		'''
+		Block until every party has arrived or left, or until the timeout passes
+		'''
+		with self._cond:
+			self._arrived.add(who)
+			self._cond.notifyAll()
+			deadline = time.time() + self._timeout
+			while len(self._arrived) < self._parties:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					logging.warning("Gave up waiting for the other signs to be ready")
+					break
+				self._cond.wait(remaining)
+
+	def leave(self, who):
+		'''
+		Say we're done without waiting - a no-op for a party that already arrived
+		'''
+		with self._cond:
+			if who not in self._arrived:
+				self._arrived.add(who)
+				self._cond.notifyAll()
+
+
+class SignWrite:
+	'''
+	One pending write to a sign, handed to a SignWriter.  Call wait() to get the result.
+	'''
+
+	def __init__(self, text, displayMode, barrier, files=None, variables=None, ready=None):
+		self.text = text
+		self.displayMode = displayMode
+		self.barrier = barrier
+		self.files = files			# (text, displayMode) list for LedSign.writeFiles instead
+		self.variables = variables	# values for the {name}s in the text
+		self.ready = ready			# the ReadyFrame for the text, if it was encoded ahead of time
+		self.result = None
+		self.started = None			# when the writer picked it up
+		self.commitTime = None		# when the frame finished going out, None if nothing was sent
+		self.elapsed = None			# secs from queueing the write to the sign answering
+		self._queued = time.time()
+		self._done = Event()
+
+	def finish(self, result, commitTime):
+		self.result = result
+		self.commitTime = commitTime
+		self.elapsed = time.time() - self._queued
+		self._done.set()
+
+	def isDone(self):
+		return self._done.isSet()
+
+	def wait(self, timeout=None):
+		'''
+		Block until the sign acknowledged (or failed) this write, or until timeout secs pass,
+		and return if it worked (None if it hasn't finished)
+		'''
+		self._done.wait(timeout)
+		return self.result
+
+
+class SignWriter(Thread):
+	'''
+	Owns one LedSign and does all the writing to it from its own thread.  This lets us talk to
+	several signs at once, instead of waiting on one sign's ack before writing to the next.
+	'''
+
+	def __init__(self, sign):
+		Thread.__init__(self)
+		self.daemon = True
+		self._sign = sign
+		self._lock = Lock()			# use when talking to the LED sign
+		self._queue = Queue.Queue()
+
+	def run(self):
+		while True:
+			job = self._queue.get()
+			with self._lock:
+				job.started = time.time()
+				lastCommit = self._sign.getLastCommitTime()
+				if job.files != None:
+					result = self._sign.writeFiles(job.files, job.variables)
+				else:
+					result = self._sign.write(job.text, job.displayMode, barrier=job.barrier,
+											  variables=job.variables, ready=job.ready)
+				commitTime = self._sign.getLastCommitTime()
+			if job.barrier != None:
+				job.barrier.leave(self._sign)
+			if commitTime == lastCommit:
+				commitTime = None
+			job.finish(result, commitTime)
+
+	def write(self, text, displayMode, barrier=None, variables=None, ready=None):
+		'''
+		Public method to queue up text for the sign - returns a SignWrite to wait on
+		'''
+		job = SignWrite(text, displayMode, barrier, variables=variables, ready=ready)
+		self._queue.put(job)
+		return job
+
+	def writeFiles(self, files, variables=None):
+		'''
+		Public method to queue up loading files into the sign's own text files - returns a
+		SignWrite to wait on
+		'''
+		job = SignWrite(None, None, None, files, variables)
+		self._queue.put(job)
+		return job
+
+
+class SignManager(Thread):
+	'''
+	This class is a thread wrapper around a serial-port based LedSign.  The point is 
+	to allows sign content updates to happen asyncronously from the content fetching.
+	The thread sleeps on a condition variable until it has signs and content, so a
+	new setContent is shown right away and an idle sign costs no CPU.
+	'''
+
+	_contentLock = None			# use when changing the content
+	_contentChanged = None		# condition (on _contentLock) signalled when content or signs change
+	_content = None				# the text to display on the sign
+	_variables = None			# values for the {name}s in the content, or None
+	_cyclesDone = 0				# how many times we've finished showing the content
+	_cycleStarted = None		# when we started showing the content this time round
+	_writing = False			# true while we're writing to the signs
+	_holding = False			# true once hold() has asked us not to start another write
+	_pageEnds = None			# when the page up now is due to be replaced, while we wait for that
+	_resumeAt = None			# when to show the first page, carrying on after a restart
+	_stopped = False			# true once stop() has asked the thread to finish
+	
+	_signLock = None			# use when talking to the LED sign
+	_sign1 = None				# the LedSign object
+	_sign1Working = None
+
+	RETRY_POLL = 1				# secs between tries at content a sign didn't take (cheap while
+								# the port is backing off, see PortSupervisor)
+	HOLD_POLL = 0.05			# secs between checks that a hold has taken effect
+
+	def __init__(self, config=None):
+		Thread.__init__(self)
+		self.daemon = True			# don't keep the process alive once the main loop exits
+		self._config = config or SignConfig()
+		self._contentLock = Lock()
+		self._contentChanged = Condition(self._contentLock)
+		self._signLock = Lock()
+	
+	def _hasSigns(self):
+		'''
+		Helper to see if the signs have been instantiated
+		'''
+		hasSigns = False
+		with self._signLock:
+			if (self._sign1 != None):
+				hasSigns = True
+		return hasSigns
+
+	def _hasContent(self):
+		'''
+		Helper to see if we have content set - call with _contentLock held
+		'''
+		return self._content != None
+		
+	def run(self):
+		'''
+		Loop showing the content
+		'''
+		while True:
+			delay = self._resumeDelay()
+			if delay > 0:
+				time.sleep(delay)
+
+			# block until we have signs and content (no timeout, so this doesn't poll)
+			with self._contentLock:
+				if not self._canWrite():
+					idleStarted = time.time()
+					while not (self._canWrite() or self._stopped):
+						self._contentChanged.wait(self._idleWait())
+					self._idleOver(idleStarted)
+				if self._stopped:
+					return
+				self._writing = True
+
+			if not self._updateSign():
+				self._finishedCycle()
+			self._doneWriting()
+
+	def _canWrite(self):
+		'''
+		Helper to see if there's anything to write and we're allowed to - call with
+		_contentLock held
+		'''
+		return (not self._holding) and self._hasContent() and self._hasSigns()
+
+	def _idleWait(self):
+		'''
+		Helper to return how long to sleep with nothing to write before checking again (None
+		for until something changes) - call with _contentLock held
+		'''
+		return None
+
+	def _doneWriting(self, pageEnds=None):
+		'''
+		Helper to note that nothing is being written to the signs any more, and when the page
+		up now is due to be replaced (None if it isn't)
+		'''
+		with self._contentLock:
+			self._writing = False
+			self._pageEnds = pageEnds
+			self._contentChanged.notifyAll()
+
+	def _resumeDelay(self):
+		'''
+		Helper to return (once) how long to wait before the first page after a restart
+		'''
+		with self._contentLock:
+			resumeAt = self._resumeAt
+			self._resumeAt = None
+		if resumeAt == None:
+			return 0
+		return max(0, resumeAt - time.time())
+	
+	def _finishedCycle(self):
+		'''
+		Note that we've shown all the content once, and wake up anyone waiting on that
+		'''
+		with self._contentLock:
+			self._cyclesDone = self._cyclesDone + 1
+			now = time.time()
+			if self._cycleStarted != None:
+				metrics.observe('display.cycle', now - self._cycleStarted)
+			self._cycleStarted = now
+			self._contentChanged.notifyAll()
+
+	def _idleOver(self, idleStarted):
+		'''
+		Helper to record that we had nothing to show since idleStarted - call with _contentLock
+		held
+		'''
+		now = time.time()
+		metrics.observe('display.idle', now - idleStarted)
+		self._cycleStarted = now
+
+	def _updateSign(self):
+		'''
+		Send the content to the sign - override this for different sign configurations.
+		Returns True if there is more content to show, False once it has all been shown.
+		'''
+		content = ""
+		with self._contentLock:
+			content = self._content
+			variables = self._variables
+		
+		with self._signLock:
+			self._sign1Working = self._sign1.write(content,
+				self._transitionFor(self._rendered(content, variables)), variables=variables)
+			worked = self._sign1Working
+
+		if not worked:
+			# keep the content, so it goes up as soon as the sign is back
+			self._waitToRetry(content)
+			return True
+		self._contentShown(content)
+		return False
+
+	def _waitToRetry(self, content):
+		'''
+		Helper to wait RETRY_POLL secs before trying content again, unless new content comes
+		'''
+		with self._contentLock:
+			if (self._content is content) and not self._stopped:
+				self._contentChanged.wait(self.RETRY_POLL)
+
+	def _transitionFor(self, content):
+		'''
+		Helper to pick how the sign should transition to showing this content
+		'''
+		transition = LedSign.COMM_DISPLAY_MODE_ROLLLEFT
+		# if the content is multi-line that means we're on a two-line sign, so 
+		# use a rollup transition
+		if content.find(LedSign.COMM_TEXT_LINE_BREAK) != -1:
+			transition = LedSign.COMM_DISPLAY_MODE_ROLLUP		
+		return transition
+
+	def _rendered(self, text, variables):
+		'''
+		Helper to fill the variable values into text and translate it, to see how it will look
+		on the sign
+		'''
+		if variables:
+			for name in variables:
+				text = text.replace('{' + name + '}', variables[name])
+		return translator.translate(text)
+
+	def _contentShown(self, content):
+		'''
+		Helper to mark the content as shown, unless someone set newer content in the meantime
+		'''
+		with self._contentLock:
+			if self._content is content:
+				self._content = None
+
+	def setLedSigns(self, signList):
+		'''
+		Signs are actually created outside of this thread and passed in via this method
+		'''
+		self._assignSigns(signList)
+		self._notifyChanged()
+
+	def _assignSigns(self, signList):
+		'''
+		Helper to hang on to the signs we were given
+		'''
+		with self._signLock:
+			self._sign1 = signList[0]
+		self._sign1.setConfig(self._config)
+		
+	def setConfig(self, config):
+		'''
+		Public method to switch to new settings (a SignConfig), for us and our signs - they're
+		used from the next page on
+		'''
+		self._config = config
+		for sign in self._managedSigns():
+			sign.setConfig(config)
+
+	def _managedSigns(self):
+		with self._signLock:
+			if self._sign1 == None:
+				return []
+			return [self._sign1]
+
+	def _notifyChanged(self):
+		'''
+		Wake up the display thread
+		'''
+		with self._contentLock:
+			self._contentChanged.notifyAll()
+
+	def setContent(self, msgs, variables=None):
+		'''
+		Public method to set the content of the sign.  Any {name} in it with a value in
+		variables (a dict) is kept in a sign variable, so updates that only change the values
+		send just the values.
+		'''
+		with self._contentLock:
+			self._content = msgs
+			self._variables = variables
+			self._contentChanged.notifyAll()
+		
+	def clear(self):
+		'''
+		Public method to remove all the content from the sign
+		'''
+		with self._contentLock:
+			self._content = None	
+			self._contentChanged.notifyAll()
+	
+	def isSignOk(self):
+		'''
+		Was the last sign comms successful?
+		'''
+		lastStatus = None
+		with self._signLock:
+			lastStatus = self._sign1Working
+		return lastStatus
+
+	def getPortStats(self):
+		'''
+		Public method to return health for each sign, top one first (without taking _signLock,
+		which is held for the whole of a write)
+		'''
+		sign = self._sign1
+		if sign == None:
+			return []
+		return [self._portHealth(sign, self._sign1Working)]
+
+	def _portHealth(self, sign, working):
+		'''
+		Helper to return what the sign's PortSupervisor knows about its port, for getPortStats
+		'''
+		health = sign.getPortHealth()
+		return {'port': sign.getPortName(), 'device': health['path'],
+				'failuresInRow': health['failures'], 'retryIn': health['retryIn'],
+				'rebinds': health['rebinds'], 'working': working}
+		
+	def loopingContent(self):
+		'''
+		Override this to say if we are still showing the content
+		'''
+		return False
+
+	def hold(self):
+		'''
+		Public method to stop writing to the signs, for a restart - a write that's under way
+		is finished first, see isHeld.  Call release to start again.
+		'''
+		with self._contentLock:
+			self._holding = True
+			self._contentChanged.notifyAll()
+
+	def release(self):
+		'''
+		Public method to undo hold
+		'''
+		with self._contentLock:
+			self._holding = False
+			self._contentChanged.notifyAll()
+
+	def stop(self, timeout=None):
+		'''
+		Public method to finish the thread once a write that's under way is done, and wait up
+		to timeout secs for it, so it isn't left to run into interpreter exit
+		'''
+		with self._contentLock:
+			self._stopped = True
+			self._contentChanged.notifyAll()
+		if self.is_alive() and (current_thread() is not self):
+			self.join(timeout)
+
+	def isHeld(self):
+		'''
+		Public method to return if hold has taken effect: nothing is being written to any sign
+		'''
+		with self._contentLock:
+			if (not self._holding) or self._writing:
+				return False
+		return self._portsIdle()
+
+	def _portsIdle(self):
+		'''
+		Helper to see if the ports are done with everything we gave them - override this if
+		they write on their own
+		'''
+		return True
+
+	def waitForHold(self, timeout):
+		'''
+		Public method to block until isHeld, for up to timeout secs - returns isHeld()
+		'''
+		deadline = time.time() + timeout
+		while (not self.isHeld()) and (time.time() < deadline):
+			time.sleep(self.HOLD_POLL)
+		return self.isHeld()
+
+	def handoff(self):
+		'''
+		Public method to return where we are in the content (JSON-friendly), for a restarted
+		process to carry on from with resume
+		'''
+		return {}
+
+	def resume(self, msgs, variables, state):
+		'''
+		Public method to show the content we were showing before a restart, carrying on from
+		where handoff said we were
+		'''
+		self.setContent(msgs, variables)
+
+	def getCyclesDone(self):
+		'''
+		Public method to return how many times the content has been shown all the way through
+		'''
+		with self._contentLock:
+			return self._cyclesDone
+
+	def hasContent(self):
+		'''
+		Public method to say if there is any content set to show
+		'''
+		with self._contentLock:
+			return self._hasContent()
+
+	def waitForCycle(self, since, timeout=None):
+		'''
+		Public method to block until the content has been shown all the way through more than
+		`since` times.  Returns False without waiting for that if there is nothing to show, or
+		if timeout secs pass first.
+		'''
+		deadline = None
+		if timeout != None:
+			deadline = time.time() + timeout
+		with self._contentLock:
+			while self._cyclesDone <= since and self._hasContent():
+				if deadline == None:
+					self._contentChanged.wait()
+					continue
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					break
+				self._contentChanged.wait(remaining)
+			return self._cyclesDone > since
+
+class ScrollTimingModel:
+	'''
+	Predicts how long a sign takes to finish showing a line: the whole animation for its display
+	mode, at its speed, plus the pause.  It is a table keyed by (display mode, speed, pause) of
+	(fixed secs, secs per char), so the time for a line is fixed + secs per char * its length.
+	Use scripts/calibrate_timing.py to measure a sign and save a table for it (as JSON); until
+	then, scrolling modes take SECS_PER_CHAR per char at speed 2 (scaled for other speeds) and
+	a held line is up as soon as it's sent.
+	'''
+
+	SECS_PER_CHAR = 0.17		# scrolling at speed 2, the old fixed rate
+	DEFAULT_SPEED = '2'
+	HOLDING_MODES = [''.join(LedSign.COMM_DISPLAY_MODE_HOLD)]
+
+	def __init__(self, secsPerChar=SECS_PER_CHAR):
+		self._secsPerChar = secsPerChar	# default scrolling rate at DEFAULT_SPEED
+		self._table = {}				# (mode, speed, pause) -> (fixed secs, secs per char)
+
+	def _key(self, displayMode, speed, pause):
+		return (''.join(displayMode), ''.join(speed), ''.join(pause))
+
+	def entry(self, displayMode, speed, pause):
+		'''
+		Public method to return the (fixed secs, secs per char) for a mode, speed and pause -
+		calibrated if we have it, otherwise the default guess
+		'''
+		key = self._key(displayMode, speed, pause)
+		if key in self._table:
+			return self._table[key]
+		mode, speed, pause = key
+		if mode in self.HOLDING_MODES:
+			return (0.0, 0.0)
+		return (0.0, self._secsPerChar * int(speed) / int(self.DEFAULT_SPEED))
+
+	def isCalibrated(self, displayMode, speed, pause):
+		return self._key(displayMode, speed, pause) in self._table
+
+	def predict(self, displayMode, speed, pause, length):
+		'''
+		Public method to return how many secs the sign takes over a line of length chars
+		'''
+		fixed, perChar = self.entry(displayMode, speed, pause)
+		return fixed + perChar * length
+
+	def calibrate(self, displayMode, speed, pause, samples):
+		'''
+		Public method to fit the table entry for a mode, speed and pause to (length, secs)
+		samples with least squares, and return it
+		'''
+		count = float(len(samples))
+		meanLength = sum([length for length, secs in samples]) / count
+		meanSecs = sum([secs for length, secs in samples]) / count
+		spread = sum([(length - meanLength) ** 2 for length, secs in samples])
+		perChar = 0.0
+		if spread > 0:
+			perChar = sum([(length - meanLength) * (secs - meanSecs)
+						   for length, secs in samples]) / spread
+			perChar = max(0.0, perChar)
+		fixed = max(0.0, meanSecs - perChar * meanLength)
+		self._table[self._key(displayMode, speed, pause)] = (fixed, perChar)
+		return (fixed, perChar)
+
+	def load(self, path):
+		'''
+		Public method to read a table saved with save - returns False if there isn't one
+		'''
+		if not os.path.isfile(path):
+			return False
+		try:
+			f = open(path, 'r')
+			try:
+				entries = json.load(f)
+			finally:
+				f.close()
+			for entry in entries:
+				self._table[(str(entry['mode']), str(entry['speed']), str(entry['pause']))] = \
+					(float(entry['fixed']), float(entry['perChar']))
+		except (IOError, ValueError, KeyError, TypeError), e:
+			logging.warning("couldn't read timing table %s: %s" % (path, e))
+			return False
+		logging.info("Loaded %d scroll timings from %s" % (len(entries), path))
+		return True
+
+	def save(self, path):
+		'''
+		Public method to write the calibrated entries out as JSON
+		'''
+		entries = []
+		for key in sorted(self._table.keys()):
+			fixed, perChar = self._table[key]
+			entries.append({'mode': key[0], 'speed': key[1], 'pause': key[2], 'fixed': fixed,
+							'perChar': perChar})
+		f = open(path, 'w')
+		try:
+			json.dump(entries, f, indent=1)
+		finally:
+			f.close()
+
+
+class PageLayout:
+	'''
+	Fits content to the width of a 1-line sign, measuring text in columns with the widths of the
+	SS7 font's characters.  A page with a line too wide to hold can either scroll that line, or
+	be split at word boundaries into several pages that each hold; paginate picks whichever gets
+	through the content sooner, which is the one showing the most of it per minute.  Layouts are
+	cached by a digest of everything that went into them, so the same content costs nothing to
+	lay out again.
+	'''
+
+	SIGN_COLUMNS = 80			# our signs are 7x80 LEDs
+	CHAR_COLUMNS = 6			# most SS7 characters are 5 columns wide, plus 1 between them
+	# the ones that aren't, in columns including the space after
+	SS7_COLUMNS = dict([(c, 2) for c in "!'.:;,|"] + [(c, 4) for c in " I()[]`i"] +
+					   [(c, 5) for c in "fjlrt"] + [(c, 7) for c in "MWmw"])
+	CACHE_SIZE = 8				# layouts to remember
+
+	def __init__(self, columns=SIGN_COLUMNS):
+		self._columns = columns
+		self._cache = {}			# digest -> laid out lines
+		self._cacheOrder = []		# digests, oldest first
+
+	def width(self, text):
+		'''
+		Public method to return how many columns text takes up on the sign
+		'''
+		if len(text) == 0:
+			return 0
+		return sum([self.SS7_COLUMNS.get(c, self.CHAR_COLUMNS) for c in text]) - 1
+
+	def fits(self, text):
+		'''
+		Public method to say if text can be held on the sign without any of it being cut off
+		'''
+		return self.width(text) <= self._columns
+
+	def wrap(self, line, render):
+		'''
+		Public method to break a line into pieces that each fit, at spaces where it can.  Each
+		piece is measured as render(piece) (to fill in variables); a word too wide on its own is
+		broken wherever it has to be, unless it holds a variable.
+		'''
+		pieces = []
+		current = ''
+		for word in line.split(' '):
+			if len(word) == 0:
+				continue
+			candidate = word
+			if len(current) > 0:
+				candidate = current + ' ' + word
+			if self.fits(render(candidate)):
+				current = candidate
+				continue
+			if len(current) > 0:
+				pieces.append(current)
+			current = word
+			while (not self.fits(render(current))) and ('{' not in current) and \
+					(len(current) > 1):
+				cut = len(current) - 1
+				while (cut > 1) and (not self.fits(current[:cut])):
+					cut = cut - 1
+				pieces.append(current[:cut])
+				current = current[cut:]
+		if (len(current) > 0) or (len(pieces) == 0):
+			pieces.append(current)
+		return pieces
+
+	def paginate(self, lines, linesPerPage, render, duration, key):
+		'''
+		Public method to lay content out in pages of linesPerPage lines, returning the new lines.
+		The top line of a page always holds, so if it doesn't fit it is always split up; other
+		lines that don't fit either scroll or are split up, whichever makes the pages go by
+		faster according to duration(shown lines of a page).  render fills in the variables,
+		and key has to cover everything else render and duration depend on.
+		'''
+		digest = hashlib.md5(repr((lines, linesPerPage, key))).digest()
+		laidOut = self._cache.get(digest)
+		if laidOut != None:
+			metrics.count('display.layout_cache_hits')
+			return list(laidOut)
+		started = time.time()
+		laidOut = []
+		end = len(lines) - len(lines) % linesPerPage
+		for start in range(0, end, linesPerPage):
+			laidOut.extend(self._layoutPage(lines[start:start + linesPerPage], render, duration))
+		laidOut.extend(lines[end:])		# not a full page, so it won't be shown
+		metrics.observe('display.layout', time.time() - started)
+		self._cache[digest] = laidOut
+		self._cacheOrder.append(digest)
+		if len(self._cacheOrder) > self.CACHE_SIZE:
+			del self._cache[self._cacheOrder.pop(0)]
+		return list(laidOut)
+
+	def _layoutPage(self, page, render, duration):
+		'''
+		Helper to lay out one page, returning its lines (several pages worth if it was split)
+		'''
+		shown = [render(line) for line in page]
+		tooWide = [i for i in range(len(page)) if not self.fits(shown[i])]
+		if len(tooWide) == 0:
+			return page
+		# the top line has to be split, the others can scroll instead
+		scrolling = self._splitPages(page, [i for i in tooWide if i == 0], render)
+		holding = self._splitPages(page, tooWide, render)
+		if self._totalDuration(holding, render, duration) < \
+				self._totalDuration(scrolling, render, duration):
+			return [line for lines in holding for line in lines]
+		return [line for lines in scrolling for line in lines]
+
+	def _splitPages(self, page, split, render):
+		'''
+		Helper to turn a page into as many pages as it takes to show the lines in split a piece
+		at a time.  The other lines are repeated on each, and a line that runs out of pieces
+		stays on its last one.
+		'''
+		pieces = []
+		for i in range(len(page)):
+			if i in split:
+				pieces.append(self.wrap(page[i], render))
+			else:
+				pieces.append([page[i]])
+		count = max([len(linePieces) for linePieces in pieces])
+		return [[linePieces[min(j, len(linePieces) - 1)] for linePieces in pieces]
+				for j in range(count)]
+
+	def _totalDuration(self, pages, render, duration):
+		return sum([duration([render(line) for line in lines]) for lines in pages])
+
+
+class ReadyPage:
+	'''
+	A page worked out ahead of time: the lines for each sign, how each one transitions in, how
+	long it stays up, and (if it was encoded ahead) each sign's ReadyFrame
+	'''
+
+	def __init__(self, content, variables, lines, shownLines, transitions, duration, frames):
+		self.content = content		# the content list this page came from
+		self.variables = variables
+		self.lines = lines
+		self.shownLines = shownLines	# the lines with the variable values filled in
+		self.transitions = transitions
+		self.duration = duration	# secs to leave it up, from when the signs have it
+		self.frames = frames		# a ReadyFrame (or None) for each sign
+
+	def isFor(self, content, lines, variables):
+		return (self.content is content) and (self.variables is variables) and \
+			(self.lines == lines)
+
+
+class MultiSignManager(SignManager):
+	'''
+	This is a special case SignManager to handle a stack of 1-line led signs, each on its own
+	serial port, used to create a taller sign.  This is because a multi-line sign can't hold
+	one line fixed while scrolling another horizontally.  So annoying.  The content is split
+	into pages with a line for each sign, and each sign gets its own SignWriter thread so all
+	the lines of a page go out (and get acked) at the same time.  A sign that stops answering
+	is left out of pages until it finishes its last write, so it can't hold up the others.
+	While a page is up, the next few are worked out and encoded, so they go out the moment
+	it's done.
+	'''
+
+	MIN_DURATION = 5			# if the computed display time is less than this, don't respect it
+	SECS_PER_CHAR = ScrollTimingModel.SECS_PER_CHAR		# unless the config says otherwise
+	TIMING_FILE = "timing.json"	# the scroll timing table, from scripts/calibrate_timing.py
+	SYNC_TIMEOUT = 3			# longest we'll hold one sign back waiting for the others
+	PORT_TIMEOUT = 10			# longest we'll wait on one sign to take its line before going on
+	NO_PAGES = 'no pages'		# _nextPage result for content without a single full page
+	PIPELINE_PAGES = 2			# how many pages to have ready ahead of the one showing
+
+	_signs = None				# the LedSigns, top one first
+	_signsWorking = None		# if the last write to each sign worked
+	_writers = None				# a SignWriter for each sign
+	_pending = None				# the last SignWrite handed to each writer
+	_portStats = None			# write counts and timings for each sign
+	_linesPerPage = 0
+	_currContentIdx = 0
+	_loopingContent = False
+	_timing = None				# ScrollTimingModel, loaded the first time we need it
+	_readyPages = None			# ReadyPages for what's coming up, next one first
+	_sourceLines = None			# the content as it was set, before it was laid out into pages
+	_layout = None				# PageLayout fitting the content to the signs
+	_dwellEnded = None			# when the last page's time was up, to time the gap to the next
+
+	def _hasSigns(self):
+		'''
+		Overloaded helper to tell me if the signs have been assigned or not
+		'''
+		hasSigns = False
+		with self._signLock:
+			if (self._signs != None) and (len(self._signs) > 0):
+				hasSigns = True
+		return hasSigns
+
+	def _updateSign(self):
+		'''
+		Overloaded helper to actually write content to signs
+		'''
+		
+		# grab the next msgs to show, or loop back to beginning
+		page = self._nextPage()
+		if page == None:
+			return False
+		if page == self.NO_PAGES:
+			return True
+		content, lines = page
+		readyPage = self._readyPage(content, lines)
+
+		# show the content on all the signs at once
+		barrier = None
+		syncTimeout = self._syncTimeout()
+		if syncTimeout != None:
+			barrier = PageBarrier(len(lines), syncTimeout)
+		results = self._writeAll(
+			lambda i, writer: writer.write(lines[i], readyPage.transitions[i], barrier,
+										   readyPage.variables, readyPage.frames[i]),
+			self._portTimeout(syncTimeout), barrier, self._takeDwellEnd())
+		self._pageWritten(results)
+
+		# get the next pages ready, then leave this one up until the signs are done showing it
+		shownAt = self._pageShownAt(results)
+		self._prepareAhead()
+		remaining = self._remainingDuration(readyPage.duration, shownAt)
+		self._doneWriting(time.time() + remaining)
+		self._waitOutPage(content, remaining)
+
+		self._advancePage(content, shownAt)
+		return True
+
+	def _waitOutPage(self, content, secs):
+		'''
+		Helper to leave the page up for secs, or until setContent or clear replaces content
+		'''
+		deadline = time.time() + secs
+		with self._contentLock:
+			while (self._content is content) and (not self._stopped) and (time.time() < deadline):
+				self._contentChanged.wait(deadline - time.time())
+
+	def _writeAll(self, makeJob, timeout, barrier=None, dwellEnded=None):
+		'''
+		Helper to hand each sign a job at once, with makeJob(index, writer) returning the
+		SignWrite, and wait up to timeout secs for them.  Returns (worked, commitTime, elapsed)
+		for each sign, with elapsed None if it didn't finish in time.  If dwellEnded is given,
+		the time from then until the first sign started on its job is recorded as the gap
+		between pages.
+		'''
+		with self._signLock:
+			signs = list(self._signs)
+			writers = list(self._writers)
+		jobs = []
+		for i in range(len(signs)):
+			if (self._pending[i] != None) and (not self._pending[i].isDone()):
+				# this sign is still stuck on an earlier job, so go on without it
+				logging.warning("Sign %d is still busy, skipping it this page" % (i + 1))
+				if barrier != None:
+					barrier.leave(signs[i])
+				jobs.append(None)
+				continue
+			job = makeJob(i, writers[i])
+			self._pending[i] = job
+			jobs.append(job)
+		deadline = time.time() + timeout
+		results = []
+		for job in jobs:
+			if job != None:
+				job.wait(max(0, deadline - time.time()))
+			if (job == None) or (not job.isDone()):
+				results.append((False, None, None))
+			else:
+				results.append((job.result, job.commitTime, job.elapsed))
+		started = [job.started for job in jobs if (job != None) and (job.started != None)]
+		if len(started) > 0:
+			self._observeGap(dwellEnded, min(started))
+		return results
+
+	def _nextPage(self):
+		'''
+		Helper to grab the next (content, lines) to show.  Returns None at the end of the
+		content (and loops back to the beginning), or NO_PAGES if there isn't even one page to
+		show, in which case the content is dropped until something new is set.  Lines left
+		over after the last full page aren't shown.
+		'''
+		with self._contentLock:
+			content = self._content
+			start = self._currContentIdx * self._linesPerPage
+			if (start + self._linesPerPage) <= len(content):
+				self._loopingContent = True
+				return (content, content[start:start + self._linesPerPage])
+			self._loopingContent = False
+			if self._currContentIdx == 0:
+				# this isn't a finished cycle, so wake up waitForCycle to tell it so
+				self._content = None
+				self._contentChanged.notifyAll()
+				return self.NO_PAGES
+			self._currContentIdx = 0
+			return None
+
+	def _advancePage(self, content, shownAt=None):
+		'''
+		Helper to set up to show the next page (unless setContent started us over meanwhile),
+		noting how long the page was up if we know when it went up
+		'''
+		if shownAt != None:
+			metrics.observe('display.page_dwell', time.time() - shownAt)
+		with self._contentLock:
+			self._pageEnds = None
+			if self._content is content:
+				self._currContentIdx = self._currContentIdx + 1
+				self._dwellEnded = time.time()
+
+	def _takeDwellEnd(self):
+		'''
+		Helper to return (and forget) when the last page's time was up, None if new content
+		came in since
+		'''
+		with self._contentLock:
+			dwellEnded = self._dwellEnded
+			self._dwellEnded = None
+		return dwellEnded
+
+	def _observeGap(self, dwellEnded, sendStarted):
+		if dwellEnded != None:
+			metrics.observe('display.page_gap', sendStarted - dwellEnded)
+
+	def _pipelinePages(self):
+		'''
+		Helper to return how many pages to get ready ahead of time (0 for none)
+		'''
+		if self._config.pipelinePages != None:
+			return self._config.pipelinePages
+		return self.PIPELINE_PAGES
+
+	def _readyPage(self, content, lines):
+		'''
+		Helper to return the ReadyPage for these lines, the one we got ready during the last
+		page if it's still good, or else worked out now (leaving the encoding to the writers)
+		'''
+		with self._contentLock:
+			variables = self._variables
+			readyPages = self._readyPages or []
+			while len(readyPages) > 0:
+				readyPage = readyPages.pop(0)
+				if readyPage.isFor(content, lines, variables):
+					return readyPage
+		return self._preparePage(content, lines, variables, False)
+
+	def _preparePage(self, content, lines, variables, encode):
+		'''
+		Helper to work out a ReadyPage for lines, encoding each sign's frame if encode is set
+		'''
+		shownLines = [self._rendered(line, variables) for line in lines]
+		transitions = [self._lineTransition(i, shownLines[i]) for i in range(len(lines))]
+		frames = [None for line in lines]
+		if encode:
+			with self._signLock:
+				signs = list(self._signs)
+				pending = list(self._pending or [])
+			for i in range(min(len(lines), len(signs))):
+				if (i < len(pending)) and (pending[i] != None) and (not pending[i].isDone()):
+					continue	# it's still writing, leave it be
+				frames[i] = signs[i].encodeText(lines[i], transitions[i], variables=variables)
+		return ReadyPage(content, variables, lines, shownLines, transitions,
+						 self._pageDuration(shownLines), frames)
+
+	def _prepareAhead(self):
+		'''
+		Helper to get the pages after the one showing ready (up to _pipelinePages of them), so
+		the time between pages is just sending them
+		'''
+		depth = self._pipelinePages()
+		with self._contentLock:
+			content = self._content
+			variables = self._variables
+			linesPerPage = self._linesPerPage
+			index = self._currContentIdx
+			readyPages = [readyPage for readyPage in (self._readyPages or [])
+						  if (readyPage.content is content) and (readyPage.variables is variables)]
+		if (content == None) or (depth <= 0) or (linesPerPage == 0):
+			return
+		pageCount = len(content) / linesPerPage
+		for ahead in range(1, min(depth, pageCount) + 1):
+			start = ((index + ahead) % pageCount) * linesPerPage
+			lines = content[start:start + linesPerPage]
+			if len([page for page in readyPages if page.lines == lines]) == 0:
+				readyPages.append(self._preparePage(content, lines, variables, True))
+		with self._contentLock:
+			if (self._content is content) and (self._variables is variables):
+				self._readyPages = readyPages[-depth:]
+
+	def _lineTransition(self, index, line):
+		'''
+		Helper to pick the transition for a sign - the top one holds, the rest scroll only if
+		their line doesn't fit
+		'''
+		if (index == 0) or self._pageLayout().fits(line):
+			return LedSign.COMM_DISPLAY_MODE_HOLD
+		return LedSign.COMM_DISPLAY_MODE_ROLLLEFT
+
+	def _pageLayout(self):
+		'''
+		Helper to return the PageLayout for our signs, making it the first time
+		'''
+		if self._layout == None:
+			self._layout = PageLayout(self._config.signColumns or PageLayout.SIGN_COLUMNS)
+		return self._layout
+
+	def _laidOut(self, lines, variables):
+		'''
+		Helper to fit the lines of new content to the signs, splitting or scrolling the lines
+		that don't fit (see PageLayout)
+		'''
+		linesPerPage = self._linesPerPage
+		if (linesPerPage == 0) or (not self._hasSigns()):
+			return list(lines)
+		values = None
+		if variables:
+			values = sorted(variables.items())
+		config = self._config
+		key = (values, config.displaySpeed, config.pauseTime, config.minDisplaySecs,
+			   config.secsPerChar, config.timingFile, config.signColumns)
+		return self._pageLayout().paginate(lines, linesPerPage,
+										   lambda line: self._rendered(line, variables),
+										   self._pageDuration, key)
+
+	def _pageDuration(self, lines):
+		'''
+		Helper to figure out how many secs to leave a page up for: until the slowest sign is
+		done with its line, going by the timing model for the mode each line is shown with
+		'''
+		if min([len(line) for line in lines]) > 0:
+			config = self._config
+			minDisplaySecs = self.MIN_DURATION
+			if config.minDisplaySecs != None:
+				minDisplaySecs = config.minDisplaySecs
+			timing = self._timingModel()
+			longest = max([timing.predict(self._lineTransition(i, lines[i]), config.displaySpeed,
+										  config.pauseTime, len(lines[i]))
+						   for i in range(len(lines))])
+			return max(minDisplaySecs, longest)
+		return 1
+
+	def _remainingDuration(self, duration, shownAt):
+		'''
+		Helper to return how much longer a page that went up at shownAt should stay up
+		'''
+		return max(0, duration - (time.time() - shownAt))
+
+	def _pageShownAt(self, results):
+		'''
+		Helper to return when the last sign got the page (now if none of them were sent it)
+		'''
+		commitTimes = [commitTime for worked, commitTime, elapsed in results if commitTime != None]
+		if len(commitTimes) == 0:
+			return time.time()
+		return max(commitTimes)
+
+	def _timingModel(self):
+		'''
+		Helper to return the ScrollTimingModel, loading the calibrated table if there is one
+		'''
+		if self._timing == None:
+			config = self._config
+			secsPerChar = self.SECS_PER_CHAR
+			if config.secsPerChar != None:
+				secsPerChar = config.secsPerChar
+			timing = ScrollTimingModel(secsPerChar)
+			timing.load(config.timingFile or self.TIMING_FILE)
+			self._timing = timing
+		return self._timing
+
+	def _syncTimeout(self):
+		'''
+		Helper to return how long to hold one sign for the others, or None if we don't sync them
+		'''
+		config = self._config
+		if config.syncSigns:
+			syncTimeout = self.SYNC_TIMEOUT
+			if config.syncTimeoutSecs != None:
+				syncTimeout = config.syncTimeoutSecs
+			return syncTimeout
+		return None
+
+	def _portTimeout(self, syncTimeout):
+		'''
+		Helper to return how long to wait on the signs to take a page before giving up on them
+		'''
+		if syncTimeout == None:
+			return self.PORT_TIMEOUT
+		return self.PORT_TIMEOUT + syncTimeout
+
+	def _pageWritten(self, results):
+		'''
+		Helper to record the outcome of writing a page - results has (worked, commitTime,
+		elapsed) for each sign, with commitTime None if nothing was sent and elapsed None if the
+		sign didn't finish in time
+		'''
+		with self._signLock:
+			commitTimes = []
+			for i in range(len(results)):
+				worked, commitTime, elapsed = results[i]
+				self._signsWorking[i] = worked
+				stats = self._portStats[i]
+				stats['writes'] = stats['writes'] + 1
+				if not worked:
+					stats['failures'] = stats['failures'] + 1
+				if elapsed == None:
+					stats['timeouts'] = stats['timeouts'] + 1
+				else:
+					stats['lastWriteSecs'] = elapsed
+					stats['totalWriteSecs'] = stats['totalWriteSecs'] + elapsed
+				if commitTime != None:
+					commitTimes.append(commitTime)
+			if len(commitTimes) > 1:
+				# how far apart the first and last signs switched to the page
+				metrics.observe('display.skew', max(commitTimes) - min(commitTimes))
+
+	def setContent(self, msgs, variables=None):
+		'''
+		Overloaded public method to tell the signs what to show
+		'''
+		signMsgs = msgs.strip().replace('\n', LedSign.COMM_TEXT_LINE_BREAK)
+		lines = signMsgs.split(LedSign.COMM_TEXT_LINE_BREAK)
+		laidOut = self._laidOut(lines, variables)
+		with self._contentLock:
+			self._sourceLines = lines
+			self._content = laidOut
+			self._variables = variables
+			self._currContentIdx = 0
+			self._readyPages = None
+			self._dwellEnded = None
+			self._contentChanged.notifyAll()
+
+	def setLedSigns(self, signList):
+		'''
+		Overloaded pulbic method to set the LedSigns this thread manages
+		'''
+		self._assignSigns(signList)
+		with self._signLock:
+			self._writers = [SignWriter(sign) for sign in self._signs]
+			self._pending = [None for sign in self._signs]
+			for writer in self._writers:
+				writer.start()
+		self._notifyChanged()
+		
+	def _assignSigns(self, signList):
+		'''
+		Overloaded helper to hang on to all the signs, and start their stats over
+		'''
+		with self._signLock:
+			self._signs = list(signList)
+			self._signsWorking = [None for sign in signList]
+			self._portStats = [{'writes': 0, 'failures': 0, 'timeouts': 0, 'lastWriteSecs': None,
+								'totalWriteSecs': 0.0} for sign in signList]
+		for sign in signList:
+			sign.setConfig(self._config)
+		with self._contentLock:
+			self._linesPerPage = len(signList)
+			self._currContentIdx = 0
+			if (self._content != None) and (self._sourceLines != None):
+				# lay the content out again for this many signs
+				self._content = self._laidOut(self._sourceLines, self._variables)
+				self._readyPages = None
+
+	def setConfig(self, config):
+		'''
+		Overloaded public method to switch to new settings, laying the content out again if
+		they change how it fits or how long pages take
+		'''
+		old = self._config
+		SignManager.setConfig(self, config)
+		changes = config.changes(old)
+		if ('secsPerChar' in changes) or ('timingFile' in changes):
+			self._timing = None
+		if 'signColumns' in changes:
+			self._layout = None
+		if len([name for name in changes if name in ['displaySpeed', 'pauseTime', 'minDisplaySecs',
+				'secsPerChar', 'timingFile', 'signColumns', 'pipelinePages']]) > 0:
+			with self._contentLock:
+				if (self._content != None) and (self._sourceLines != None):
+					self._content = self._laidOut(self._sourceLines, self._variables)
+				self._readyPages = None
+
+	def _managedSigns(self):
+		with self._signLock:
+			return list(self._signs or [])
+
+	def _portsIdle(self):
+		'''
+		Overloaded helper to check that no SignWriter is still on a page we gave up waiting for
+		'''
+		return len([job for job in (self._pending or []) if (job != None) and
+					(not job.isDone())]) == 0
+
+	def handoff(self):
+		'''
+		Overloaded public method to say which page goes up next, and when
+		'''
+		with self._contentLock:
+			if self._pageEnds != None:
+				return {'page': self._currContentIdx + 1, 'at': self._pageEnds}
+			return {'page': self._currContentIdx, 'at': time.time()}
+
+	def resume(self, msgs, variables, state):
+		'''
+		Overloaded public method to carry on from the page after the one that was up, once its
+		time is up - the time until then counts towards the gap between pages
+		'''
+		with self._contentLock:
+			self._resumeAt = state.get('at')
+		self.setContent(msgs, variables)
+		with self._contentLock:
+			self._currContentIdx = state.get('page', 0)
+			self._dwellEnded = state.get('at')
+
+	def isSignOk(self):
+		'''
+		Overloaded public method to return if the serial comms are working
+		'''
+		lastStatus = None
+		with self._signLock:
+			lastStatus = self._signsWorking[0]
+			for working in self._signsWorking[1:]:
+				lastStatus = (lastStatus) and (working)
+		return lastStatus
+
+	def getPortStats(self):
+		'''
+		Overloaded public method to return health and timing for each sign, top one first
+		'''
+		portStats = []
+		with self._signLock:
+			if self._signs == None:
+				return portStats
+			for i in range(len(self._signs)):
+				stats = self._portStats[i]
+				mean = None
+				if stats['writes'] > stats['timeouts']:
+					mean = stats['totalWriteSecs'] / (stats['writes'] - stats['timeouts'])
+				port = self._portHealth(self._signs[i], self._signsWorking[i])
+				port.update({'writes': stats['writes'], 'failures': stats['failures'],
+							 'timeouts': stats['timeouts'], 'last': stats['lastWriteSecs'],
+							 'mean': mean})
+				portStats.append(port)
+		return portStats
+		
+	def loopingContent(self):
+		'''
+		Overloaded public method to indicate if this is still looping the last content set
+		'''
+		isLooping = None
+		with self._contentLock:
+			isLooping = self._loopingContent
+		return isLooping
+
+
+class TwoSignManager(MultiSignManager):
+	'''
+	The original setup: two 1-line led signs used to create a two-line sign.  This is just a
+	MultiSignManager that gets handed two signs.
+	'''
+
+
+class ResidentSignManager(MultiSignManager):
+	'''
+	A MultiSignManager that loads each page into its own text file on every sign and lets the
+	signs' firmware cycle through them, instead of writing each page on every cycle and
+	sleeping in between.  Only files that changed get sent, so once the content is loaded
+	there is no serial traffic until it changes.  The signs keep their own time, so every
+	line of a page is given the same length and transition to keep them in step.  Every
+	CHECK_INTERVAL secs the signs that can read back are asked what they still hold, and
+	whatever they lost (to a power cut, say) is loaded again.  Signs that can't read back get
+	everything loaded again once what we think they hold is too old (see LedSign.expireCache).
+	'''
+
+	UPLOAD_TIMEOUT_PER_FILE = 3		# how long we'll wait on a sign for each file it loads
+	CHECK_INTERVAL = 60				# secs between checks that the signs still hold the content
+
+	_loaded = None					# (content, variables) the signs last took, to check on
+	_checkAt = None					# when that check is due
+
+	def _updateSign(self):
+		'''
+		Overloaded helper to load all the pages onto the signs at once, or check they still have
+		them (and put back what they lost)
+		'''
+		content, variables, checking = self._takeContent()
+		pages = self._residentPages(content)
+		if len(pages) == 0:
+			# nothing to show isn't a finished cycle, so wake up waitForCycle to tell it so
+			with self._contentLock:
+				if self._content is content:
+					self._content = None
+				self._contentChanged.notifyAll()
+			return True
+
+		files = [self._residentFile(page, variables) for page in pages]
+		timeout = self.PORT_TIMEOUT + self.UPLOAD_TIMEOUT_PER_FILE * len(pages)
+		results = self._writeAll(
+			lambda i, writer: writer.writeFiles([pageFiles[i] for pageFiles in files], variables),
+			timeout)
+		self._pageWritten(results)
+		with self._contentLock:
+			self._loopingContent = True
+		if not self._allWorked(results):
+			# the signs that took it won't be sent anything again, so just retry the others
+			self._checkFailed(content, variables, checking)
+			self._waitToRetry(content)
+			return True
+		self._contentLoaded(content, variables)
+		return checking		# a check isn't another cycle
+
+	def _allWorked(self, results):
+		return len([worked for worked, commitTime, elapsed in results if not worked]) == 0
+
+	def _takeContent(self):
+		'''
+		Helper to return the (content, variables, checking) to load: the content that was set,
+		or if there isn't any and a check is due, what the signs last took (with checking True,
+		after marking the signs that can read back as needing a look)
+		'''
+		with self._contentLock:
+			content = self._content
+			variables = self._variables
+			checking = (content == None) and self._checkDue()
+			if checking:
+				content, variables = self._loaded
+				self._checkAt = None
+		if checking:
+			for sign in self._managedSigns():
+				if sign.canReadBack():
+					sign.suspect()
+		return (content, variables, checking)
+
+	def _checkDue(self):
+		'''
+		Helper to see if it's time to check the signs still hold the content - call with
+		_contentLock held
+		'''
+		return (self._checkAt != None) and (time.time() >= self._checkAt)
+
+	def _contentLoaded(self, content, variables):
+		'''
+		Helper to mark the content as shown, and when to check on it
+		'''
+		self._contentShown(content)
+		interval = self._checkInterval()
+		with self._contentLock:
+			if self._content == None:
+				self._loaded = (content, variables)
+				if interval != None:
+					self._checkAt = time.time() + interval
+
+	def _checkInterval(self):
+		'''
+		Helper to return how many secs until the signs should be checked on (None for never):
+		CHECK_INTERVAL for a sign that can read back, else when it stops trusting what we think
+		it holds, whichever sign comes first
+		'''
+		intervals = []
+		for sign in self._managedSigns():
+			if sign.canReadBack():
+				intervals.append(self.CHECK_INTERVAL)
+			elif sign.cacheMaxAge() != None:
+				intervals.append(sign.cacheMaxAge())
+		if len(intervals) == 0:
+			return None
+		return min(intervals)
+
+	def _checkFailed(self, content, variables, checking):
+		'''
+		Helper to keep retrying content a check found a sign wasn't showing, like new content
+		'''
+		if not checking:
+			return
+		with self._contentLock:
+			if self._content == None:
+				self._content = content
+				self._variables = variables
+
+	def _canWrite(self):
+		'''
+		Overloaded helper to also wake up when a check is due
+		'''
+		if MultiSignManager._canWrite(self):
+			return True
+		return (not self._holding) and self._checkDue() and self._hasSigns()
+
+	def _idleWait(self):
+		'''
+		Overloaded helper to sleep until the next check
+		'''
+		if (self._checkAt == None) or self._holding:
+			return None
+		return max(0, self._checkAt - time.time())
+
+	def _residentPages(self, content):
+		'''
+		Helper to split the content into pages, as many as the signs have text files for
+		'''
+		pages = []
+		for start in range(0, len(content) - self._linesPerPage + 1, self._linesPerPage):
+			pages.append(content[start:start + self._linesPerPage])
+		if len(pages) > len(LedSign.COMM_TEXT_FILE_NAMES):
+			logging.warning("Only showing the first %d of %d pages" %
+							(len(LedSign.COMM_TEXT_FILE_NAMES), len(pages)))
+			pages = pages[:len(LedSign.COMM_TEXT_FILE_NAMES)]
+		return pages
+
+	def _residentFile(self, page, variables=None):
+		'''
+		Helper to turn a page into the (text, displayMode) for each sign.  If any line needs to
+		scroll they all do, padded to the same length (with the variables filled in) so every
+		sign takes as long over the page.
+		'''
+		shownLines = [self._rendered(line, variables) for line in page]
+		if len([line for line in shownLines if not self._pageLayout().fits(line)]) == 0:
+			return [(line, LedSign.COMM_DISPLAY_MODE_HOLD) for line in page]
+		lengths = [len(line) for line in shownLines]
+		longest = max(lengths)
+		return [(page[i] + ' ' * (longest - lengths[i]), LedSign.COMM_DISPLAY_MODE_ROLLLEFT)
+				for i in range(len(page))]
+
+	def setContent(self, msgs, variables=None):
+		'''
+		Overloaded public method to tell the signs what to show
+		'''
+		MultiSignManager.setContent(self, msgs, variables)
+		with self._contentLock:
+			self._loopingContent = False
+			self._loaded = None
+			self._checkAt = None
+
+	def clear(self):
+		'''
+		Overloaded public method to stop checking on the content too
+		'''
+		with self._contentLock:
+			self._loaded = None
+			self._checkAt = None
+		MultiSignManager.clear(self)
+
+
+class LoopTimer:
+	'''
+	A callback scheduled on an EventLoop - call cancel() to stop it from running
+	'''
+
+	def __init__(self, when, fn, args):
+		self.when = when
+		self._fn = fn
+		self._args = args
+		self._cancelled = False
+
+	def cancel(self):
+		self._cancelled = True
+
+	def fire(self):
+		if not self._cancelled:
+			self._fn(*self._args)
+
+
+class EventLoop:
+	'''
+	A small single-threaded event loop for the async runtime: asyncore watches the serial ports
+	and server sockets, and a heap of timers handles everything that used to be a sleep.  When
+	there is nothing to do it blocks in select until the next timer is due.
+	'''
+
+	IDLE_WAIT = 60				# longest we'll block in one go if no timer is due
+
+	def __init__(self):
+		self._map = {}			# asyncore channels, by file descriptor
+		self._timers = []		# heap of (when, seq, LoopTimer)
+		self._seq = 0
+
+	def getMap(self):
+		'''
+		Public method to return the asyncore map dispatchers should register themselves in
+		'''
+		return self._map
+
+	def callLater(self, delay, fn, *args):
+		'''
+		Public method to run fn(*args) from the loop after delay secs - returns a LoopTimer
+		'''
+		timer = LoopTimer(time.time() + delay, fn, args)
+		self._seq = self._seq + 1
+		heapq.heappush(self._timers, (timer.when, self._seq, timer))
+		return timer
+
+	def runOnce(self):
+		'''
+		Run any timers that are due, then wait for I/O (or the next timer) once
+		'''
+		now = time.time()
+		while self._timers and self._timers[0][0] <= now:
+			timer = heapq.heappop(self._timers)[2]
+			timer.fire()
+		timeout = self.IDLE_WAIT
+		if self._timers:
+			timeout = max(0, min(timeout, self._timers[0][0] - time.time()))
+		if self._map:
+			asyncore.loop(timeout=timeout, map=self._map, count=1)
+		else:
+			time.sleep(timeout)
+
+	def run(self):
+		'''
+		Public method to run the loop forever
+		'''
+		while True:
+			self.runOnce()
+
+
+class AsyncSignPort(asyncore.file_dispatcher):
+	'''
+	Event-loop version of LedSign.write.  It sends frames through the sign's serial port with a
+	non-blocking file descriptor and waits for the EOT/SOH ack from the loop, so a slow ack never
+	holds up anything else.  The LedSign still owns the port, the frame cache and the working state.
+	'''
+
+	ACK_TIMEOUT = 1				# secs to wait for each ack byte, same as the serial port timeout
+
+	IDLE = 'idle'
+	SENDING = 'sending'			# writing the header and data
+	HOLDING = 'holding'			# data sent, waiting for release() to send the footer
+	COMMITTING = 'committing'	# writing the footer
+	ACKING = 'acking'			# waiting for the sign to answer
+	READING = 'reading'			# got the EOT for a read, collecting the rest of the answer
+
+	def __init__(self, loop, sign):
+		asyncore.dispatcher.__init__(self, map=loop.getMap())
+		self._loop = loop
+		self._sign = sign
+		self._state = self.IDLE
+		self._out = []			# chunks still to write, each one written separately
+		self._job = None
+		self._timer = None
+		self._expect = None		# the ack byte we're waiting for
+		self._reading = False	# if the frame is a read, so the sign answers with a frame
+		self._reply = None		# what the sign has answered a read with after its EOT
+		self._frame = None		# (header, data, footer) of the frame, for the trace
+		self._ackTimeout = self.ACK_TIMEOUT	# secs to wait for the sign to be done with this frame
+		self._commitTime = None
+		self._bound = False
+		self._bind()
+
+	def _bind(self):
+		'''
+		Helper to (re)attach to the sign's current serial port, if it has one open
+		'''
+		if self._bound:
+			self.close()
+			self._bound = False
+		serialPort = self._sign.getSerial()
+		if (serialPort == None) or (not self._sign.isWorking()):
+			return False
+		# asyncore closes the descriptor it is given, so give it a copy of the port's
+		fd = os.dup(serialPort.fileno())
+		self.set_file(fd)
+		if self.socket.fd != fd:
+			os.close(fd)
+		flags = fcntl.fcntl(self._fileno, fcntl.F_GETFL, 0)
+		fcntl.fcntl(self._fileno, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+		self.connected = True
+		self._bound = True
+		return True
+
+	def write(self, text, displayMode, callback, onReady=None,
+			  fileName=LedSign.COMM_TEXT_FILE_NAME_0, variables=None, ready=None):
+		'''
+		Public method to start sending text to the sign.  callback(acknowledged, commitTime) is
+		called from the loop once the sign answers (commitTime is None if nothing was sent).  If
+		onReady is given, the end of the frame is held back and onReady() is called once the
+		rest is out - call release() to finish the frame.  Any variable values the text needs
+		go out first, like LedSign.write, and ready is the frame from encodeText if there is one.
+		'''
+		if not self._canSend(callback):
+			return
+		def send():
+			started = time.time()
+			steps = self._sign.variableSteps([text], variables)
+			sentVariables = len(steps) > 0
+			def sendText():
+				frame = self._sign.prepareFrame(text, displayMode, fileName, variables, ready)
+				if frame == None:
+					if sentVariables:
+						self._sign.recordUpdate(time.time() - started)
+					self._loop.callLater(0, callback, True, None)
+					return
+				def written(acknowledged, commitTime):
+					self._sign.recordUpdate(time.time() - started)
+					callback(acknowledged, commitTime)
+				self._start(frame, written, onReady, self.ACK_TIMEOUT)
+			self._writeVariables(steps, callback, sendText)
+		self._verified(callback, send)
+
+	def _writeVariables(self, steps, callback, then):
+		'''
+		Helper to send each (sign variable, value) in steps in turn and then call then(), or
+		callback(False, commitTime) if the sign doesn't take one
+		'''
+		if len(steps) == 0:
+			then()
+			return
+		slot, value = steps.pop(0)
+		def written(acknowledged, commitTime):
+			if not acknowledged:
+				callback(False, commitTime)
+				return
+			self._sign.variableSent(slot, value)
+			self._writeVariables(steps, callback, then)
+		self._start(self._sign.prepareVariable(slot, value), written, None, self.ACK_TIMEOUT)
+
+	def writeCommand(self, command, data, callback):
+		'''
+		Public method, the event-loop version of LedSign.writeCommand
+		'''
+		if not self._canSend(callback):
+			return
+		self._start(self._sign.prepareCommand(command, data), callback, None,
+					LedSign.COMMAND_ACK_TIMEOUT)
+
+	def probe(self, callback):
 		'''
-		Overloaded helper to tell me if the signs have been assigned or not
+		Public method, the event-loop version of LedSign.probe: callback(answered, commitTime)
+		is called once the sign has answered, or didn't
 		'''
-		hasSigns = False
+		if not self._canSend(callback):
+			return
+		self._start(self._sign.prepareRead(), callback, None, LedSign.READ_TIMEOUT, True)
+
+	def _verified(self, callback, then):
+		'''
+		Helper to ask the sign what it still holds first if it may have lost some of it (see
+		LedSign.verify), then call then(), or callback(False, commitTime) if it doesn't answer
+		'''
+		self._sign.expireCache()
+		if not self._sign.isSuspect():
+			then()
+			return
+		def read(answered, commitTime):
+			if (not answered) and self._sign.canReadBack():
+				callback(False, commitTime)
+				return
+			then()
+		self.probe(read)
+
+	def writeFiles(self, files, callback, variables=None):
+		'''
+		Public method, the event-loop version of LedSign.writeFiles: callback(worked,
+		commitTime) is called once the sign has all the files, or one of them failed
+		'''
+		files = files[:len(LedSign.COMM_TEXT_FILE_NAMES)]
+		steps = []
+		lastCommit = []
+		def nextStep(worked, commitTime):
+			if commitTime != None:
+				lastCommit.append(commitTime)
+			commitTime = None
+			if len(lastCommit) > 0:
+				commitTime = lastCommit[-1]
+			if not worked:
+				callback(False, commitTime)
+				return
+			if len(steps) == 0:
+				self._sign.residentLoaded(len(files))
+				callback(True, commitTime)
+				return
+			step, args = steps.pop(0)
+			if step == LedSign.STEP_CLEAR:
+				self._sign.invalidateCache()
+				self.writeCommand(LedSign.COMM_CMD_WRITE_SPECIAL, LedSign.COMM_SPECIAL_CLEAR_ALL,
+								  nextStep)
+			elif step == LedSign.STEP_TEXT:
+				text, displayMode, fileName = args
+				self.write(text, displayMode, nextStep, fileName=fileName, variables=variables)
+			else:
+				self.writeCommand(LedSign.COMM_CMD_WRITE_SPECIAL,
+								  LedSign.COMM_SPECIAL_DISPLAY_MODE + LedSign.COMM_SHOW_ALL_FILES,
+								  nextStep)
+		def verified():
+			steps.extend(self._sign.residentSteps(files))
+			nextStep(True, None)
+		self._verified(callback, verified)
+
+	def _canSend(self, callback):
+		'''
+		Helper to check we can send a frame, calling back (from the loop) straight away if not
+		'''
+		if not self._sign.isWritingToSerial():
+			self._loop.callLater(0, callback, True, None)
+			return False
+
+		# try to re-open it if it wasn't working (unless we're backing off)
+		if (not self._sign.isWorking()) or (not self._bound):
+			if (not self._sign.ensureOpen()) or (not self._bind()):
+				self._loop.callLater(0, callback, False, None)
+				return False
+		return True
+
+	def _start(self, frame, callback, onReady, ackTimeout, reading=False):
+		'''
+		Helper to start sending a frame from LedSign.prepareFrame, prepareCommand or prepareRead
+		(with reading True)
+		'''
+		msgHeader, msgData, msgFooter, cacheKey, frameDigest = frame
+		self._job = (cacheKey, frameDigest, msgFooter, callback, onReady)
+		self._frame = (msgHeader, msgData, msgFooter)
+		self._ackTimeout = ackTimeout
+		self._commitTime = None
+		self._reading = reading
+		self._reply = None
+		# for some reason, these need to be sent separately, it fails if they go all at once
+		self._out = [msgHeader, msgData]
+		self._state = self.SENDING
+
+	def isBusy(self):
+		'''
+		Public method to say if we're still in the middle of a frame
+		'''
+		return self._state != self.IDLE
+
+	def release(self):
+		'''
+		Public method to send the held-back end of the frame
+		'''
+		if self._state == self.HOLDING:
+			self._out = [self._job[2]]
+			self._state = self.COMMITTING
+
+	def readable(self):
+		return True
+
+	def writable(self):
+		return len(self._out) > 0
+
+	def handle_write(self):
+		sent = self.send(self._out[0])
+		self._out[0] = self._out[0][sent:]
+		if len(self._out[0]) == 0:
+			self._out.pop(0)
+		if len(self._out) > 0:
+			return
+		if self._state == self.SENDING:
+			self._state = self.HOLDING
+			onReady = self._job[4]
+			if onReady == None:
+				self.release()
+			else:
+				onReady()
+		elif self._state == self.COMMITTING:
+			self._commitTime = time.time()
+			self._state = self.ACKING
+			self._expect = '\x04'
+			self._timer = self._loop.callLater(self.ACK_TIMEOUT, self._ackTimedOut)
+
+	def handle_read(self):
+		data = self.recv(64)
+		for c in data:
+			if self._state == self.READING:
+				self._reply += c
+				if self._sign.isReplyDone(self._reply):
+					self._finish(True)
+				continue
+			if self._state != self.ACKING:
+				continue	# nothing we asked for
+			if c != self._expect:
+				logging.warning("Got %s instead of %s in response!", str(ord(c)), str(ord(self._expect)))
+				self._finish(False)
+			elif c == '\x04':
+				self._timer.cancel()
+				if self._reading:
+					self._state = self.READING
+					self._reply = ''
+				else:
+					self._expect = '\x01'
+				self._timer = self._loop.callLater(self._ackTimeout, self._ackTimedOut)
+			else:
+				self._finish(True)
+
+	def _ackTimedOut(self):
+		if self._state == self.READING:
+			self._finish(True)		# it answered, with what we have
+			return
+		if self._expect == '\x04':
+			logging.warning("Didn't get EOT (0x04) in response!")
+		else:
+			logging.warning("Didn't get SOH (0x01) in response!")
+		self._finish(False)
+
+	def _finish(self, acknowledged):
+		'''
+		Helper to wrap up the current frame and tell whoever asked for it
+		'''
+		if self._timer != None:
+			self._timer.cancel()
+			self._timer = None
+		if self._job == None:
+			return
+		cacheKey, frameDigest, msgFooter, callback, onReady = self._job
+		self._job = None
+		self._out = []
+		self._state = self.IDLE
+		reply = None
+		if self._reading and acknowledged:
+			reply = self._reply
+		trace.frame(self._sign.getPortName(), self._frame, self._commitTime, acknowledged, reply)
+		if self._reading:
+			self._sign.statusRead(reply, self._commitTime)
+		else:
+			self._sign.frameSent(cacheKey, frameDigest, acknowledged, self._commitTime)
+		callback(acknowledged, self._commitTime)
+
+	def handle_error(self):
+		logging.warning("serial port error: %s", str(sys.exc_info()[1]))
+		if self._job != None:
+			self._finish(False)
+		self.close()
+
+	def handle_close(self):
+		self.handle_error()
+
+	def handle_expt(self):
+		self.handle_error()
+
+
+class AsyncHttpFetch(asyncore.dispatcher):
+	'''
+	A one-shot non-blocking HTTP GET, run from the EventLoop.  callback(status, headers, body)
+	is called with the response status, a dict of (lower-cased) headers and the body, or with
+	(None, None, None) if it failed or timed out.  The host name lookup still blocks, everything
+	after that doesn't.
+	'''
+
+	TIMEOUT = 30				# secs to give the server to answer
+
+	def __init__(self, loop, host, port, path, callback, headers={}, timeout=TIMEOUT):
+		asyncore.dispatcher.__init__(self, map=loop.getMap())
+		self._callback = callback
+		request = ["GET %s HTTP/1.0" % path, "Host: %s" % host]
+		for name, value in headers.items():
+			request.append("%s: %s" % (name, value))
+		self._request = '\r\n'.join(request) + '\r\n\r\n'
+		self._response = []
+		self._started = time.time()
+		self._requestSent = None
+		self._timer = loop.callLater(timeout, self._fail, "timed out")
+		self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+		try:
+			self.connect((host, int(port)))
+		except socket.error, e:
+			self._fail(str(e))
+
+	def handle_connect(self):
+		metrics.observe('fetch.connect', time.time() - self._started)
+
+	def writable(self):
+		return len(self._request) > 0
+
+	def handle_write(self):
+		sent = self.send(self._request)
+		self._request = self._request[sent:]
+		if len(self._request) == 0:
+			self._requestSent = time.time()
+
+	def handle_read(self):
+		if (len(self._response) == 0) and (self._requestSent != None):
+			# same as the blocking fetch: from sending the request to the start of the answer
+			metrics.observe('fetch.response', time.time() - self._requestSent)
+		self._response.append(self.recv(8192))
+
+	def handle_close(self):
+		head, sep, body = ''.join(self._response).partition('\r\n\r\n')
+		lines = head.split('\r\n')
+		statusLine = lines[0].split(' ')
+		if len(statusLine) < 2 or not statusLine[1].isdigit():
+			self._fail("got '%s' from server" % lines[0])
+			return
+		headers = {}
+		for line in lines[1:]:
+			name, sep, value = line.partition(':')
+			headers[name.strip().lower()] = value.strip()
+		metrics.count('fetch.bytes', len(body))
+		self._finish(int(statusLine[1]), headers, body)
+
+	def handle_error(self):
+		self._fail(str(sys.exc_info()[1]))
+
+	def _fail(self, error):
+		if self._callback == None:
+			return
+		metrics.count('fetch.errors')
+		logging.warning("couldn't fetch from server "+error)
+		self._finish(None, None, None)
+
+	def _finish(self, status, headers, body):
+		'''
+		Helper to close up and hand the result to the callback, only once
+		'''
+		if self._callback == None:
+			return
+		callback = self._callback
+		self._callback = None
+		self._timer.cancel()
+		self.close()
+		callback(status, headers, body)
+
+
+class AsyncSignManager(SignManager):
+	'''
+	Event-loop version of SignManager for the async runtime.  It is never started as a thread:
+	the EventLoop calls back into it as frames get acked and timers go off.
+	'''
+
+	def __init__(self, loop, config=None):
+		SignManager.__init__(self, config)
+		self._loop = loop
+		self._ports = []
+		self._busy = False			# true while we're showing something
+		self._idleSince = time.time()	# when we last stopped being busy
+		self._cycleWaiters = []		# (since, callback) pairs waiting on whenCycleDone
+
+	def setLedSigns(self, signList):
+		'''
+		Overloaded public method to attach the signs to the event loop
+		'''
+		self._assignSigns(signList)
+		self._ports = [AsyncSignPort(self._loop, sign) for sign in signList]
+		self._kick()
+
+	def setContent(self, msgs, variables=None):
+		'''
+		Overloaded public method to set the content and start showing it
+		'''
+		super(AsyncSignManager, self).setContent(msgs, variables)
+		self._kick()
+
+	def _kick(self):
+		'''
+		Helper to start showing the content, unless we're already busy showing something
+		'''
+		with self._contentLock:
+			canShow = self._canWrite()
+		if canShow and len(self._ports) > 0 and not self._busy:
+			self._busy = True
+			with self._contentLock:
+				self._idleOver(self._idleSince)
+			self._loop.callLater(self._resumeDelay(), self._showNext)
+
+	def _startWriting(self):
+		'''
+		Helper to note that we're about to write to the signs - returns False (and we mustn't)
+		if we're being held
+		'''
+		with self._contentLock:
+			if self._holding:
+				return False
+			self._writing = True
+			return True
+
+	def release(self):
+		'''
+		Overloaded public method to start showing things again
+		'''
+		SignManager.release(self)
+		self._kick()
+
+	def _portsIdle(self):
+		'''
+		Overloaded helper to check that no port is still working on a frame
+		'''
+		return len([port for port in self._ports if port.isBusy()]) == 0
+
+	def _goIdle(self):
+		'''
+		Helper to note that we're done showing things for now
+		'''
+		self._busy = False
+		self._idleSince = time.time()
+
+	def _retryLater(self):
+		'''
+		Helper to keep the content a sign didn't take and try it again in RETRY_POLL secs
+		'''
+		self._goIdle()
+		self._loop.callLater(self.RETRY_POLL, self._kick)
+
+	def _showNext(self):
+		'''
+		Send the content to the sign, like SignManager._updateSign but without waiting
+		'''
+		if not self._startWriting():
+			self._goIdle()
+			return
+		with self._contentLock:
+			content = self._content
+			variables = self._variables
+		if content == None:
+			self._doneWriting()
+			self._goIdle()
+			return
+		self._ports[0].write(content, self._transitionFor(self._rendered(content, variables)),
+							 lambda worked, commitTime: self._shown(content, worked),
+							 variables=variables)
+
+	def _shown(self, content, worked):
+		self._doneWriting()
 		with self._signLock:
-			if (self._sign1 != None) and (self._sign2 != None):
-				hasSigns = True
-		return hasSigns
+			self._sign1Working = worked
+		if not worked:
+			self._retryLater()
+			return
+		self._contentShown(content)
+		self._goIdle()
+		self._finishedCycle()
+		self._kick()
 
-	def _updateSign(self):
+	def _finishedCycle(self):
+		SignManager._finishedCycle(self)
+		self._checkCycleWaiters()
+
+	def whenCycleDone(self, since, callback):
 		'''
-		Overloaded helper to actually write content to signs
+		Public method, the event-loop version of waitForCycle: callback(True) is called once the
+		content has been shown all the way through more than `since` times, or callback(False)
+		if there is nothing to show
+		'''
+		self._cycleWaiters.append((since, callback))
+		self._checkCycleWaiters()
+
+	def _checkCycleWaiters(self):
+		'''
+		Helper to call back anyone in whenCycleDone who doesn't need to wait any more
 		'''
-		
-		# grab the next msgs to show, or loop back to beginning
-		skip = False
 		with self._contentLock:
-			line1 = ""
-			line2 = ""
-			if (self._currContentIdx*2 + 1) < len(self._content):
+			cyclesDone = self._cyclesDone
+			hasContent = self._hasContent()
+		stillWaiting = []
+		for since, callback in self._cycleWaiters:
+			if cyclesDone > since:
+				self._loop.callLater(0, callback, True)
+			elif not hasContent:
+				self._loop.callLater(0, callback, False)
+			else:
+				stillWaiting.append((since, callback))
+		self._cycleWaiters = stillWaiting
+
+
+class AsyncMultiSignManager(AsyncSignManager, MultiSignManager):
+	'''
+	Event-loop version of MultiSignManager: every line of a page goes out at once, and the page
+	dwell is a timer instead of a sleep
+	'''
+
+	def _showNext(self):
+		'''
+		Overloaded helper to write the next page to all the signs
+		'''
+		if not self._startWriting():
+			self._goIdle()
+			return
+		page = self._nextPage()
+		if page == None:
+			self._doneWriting()
+			self._goIdle()
+			self._finishedCycle()
+			self._kick()
+			return
+		if page == self.NO_PAGES:
+			self._doneWriting()
+			self._goIdle()
+			self._checkCycleWaiters()
+			return
+		content, lines = page
+		readyPage = self._readyPage(content, lines)
+		joining = self._idlePorts()
+
+		# if we're syncing, hold back the end of the frames until all the signs are ready
+		onReady = None
+		ready = []
+		syncTimeout = self._syncTimeout()
+		if syncTimeout != None:
+			def releaseAll():
+				for i in joining:
+					self._ports[i].release()
+			def portReady():
+				ready.append(True)
+				if len(ready) == len(joining):
+					syncTimer.cancel()
+					releaseAll()
+			syncTimer = self._loop.callLater(syncTimeout, releaseAll)
+			onReady = portReady
+
+		def startJob(i, port, callback):
+			def written(worked, commitTime):
+				if (onReady != None) and (commitTime == None) and (len(ready) < len(joining)):
+					onReady()	# a sign with nothing to send doesn't hold up the others
+				callback(worked, commitTime)
+			port.write(lines[i], readyPage.transitions[i], written, onReady,
+					   variables=readyPage.variables, ready=readyPage.frames[i])
+		def pageWritten(results):
+			self._pageWritten(results)
+			shownAt = self._pageShownAt(results)
+			remaining = self._remainingDuration(readyPage.duration, shownAt)
+			self._doneWriting(time.time() + remaining)
+			self._loop.callLater(remaining, self._pageDone, content, shownAt)
+			self._prepareAhead()
+		dwellEnded = self._takeDwellEnd()
+		self._observeGap(dwellEnded, time.time())
+		self._startAll(joining, startJob, self._portTimeout(syncTimeout), pageWritten)
+
+	def _idlePorts(self):
+		'''
+		Helper to list the ports that can take a new job - one still stuck on an earlier page
+		sits this one out
+		'''
+		joining = []
+		for i in range(len(self._ports)):
+			if self._ports[i].isBusy():
+				logging.warning("Sign %d is still busy, skipping it this page" % (i + 1))
+			else:
+				joining.append(i)
+		return joining
+
+	def _startAll(self, joining, startJob, timeout, done):
+		'''
+		Helper to start a job on each of the joining ports at once, with startJob(index, port,
+		callback), then call done(results) once they've all called back or timeout secs pass.
+		results has (worked, commitTime, elapsed) for each port, with elapsed None if it didn't
+		finish in time (or wasn't joining).
+		'''
+		results = [None for port in self._ports]
+		for i in range(len(self._ports)):
+			if i not in joining:
+				results[i] = (False, None, None)
+		finished = []
+		def allDone():
+			if len(finished) > 0:
+				return
+			finished.append(True)
+			timer.cancel()
+			for i in range(len(results)):
+				if results[i] == None:
+					results[i] = (False, None, None)	# didn't answer in time
+			done(results)
+		def jobDone(which, worked, commitTime):
+			if len(finished) > 0:
+				return
+			results[which] = (worked, commitTime, time.time() - started)
+			if None not in results:
+				allDone()
+
+		started = time.time()
+		timer = self._loop.callLater(timeout, allDone)
+		for i in joining:
+			startJob(i, self._ports[i],
+					 lambda worked, commitTime, i=i: jobDone(i, worked, commitTime))
+		if len(joining) == 0:
+			allDone()
+
+	def _pageDone(self, content, shownAt):
+		self._advancePage(content, shownAt)
+		self._showNext()
+
+
+class AsyncTwoSignManager(AsyncMultiSignManager):
+	'''
+	Event-loop version of TwoSignManager
+	'''
+
+
+class AsyncResidentSignManager(AsyncMultiSignManager, ResidentSignManager):
+	'''
+	Event-loop version of ResidentSignManager
+	'''
+
+	def _showNext(self):
+		'''
+		Overloaded helper to load all the pages onto the signs at once
+		'''
+		if not self._startWriting():
+			self._goIdle()
+			return
+		content, variables, checking = self._takeContent()
+		if content == None:
+			self._doneWriting()
+			self._goIdle()
+			return
+		pages = self._residentPages(content)
+		if len(pages) == 0:
+			with self._contentLock:
+				if self._content is content:
+					self._content = None
+			self._doneWriting()
+			self._goIdle()
+			self._checkCycleWaiters()
+			return
+
+		files = [self._residentFile(page, variables) for page in pages]
+		def startJob(i, port, callback):
+			port.writeFiles([pageFiles[i] for pageFiles in files], callback, variables)
+		def loaded(results):
+			self._doneWriting()
+			self._pageWritten(results)
+			with self._contentLock:
 				self._loopingContent = True
-				line1 = self._content[self._currContentIdx*2]
-				line2 = self._content[self._currContentIdx*2 + 1]
+			if not self._allWorked(results):
+				self._checkFailed(content, variables, checking)
+				self._retryLater()
+				return
+			self._contentLoaded(content, variables)
+			self._goIdle()
+			if not checking:
+				self._finishedCycle()
+			if self._checkAt != None:
+				self._loop.callLater(max(0, self._checkAt - time.time()), self._kick)
+			self._kick()
+		self._startAll(self._idlePorts(), startJob,
+					   self.PORT_TIMEOUT + self.UPLOAD_TIMEOUT_PER_FILE * len(pages), loaded)
+
+
+def inotifyWatch(directory, mask):
+	'''
+	Helper function to start a non-blocking inotify watch on a directory - returns the inotify
+	file descriptor, or None if we can't
+	'''
+	if ctypes == None:
+		return None
+	try:
+		libc = ctypes.CDLL(None)
+		fd = libc.inotify_init()
+	except (OSError, AttributeError):
+		return None
+	if fd < 0:
+		return None
+	if libc.inotify_add_watch(fd, directory, mask) < 0:
+		os.close(fd)
+		return None
+	flags = fcntl.fcntl(fd, fcntl.F_GETFL, 0)
+	fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+	logging.info("Watching %s for changes with inotify" % directory)
+	return fd
+
+
+class LocalContentSource:
+	'''
+	A content file on local disk (content.xml, maybe pushed out with rsync) that is only re-read
+	and re-parsed when it changes, judged by its inode, size and mtime.  Where the kernel has
+	inotify we watch the file's directory (rsync swaps in a new file rather than editing the old
+	one) so waitForChange can wake up as soon as it changes; otherwise it checks every
+	POLL_INTERVAL secs.
+	'''
+
+	POLL_INTERVAL = 1			# secs between checks of the file when we don't have inotify
+
+	# from <sys/inotify.h>
+	IN_MODIFY = 0x002
+	IN_ATTRIB = 0x004
+	IN_CLOSE_WRITE = 0x008
+	IN_MOVED_FROM = 0x040
+	IN_MOVED_TO = 0x080
+	IN_CREATE = 0x100
+	IN_DELETE = 0x200
+
+	def __init__(self, path, parse):
+		self._path = path
+		self._parse = parse		# called with the open file, returns what read() should
+		self._key = None		# (inode, size, mtime) of the file we last read
+		self._info = None		# what we got when we parsed it
+		self._inotify = self._watch()
+
+	def _watch(self):
+		'''
+		Helper to start an inotify watch on the file's directory - returns the inotify file
+		descriptor, or None if we can't
+		'''
+		mask = (self.IN_MODIFY | self.IN_ATTRIB | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM |
+				self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE)
+		return inotifyWatch(os.path.dirname(os.path.abspath(self._path)), mask)
+
+	def _stat(self):
+		try:
+			st = os.stat(self._path)
+		except OSError:
+			return None
+		return (st.st_ino, st.st_size, st.st_mtime)
+
+	def exists(self):
+		return os.path.isfile(self._path)
+
+	def hasChanged(self):
+		'''
+		Public method to say if the file looks different from when we last read it
+		'''
+		return self._stat() != self._key
+
+	def read(self):
+		'''
+		Public method to return the parsed content of the file, only parsing it again if it has
+		changed - None if it isn't there
+		'''
+		key = self._stat()
+		if key == None:
+			self._key = None
+			self._info = None
+		elif key != self._key:
+			f = open(self._path, 'r')
+			try:
+				self._info = self._parse(f)
+			finally:
+				f.close()
+			self._key = key
+		return self._info
+
+	def invalidate(self):
+		'''
+		Public method to make the next read() parse the file again
+		'''
+		self._key = None
+
+	def fileno(self):
+		'''
+		Public method to return the inotify file descriptor that becomes readable when the
+		directory changes, or None if we're polling instead
+		'''
+		return self._inotify
+
+	def handleEvents(self):
+		'''
+		Public method to throw away the inotify events waiting to be read - we only use them as a
+		hint to check the file again
+		'''
+		try:
+			while os.read(self._inotify, 4096):
+				pass
+		except OSError:
+			pass
+
+	def waitForChange(self, timeout):
+		'''
+		Public method to block until the file changes or timeout secs pass - returns True if it
+		changed
+		'''
+		deadline = time.time() + timeout
+		while not self.hasChanged():
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				return False
+			if self._inotify != None:
+				try:
+					ready = select.select([self._inotify], [], [], remaining)[0]
+				except select.error:
+					continue	# interrupted by a signal (eg. SIGHUP to reload the settings)
+				if ready:
+					self.handleEvents()
 			else:
-				self._loopingContent = False
-				self._currContentIdx = 0
-				skip = True
+				time.sleep(min(self.POLL_INTERVAL, remaining))
+		return True
 
-		if skip:
-			return False
-		
-		# show the content
-		with self._signLock:
-			self._sign1Working = self._sign1.write(line1, LedSign.COMM_DISPLAY_MODE_HOLD)
-			line2Transition = LedSign.COMM_DISPLAY_MODE_ROLLLEFT
-			if len(line2) <= self.MAX_CHARS_PER_LINE:
-				line2Transition = LedSign.COMM_DISPLAY_MODE_HOLD
-			self._sign2Working = self._sign2.write(line2, line2Transition)
 
+class LocalContentWatcher(asyncore.file_dispatcher):
+	'''
+	Event-loop hook for a LocalContentSource's inotify descriptor: calls callback() whenever
+	something happens in the file's directory
+	'''
+
+	def __init__(self, loop, source, callback):
+		asyncore.dispatcher.__init__(self, map=loop.getMap())
+		self._source = source
+		self._callback = callback
+		# asyncore closes the descriptor it is given, so give it a copy
+		fd = os.dup(source.fileno())
+		self.set_file(fd)
+		if self.socket.fd != fd:
+			os.close(fd)
+		self.connected = True
+
+	def readable(self):
+		return True
+
+	def writable(self):
+		return False
+
+	def handle_read(self):
+		self._source.handleEvents()
+		self._callback()
+
+
+class CountingReader:
+	'''
+	Wraps a file-like object (like an HTTP response) to count the bytes read from it
+	'''
+
+	def __init__(self, f):
+		self._f = f
+		self.bytesRead = 0
+
+	def read(self, *args):
+		data = self._f.read(*args)
+		self.bytesRead += len(data)
+		return data
+
+
+class DecompressingReader:
+	'''
+	Wraps a file-like object holding a gzip or deflate encoded HTTP body, to read it
+	decompressed a chunk at a time, so the parser can still work on it as it comes in
+	'''
+
+	CHUNK_SIZE = 16384
+
+	def __init__(self, f):
+		self._f = f
+		# 32 + MAX_WBITS takes either a gzip or a zlib header, which is what deflate should be
+		self._decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+		self._buffer = ''
+		self._eof = False
+
+	def read(self, size=-1):
+		while (not self._eof) and ((size < 0) or (len(self._buffer) < size)):
+			data = self._f.read(self.CHUNK_SIZE)
+			if data:
+				self._buffer += self._decompressor.decompress(data)
+			else:
+				self._buffer += self._decompressor.flush()
+				self._eof = True
+		if size < 0:
+			size = len(self._buffer)
+		data = self._buffer[:size]
+		self._buffer = self._buffer[size:]
+		return data
+
+
+class KeepingReader:
+	'''
+	Wraps a file-like object to keep a copy of what is read from it, up to limit bytes
+	'''
+
+	def __init__(self, f, limit):
+		self._f = f
+		self._limit = limit
+		self._kept = []
+		self._size = 0
+
+	def read(self, *args):
+		data = self._f.read(*args)
+		if self._kept != None:
+			self._size += len(data)
+			if self._size > self._limit:
+				self._kept = None
+			else:
+				self._kept.append(data)
+		return data
+
+	def kept(self):
+		'''
+		Public method to return everything read so far, or None if it went over the limit
+		'''
+		if self._kept == None:
+			return None
+		return ''.join(self._kept)
+
+
+class LongPoll:
+	'''
+	One long-poll request to the server, handed to a LongPollFetcher.  Call wait() to find out
+	when it has come back, then look at status, headers and body (status is None if it failed).
+	'''
+
+	def __init__(self, host, port, path, headers, timeout):
+		self.host = host
+		self.port = port
+		self.path = path
+		self.headers = headers
+		self.timeout = timeout		# secs to give the server, including the time it holds on
+		self.status = None
+		self.responseHeaders = None	# dict with lower-cased names
+		self.body = None
+		self.error = None			# why it failed, if it did
+		self.elapsed = None			# secs from sending it to the answer
+		self._started = time.time()
+		self._done = Event()
+
+	def finish(self, status, headers, body, error=None):
+		self.status = status
+		self.responseHeaders = headers
+		self.body = body
+		self.error = error
+		self.elapsed = time.time() - self._started
+		self._done.set()
+
+	def isDone(self):
+		return self._done.isSet()
+
+	def wait(self, timeout=None):
+		'''
+		Block until the server answered (or we gave up on it), or until timeout secs pass, and
+		return if it has finished
+		'''
+		self._done.wait(timeout)
+		return self._done.isSet()
+
+
+class LongPollFetcher(Thread):
+	'''
+	Sends the LongPolls for SignController.update from its own thread, on a keep-alive
+	connection, so the main loop can keep checking the settings and the local content file while
+	the server holds on to a request.
+	'''
+
+	def __init__(self):
+		Thread.__init__(self)
+		self.daemon = True
+		self._conn = None
+		self._queue = Queue.Queue()
+
+	def run(self):
+		while True:
+			poll = self._queue.get()
+			error = None
+			for attempt in range(2):
+				try:
+					status, headers, body = self._get(poll)
+					poll.finish(status, headers, body)
+					break
+				except Exception, e:
+					# the server may have just dropped our idle connection, so try a fresh one once
+					self._close()
+					error = str(e)
+			if not poll.isDone():
+				poll.finish(None, None, None, error)
+
+	def _get(self, poll):
+		if (self._conn != None) and ((self._conn.host, self._conn.port) !=
+									 (poll.host, int(poll.port))):
+			self._close()
+		if self._conn == None:
+			self._conn = httplib.HTTPConnection(poll.host, poll.port, timeout=poll.timeout)
+			self._conn.connect()
+		self._conn.sock.settimeout(poll.timeout)
+		self._conn.request("GET", poll.path, headers=poll.headers)
+		response = self._conn.getresponse()
+		body = response.read()
+		metrics.count('fetch.bytes', len(body))
+		if response.will_close:
+			self._close()
+		return (response.status, dict(response.getheaders()), body)
+
+	def _close(self):
+		if self._conn != None:
+			self._conn.close()
+			self._conn = None
+
+	def poll(self, host, port, path, headers, timeout):
+		'''
+		Public method to queue up a long-poll - returns a LongPoll to wait on
+		'''
+		poll = LongPoll(host, port, path, headers, timeout)
+		self._queue.put(poll)
+		return poll
+
+
+class ContentCache:
+	'''
+	The content we last got from the server, kept on disk so it can go back up straight away
+	at boot, before we've heard from the server.  Each <info> in it is an item that expires on
+	its own: after its ttl attribute (in secs) if it has one, else its <message>'s, else the
+	response's Cache-Control max-age, else defaultTtl.  An item that uses a {name} also goes
+	when that <variable> does.  Expiry counts from when the server last said the content was
+	current, so a 304 starts it over.  defaultTtl only runs out once a fetch has failed since
+	then, so a refresh interval (or multi-sign cycle) longer than it doesn't blank content the
+	server is still happy with.  The file is written whole and renamed over the old one, so a
+	power cut leaves one or the other.
+	'''
+
+	MIN_SAVE_INTERVAL = 300		# secs between rewrites of the file just to note a 304, to spare
+								# the flash it lives on
+
+	def __init__(self, path, defaultTtl):
+		self._path = path				# None to keep it in memory only
+		self._defaultTtl = defaultTtl
+		self._items = []				# [text, ttl] for each <info>, in order (ttl None for
+										# defaultTtl)
+		self._variables = {}			# name -> [value, ttl]
+		self._fetched = None			# when the server last said this was current
+		self._failed = False			# whether a fetch has failed since then
+		self._saved = None				# the fetched time in the file
+
+	def store(self, info, fetched):
+		'''
+		Public method to keep new content (the [info, actions, variables, expiry] we parsed)
+		that we got at time fetched
+		'''
+		expiry = info[3]
+		default = expiry.get('ttl')
+		items = [[text, self._orDefault(ttl, default)] for text, ttl in expiry['items']]
+		variables = dict([(name, [value, self._orDefault(expiry['variables'].get(name),
+														  default)])
+						  for name, value in info[2].items()])
+		changed = (items != self._items) or (variables != self._variables)
+		self._items = items
+		self._variables = variables
+		self._fetched = fetched
+		self._failed = False
+		# new content always goes to disk, so a reboot never brings back what it replaced
+		if changed:
+			self.save()
+		else:
+			self.revalidate(fetched)
+
+	def _orDefault(self, ttl, default):
+		if ttl == None:
+			return default
+		return ttl
+
+	def revalidate(self, fetched):
+		'''
+		Public method to note that the server said at time fetched that our content is current
+		'''
+		if self._fetched == None:
+			return
+		self._fetched = fetched
+		self._failed = False
+		if (self._saved == None) or (fetched - self._saved >= self.MIN_SAVE_INTERVAL):
+			self.save()
 
-		# delay for a while
-		if len(line1)>0 and len(line2)>0:
-			secsPerChar = self.SECS_PER_CHAR
-			if config.has_option('Communication', 'secs_per_char'):
-				secsPerChar = float(config.get('Communication', 'secs_per_char'))
-			minDisplaySecs = self.MIN_DURATION
-			if config.has_option('Communication', 'min_display_secs'):
-				minDisplaySecs = float(config.get('Communication', 'min_display_secs'))
-			sleepDuration = max(minDisplaySecs, (secsPerChar * len(line2)) )
-			time.sleep(sleepDuration)
-		else:
-			time.sleep(1)
+	def fetchFailed(self):
+		'''
+		Public method to note that we couldn't get content from the server
+		'''
+		self._failed = True
 
-		# set up to show the next line
-		self._currContentIdx = self._currContentIdx + 1
+	def save(self):
+		'''
+		Public method to write the content out - returns True if it worked
+		'''
+		if (self._path == None) or (self._fetched == None):
+			return False
+		tmpPath = self._path + '.tmp'
+		try:
+			f = open(tmpPath, 'w')
+			try:
+				json.dump(self.saveState(), f)
+				f.flush()
+				os.fsync(f.fileno())
+			finally:
+				f.close()
+			os.rename(tmpPath, self._path)
+		except (IOError, OSError), e:
+			logging.warning("couldn't save the content to %s: %s" % (self._path, e))
+			return False
+		self._saved = self._fetched
 		return True
 
-	def setContent(self, msgs):
+	def load(self, now):
 		'''
-		Overloaded public method to tell the signs what to show
+		Public method to read the content back from the file - returns False if there isn't
+		any we can use
 		'''
-		with self._contentLock:
-			signMsgs = msgs.strip().replace('\n', LedSign.COMM_TEXT_LINE_BREAK)
-			self._content = signMsgs.split(LedSign.COMM_TEXT_LINE_BREAK)
-			self._currContentIdx = 0
+		if self._path == None:
+			return False
+		try:
+			f = open(self._path)
+			try:
+				state = json.load(f)
+			finally:
+				f.close()
+		except IOError:
+			return False
+		except ValueError, e:
+			logging.warning("couldn't read the content saved in %s: %s" % (self._path, e))
+			return False
+		# we haven't heard from the server since, so it's as good as a failed fetch
+		state['failed'] = True
+		return self.loadState(state, now)
 
-	def setLedSigns(self, signList):
+	def saveState(self):
 		'''
-		Overloaded pulbic method to set the LedSigns this thread manages
+		Public method to return the content as something json can write out
 		'''
-		with self._signLock:
-			self._sign1 = signList[0]
-			self._sign2 = signList[1]
-		
-	def isSignOk(self):
+		return {'fetched': self._fetched, 'failed': self._failed, 'items': self._items,
+				'variables': self._variables}
+
+	def loadState(self, state, now):
 		'''
-		Overloaded public method to return if the serial comms are working
+		Public method to take back content saveState returned - returns False if we can't use it
 		'''
-		lastStatus = None
-		with self._signLock:
-			lastStatus = (self._sign1Working) and (self._sign2Working)
-		return lastStatus
-		
-	def loopingContent(self):
+		if state.get('fetched') == None:
+			return False
+		try:
+			fetched = float(state['fetched'])
+			items = [[text, self._ttl(ttl)] for text, ttl in state['items']]
+			variables = dict([(name, [value, self._ttl(ttl)])
+							  for name, (value, ttl) in state['variables'].items()])
+		except (ValueError, KeyError, TypeError), e:
+			logging.warning("couldn't use the saved content: %s" % e)
+			return False
+		self._items = items
+		self._variables = variables
+		self._failed = state.get('failed', True)
+		self._saved = fetched
+		# with our clock behind the one that saved it (not set yet after a boot?) we can't tell
+		# how old it is, so count from now
+		self._fetched = min(fetched, now)
+		return True
+
+	def _ttl(self, ttl):
+		if ttl == None:
+			return None
+		return float(ttl)
+
+	def _expired(self, ttl, age):
+		if ttl == None:
+			return self._failed and (age >= self._defaultTtl)
+		return age >= ttl
+
+	def current(self, now):
 		'''
-		Overloaded public method to indicate if this is still looping the last content set
+		Public method to return the (message, variables) to show, from the items that haven't
+		expired yet - None if they all have (or we have nothing)
 		'''
-		isLooping = None
-		with self._contentLock:
-			isLooping = self._loopingContent
-		return isLooping
+		if self._fetched == None:
+			return None
+		age = now - self._fetched
+		variables = dict([(name, value) for name, (value, ttl) in self._variables.items()
+						  if not self._expired(ttl, age)])
+		expired = ['{' + name + '}' for name in self._variables if name not in variables]
+		texts = []
+		for text, ttl in self._items:
+			if (not self._expired(ttl, age)) and (len([ref for ref in expired if ref in text]) == 0):
+				texts.append(text)
+		if len(texts) == 0:
+			return None
+		return ("".join(texts), variables)
+
 
 class SignController:
 	'''
@@ -515,76 +4647,377 @@ class SignController:
 	STATUS_UNHEARD_FROM = 6
 	STATUS_VERSION_MISMATCH = 7		# version of protocol rx from server is not same as here in code
 
-	OFFLINE_THRESHOLD_SECS = 300	# after this long of not hearing from the server the sign switches to offline mode
+	OFFLINE_THRESHOLD_SECS = 300	# how long content is shown without hearing from the server, unless it says
+									# otherwise (see ContentCache)
+
+	RUNTIME_THREADED = 'threaded'	# update() loop in the main thread, a thread per sign manager
+	RUNTIME_ASYNC = 'async'			# everything in one event loop, see runAsync
 
 	config = None
 	_signMgr = None
 	_status = None
-	_serial_port1 = None
-	_serial_port2 = None
+	_serial_ports = None			# paths of the serial ports, top sign first
 	_write_to_serial = True
+	_runtime = RUNTIME_THREADED
+	_residentPages = False			# load pages into the signs' own text files, see ResidentSignManager
+	_loop = None
+	_conn = None					# keep-alive connection to the server
+	_etag = None					# validators from the content we're showing, for conditional GETs
+	_last_modified = None
+	_deltaBase = None				# (etag, body) of the last full response, to apply deltas to
+	_localContent = None			# LocalContentSource for LOCAL_CONTENT_PATH
+	_contentCache = None			# ContentCache with the content we're showing, and when it expires
+	_pushFetcher = None				# LongPollFetcher for the threaded runtime, started on first use
+	_pushPoll = None				# the long-poll out at the server (LongPoll, or AsyncHttpFetch)
+	_pushFailures = 0				# long-polls in a row that failed, see _push_failed
+	_pushRetryAt = 0				# when to try long-polling again after a failure
+	_refreshSeq = 0					# bumped on every async refresh, so stale callbacks can tell
+	_statusFile = STATUS_FILE		# where to write the metrics after each refresh (None for nowhere)
+	_configWatcher = None			# ConfigWatcher telling us when to reload the settings
+	_signs = None					# the LedSigns, top one first
+	_shownMessage = None			# the (message, variables) we last gave the signs
+	_handedOver = None				# the (message, variables) we carried on with after a restart
+	_restartRequested = None		# when we were asked to restart (None if we weren't)
+	_restartSignalled = False		# set by the SIGUSR1 handler, see checkRestart
 
 	ACTION_RESTART = 'restart'
 
+	NOT_MODIFIED = 'not modified'	# fetch result when the server says our content is still current
+	DELTA_FAILED = 'delta failed'	# fetch result when a delta didn't give what the server meant
+	DELTA_FORMAT = 'lines'			# the delta we ask for with A-IM, see _patch
+	DELTA_BASE_MAX_BYTES = 262144	# biggest response we keep to apply deltas to
+
 	REFRESH_INTERVAL = 30
+	PUSH_WAIT_SECS = 60				# how long the server may hold a long-poll before answering 304
+	PUSH_RETRY_SECS = 5				# wait after a long-poll fails, doubled each time it fails again
+	PUSH_MAX_RETRY_SECS = 300
+	DRAIN_TIMEOUT = 15				# longest we'll wait for the signs to take a page before restarting
+	SERVER_TIMEOUT = 30				# secs to wait on the server before giving up on a fetch
+	READ_CHUNK_SIZE = 16384			# bytes to read at a time when throwing away the rest of a response
+	LOCAL_CONTENT_PATH = "content.xml"	# shown instead of what the server says, if it is there
 
-	def __init__(self, config):
+	def __init__(self, config, configPath=None):
+		'''
+		config is the SignConfig to start with.  If configPath is given, the settings are read
+		from there again on a SIGHUP or when the file changes.
+		'''
 		self.config = config
 		self._status = self.STATUS_BOOTING
-		self._last_success = time.time()
-		if self.config.has_option('Communication', 'write_to_serial'):
-			self._write_to_serial = int(self.config.get('Communication', 'write_to_serial'))
-		if self.config.has_option('Server', 'refresh_interval'):
-			self.REFRESH_INTERVAL = int(self.config.get('Server', 'refresh_interval'))
+		self._write_to_serial = config.writeToSerial
+		self._runtime = config.runtime
+		self._residentPages = config.residentPages
+		self._useConfig(config)
+		if configPath != None:
+			self._configWatcher = ConfigWatcher(configPath)
+		try:
+			signal.signal(signal.SIGUSR1, self._restartSignal)
+			signal.siginterrupt(signal.SIGUSR1, False)
+		except (ValueError, AttributeError):
+			pass
+		#self.LOCAL_CONTENT_PATH = "/opt/usr/lib/Realtime-Community-Sign/content.xml"
+		self._localContent = LocalContentSource(self.LOCAL_CONTENT_PATH, self._parse_server_response)
+		cachePath = CONTENT_CACHE_FILE
+		if config.contentCacheFile != None:
+			cachePath = config.contentCacheFile or None
+		self._contentCache = ContentCache(cachePath, self.OFFLINE_THRESHOLD_SECS)
 		# open serial ports
 		signs = self._openSigns()
-		if self.config.has_option('Communication', 'serial_path_2'):
-			self._signMgr = TwoSignManager()
+		if self.isAsync():
+			self._loop = EventLoop()
+			if len(signs) > 1 and self._residentPages:
+				self._signMgr = AsyncResidentSignManager(self._loop, config)
+			elif len(signs) > 1:
+				self._signMgr = AsyncMultiSignManager(self._loop, config)
+			else:
+				self._signMgr = AsyncSignManager(self._loop, config)
+			self._signMgr.setLedSigns( signs )
 		else:
-			self._signMgr = SignManager()
-		self._signMgr.setLedSigns( signs )
-		self._signMgr.start()
+			if len(signs) > 1 and self._residentPages:
+				self._signMgr = ResidentSignManager(config)
+			elif len(signs) > 1:
+				self._signMgr = MultiSignManager(config)
+			else:
+				self._signMgr = SignManager(config)
+			self._signMgr.setLedSigns( signs )
+		# if we were restarted, carry on showing what the old process was, else put the last
+		# content we got back up while we wait to hear from the server
+		self._takeHandoff()
+		if self._handedOver == None:
+			self._show_cached_content()
+		if not self.isAsync():
+			self._signMgr.start()
 				
+	def _useConfig(self, config):
+		'''
+		Helper to pick up the settings we keep copies of
+		'''
+		self.REFRESH_INTERVAL = config.refreshInterval or SignController.REFRESH_INTERVAL
+		self.PUSH_WAIT_SECS = config.pushWaitSecs or SignController.PUSH_WAIT_SECS
+		self._statusFile = STATUS_FILE
+		if config.statusFile != None:
+			self._statusFile = config.statusFile or None
+		trace.open(config.traceFile or None, config.serialPaths)
+
+	def setConfig(self, config):
+		'''
+		Public method to switch to new settings (a SignConfig) while running.  They're used from
+		the next page and the next fetch on, without reopening the serial ports; changing the
+		ports themselves, write_to_serial, runtime or resident_pages needs a restart.
+		'''
+		changes = config.changes(self.config)
+		if len(changes) == 0:
+			return
+		logging.info("Loaded new settings: %s" % ', '.join(changes))
+		needRestart = [name for name in changes if name in SignConfig.RESTART_SETTINGS]
+		if len(needRestart) > 0:
+			logging.warning("Restart to use the new %s" % ', '.join(needRestart))
+		self.config = config
+		self._useConfig(config)
+		if ('serverHost' in changes) or ('serverPort' in changes):
+			self._close_connection()
+		self._signMgr.setConfig(config)
+
+	def checkConfig(self):
+		'''
+		Public method to reload the settings if we got a SIGHUP or the file changed
+		'''
+		if self._configWatcher != None:
+			config = self._configWatcher.check()
+			if config != None:
+				self.setConfig(config)
+
+	def _restartSignal(self, signum, frame):
+		self._restartSignalled = True
+
+	def checkRestart(self):
+		'''
+		Public method to ask for a restart if we got a SIGUSR1 (the handler only sets a flag,
+		since it can go off with our locks held)
+		'''
+		if self._restartSignalled:
+			self._restartSignalled = False
+			self.requestRestart()
+
+	def requestRestart(self):
+		'''
+		Public method to restart the client (to pick up new code) as soon as the page going out
+		to the signs is done.  With the async runtime that happens from the event loop, otherwise
+		the main loop calls restart.
+		'''
+		if self._restartRequested != None:
+			return
+		logging.info("Restart requested")
+		self._restartRequested = time.time()
+		self._signMgr.hold()
+		if self.isAsync():
+			self._loop.callLater(0, self._async_restart, self._restartRequested + self.DRAIN_TIMEOUT)
+
+	def restartRequested(self):
+		return self._restartRequested != None
+
+	def restart(self):
+		'''
+		Public method to replace this process with a fresh copy of the client without the signs
+		missing a page: once the page being written is done, leave what we're showing (and
+		where we are in it), the fetch validators and the open serial ports to the new process,
+		and exec it.  It only returns if that fails.
+		'''
+		if not self._signMgr.waitForHold(self.DRAIN_TIMEOUT):
+			logging.warning("Signs still busy after %d secs, restarting anyway" % self.DRAIN_TIMEOUT)
+		self._exec()
+
+	def _async_restart(self, deadline):
+		'''
+		Event-loop version of restart: check back until the signs are done with their page
+		'''
+		if (not self._signMgr.isHeld()) and (time.time() < deadline):
+			self._loop.callLater(SignManager.HOLD_POLL, self._async_restart, deadline)
+			return
+		if not self._signMgr.isHeld():
+			logging.warning("Signs still busy after %d secs, restarting anyway" % self.DRAIN_TIMEOUT)
+		self._exec()
+
+	def _exec(self):
+		'''
+		Helper to write the handoff and exec ourselves - if we can't, we carry on as we were
+		'''
+		env = dict(os.environ)
+		env.pop(HANDOFF_ENV, None)
+		keep = []
+		if self._writeHandoff(HANDOFF_FILE):
+			env[HANDOFF_ENV] = HANDOFF_FILE
+			keep = [sign.getSerial().fileno() for sign in self._signs if sign.getSerial() != None]
+		self._closeOnExec(keep)
+		logging.info("Restarting, %.2f secs after it was asked for" %
+					 (time.time() - self._restartRequested))
+		trace.close()		# the new process carries on with it
+		try:
+			os.execve(sys.executable, [sys.executable] + sys.argv, env)
+		except OSError, e:
+			logging.error("Couldn't restart: %s" % e)
+			self._useConfig(self.config)
+			self._restartRequested = None
+			self._signMgr.release()
+
+	def _writeHandoff(self, path):
+		'''
+		Helper to write out what the new process needs to carry on where we stop - returns False
+		if we couldn't
+		'''
+		state = {'requested': self._restartRequested, 'exec': time.time(), 'status': self._status,
+				 'etag': self._etag, 'lastModified': self._last_modified,
+				 'content': self._shownMessage, 'cache': self._contentCache.saveState(),
+				 'manager': self._signMgr.handoff(),
+				 'signs': [sign.saveState() for sign in self._signs]}
+		try:
+			f = open(path, 'w')
+			try:
+				json.dump(state, f)
+			finally:
+				f.close()
+		except (IOError, OSError, TypeError, ValueError), e:
+			logging.error("Couldn't write %s, restarting from scratch: %s" % (path, e))
+			return False
+		return True
+
+	def _closeOnExec(self, keep):
+		'''
+		Helper to have every file descriptor but the ones in keep closed by exec, so restarts
+		don't pile up sockets and pipes in the new process
+		'''
+		try:
+			fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+		except OSError:
+			fds = range(3, 256)
+		for fd in fds:
+			if fd <= 2:
+				continue
+			try:
+				flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+				if fd in keep:
+					flags = flags & ~fcntl.FD_CLOEXEC
+				else:
+					flags = flags | fcntl.FD_CLOEXEC
+				fcntl.fcntl(fd, fcntl.F_SETFD, flags)
+			except (IOError, OSError):
+				pass
+
+	def _takeHandoff(self):
+		'''
+		Helper to pick up where the process we were restarted from left off, if we were
+		'''
+		path = os.environ.pop(HANDOFF_ENV, None)
+		if path == None:
+			return
+		try:
+			f = open(path)
+			try:
+				state = json.load(f)
+			finally:
+				f.close()
+			os.remove(path)
+		except (IOError, OSError, ValueError), e:
+			logging.error("Couldn't read %s, starting from scratch: %s" % (path, e))
+			return
+		signStates = state.get('signs', [])
+		for i in range(len(signStates)):
+			if (i < len(self._signs)) and (signStates[i].get('port') == self._signs[i].getPortName()):
+				self._signs[i].loadState(signStates[i])
+			elif signStates[i].get('fd') != None:
+				try:
+					os.close(signStates[i]['fd'])	# a port we don't use any more
+				except OSError:
+					pass
+		self._status = state.get('status', self._status)
+		if state.get('cache') != None:
+			self._contentCache.loadState(state['cache'], time.time())
+		self._etag = state.get('etag')
+		self._last_modified = state.get('lastModified')
+		if state.get('content') != None:
+			message, variables = state['content']
+			self._shownMessage = self._handedOver = (message, variables)
+			self._signMgr.resume(message, variables, state.get('manager', {}))
+		if state.get('exec') != None:
+			metrics.observe('restart.duration', time.time() - state['exec'])
+			if state.get('requested') != None:
+				metrics.observe('restart.drain', state['exec'] - state['requested'])
+			logging.info("Restarted in %.2f secs" % (time.time() - state['exec']))
+
+	def _show_cached_content(self):
+		'''
+		Put the content we saved last time back up, if it hasn't expired
+		'''
+		if not self._contentCache.load(time.time()):
+			return
+		current = self._contentCache.current(time.time())
+		if current != None:
+			logging.info("Showing the saved content until we hear from the server")
+			self._write_to_display(current[0], current[1])
+
 	def refreshContentAfterOneCycle(self):
-		return self.config.has_option('Communication', 'serial_path_2')
+		# with resident pages the signs do the cycling, so we just refresh on the usual interval
+		return len(self._serial_ports) > 1 and not self._residentPages
 
 	def stillCyclingContent(self):
 		return self._signMgr.loopingContent()
-	
+
+	def getContentCycles(self):
+		return self._signMgr.getCyclesDone()
+
+	def waitForContentCycle(self, since):
+		'''
+		Block until the signs have shown all the content once more since `since` (from
+		getContentCycles).  If there is nothing to show there's no cycle to wait for, so
+		just wait the normal refresh interval instead.  Either way, stop waiting if the local
+		content file changes.
+		'''
+		while not self._signMgr.waitForCycle(since, LocalContentSource.POLL_INTERVAL):
+			self.checkConfig()
+			self.checkRestart()
+			if self._localContent.hasChanged() or self.restartRequested():
+				return
+			if not self._signMgr.hasContent():
+				self.sleepUntilRefresh()
+				return
+
+	def sleepUntilRefresh(self):
+		'''
+		Public method to wait REFRESH_INTERVAL secs before fetching again, cut short if the local
+		content file changes.  The settings are checked for a reload every POLL_INTERVAL secs
+		meanwhile.
+		'''
+		deadline = time.time() + self.REFRESH_INTERVAL
+		while True:
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				return
+			if self._localContent.waitForChange(min(remaining, LocalContentSource.POLL_INTERVAL)):
+				return
+			self.checkConfig()
+			self.checkRestart()
+			if self.restartRequested():
+				return
+
 	def _openSigns(self):
 		signs = []
 
-		if self.config.has_option('Communication', 'serial_path'):
-			path = self.config.get('Communication', 'serial_path')
-		else:
-			path = '/dev/ttyS0'
-		self._serial_port1 = path
-		sign1 = LedSign(self._serial_port1, self._write_to_serial)
-		serial1Opened = sign1.isWorking()
-		if serial1Opened:
-			logging.info("Opened serial port1 at ",path)
-		else:
-			logging.error("ERROR: couldn't open serial port1 named "+str(self._serial_port1))
-			self._status = self.STATUS_SIGN_COMMS_ERROR
-		signs.append(sign1)
-
-		if self.config.has_option('Communication', 'serial_path_2'):
-			logging.info("Has 2 serial ports")
-			path = self.config.get('Communication', 'serial_path_2')
-			self._serial_port2 = path
-			sign2 = LedSign(self._serial_port2, self._write_to_serial)
-			serial2Opened = sign2.isWorking()
-			if serial2Opened:
-				logging.info("Opened serial port2 at ",path)
+		self._signs = signs
+		self._serial_ports = self.config.serialPaths
+		if len(self._serial_ports) > 1:
+			logging.info("Has %d serial ports" % len(self._serial_ports))
+		for path in self._serial_ports:
+			sign = LedSign(path, self._write_to_serial, self.config)
+			if sign.isWorking():
+				logging.info("Opened serial port%d at %s" % (len(signs) + 1, path))
 			else:
-				logging.error("ERROR: couldn't open serial port2 named "+str(self._serial_port2))
+				logging.error("ERROR: couldn't open serial port%d named %s" % (len(signs) + 1, path))
 				self._status = self.STATUS_SIGN_COMMS_ERROR
-			signs.append(sign2)
+			signs.append(sign)
 		
 		return signs
 		
 
-	def _write_to_display(self, message):
+	def _write_to_display(self, message, variables=None):
 		'''
 		Wrapper around the actual sign comms
 		'''
@@ -593,26 +5026,175 @@ class SignController:
 		if lastUpdateWorked == False:
 			logging.warning("Last update couldn't write to sign.")
 			self._status = self.STATUS_SIGN_COMMS_ERROR
+		handedOver = self._handedOver
+		self._handedOver = None
+		self._shownMessage = (message, variables)
+		if handedOver == (message, variables):
+			return		# carried on with it across the restart, so it's already up
 		# try to update the sign content (which should reset the ports if they aren't working)
-		self._signMgr.setContent(message)
-		time.sleep(1)
+		self._signMgr.setContent(message, variables)
 		
 	def update(self):
 		'''
 		Public method to fetch new data and show it on the sign
 		'''
-		now = time.time()
+		self._check_expired()
+
+		# take what the server pushed if it did, else fetch normally
+		info = self._take_push()
+		if info == None:
+			info = self._fetch_text_from_server()
+		self._handle_info(info)
+		self._start_push()
+		self._write_status()
+
+	def isPushing(self):
+		'''
+		Public method to say if the server will tell us when there's new content, over a long-poll
+		that is out now, so we don't need to poll it (see waitForPush)
+		'''
+		return (self.config.push and (self._pushPoll != None) and (self._pushFailures == 0) and
+				not self._localContent.exists())
+
+	def waitForPush(self):
+		'''
+		Public method to block until the long-poll comes back, cut short if the local content
+		file changes.  The settings are checked for a reload every POLL_INTERVAL secs meanwhile.
+		'''
+		while not self._pushPoll.wait(LocalContentSource.POLL_INTERVAL):
+			self.checkConfig()
+			self.checkRestart()
+			if self._localContent.hasChanged() or self.restartRequested() or not self.isPushing():
+				return
+
+	def _start_push(self):
+		'''
+		Send the server a long-poll, if we're set to and don't have one out already: it holds on
+		to it until our content changes (or for PUSH_WAIT_SECS), so new content gets to us as
+		soon as it's published instead of at our next poll
+		'''
+		if ((not self.config.push) or (self._pushPoll != None) or
+				(time.time() < self._pushRetryAt) or self._localContent.exists()):
+			return
+		self._check_server_configured()
+		path = self._server_request_path() + '&' + urllib.urlencode({'wait': self.PUSH_WAIT_SECS})
+		timeout = self.PUSH_WAIT_SECS + self.SERVER_TIMEOUT
+		if self.isAsync():
+			started = time.time()
+			self._pushPoll = AsyncHttpFetch(self._loop, self.config.serverHost,
+											self.config.serverPort, path,
+											lambda status, headers, body:
+												self._async_pushed(started, status, headers, body),
+											self._conditional_headers(), timeout)
+			return
+		if self._pushFetcher == None:
+			self._pushFetcher = LongPollFetcher()
+			self._pushFetcher.start()
+		self._pushPoll = self._pushFetcher.poll(self.config.serverHost, self.config.serverPort,
+												path, self._conditional_headers(), timeout)
 
-		# check if we're offline so we don't show stale info
-		if (self._status==self.STATUS_SERVER_CONNECT_ERROR) and ((now - self._last_success) > self.OFFLINE_THRESHOLD_SECS):
+	def _take_push(self):
+		'''
+		What the long-poll brought back, if it has come back: [info, actions, variables, expiry]
+		or NOT_MODIFIED, or None if it hasn't or we can't use it
+		'''
+		poll = self._pushPoll
+		if (poll == None) or not poll.isDone():
+			return None
+		self._pushPoll = None
+		if poll.status == None:
+			self._push_failed(poll.error)
+			return None
+		return self._pushed(poll.status, poll.responseHeaders, poll.body, poll.elapsed)
+
+	def _pushed(self, status, headers, body, elapsed):
+		'''
+		Turn a long-poll's response into [info, actions, variables, expiry] or NOT_MODIFIED, or
+		None if we can't use it (in which case we go back to polling for a while)
+		'''
+		if (not self.config.push) or self._localContent.exists():
+			return None
+		if status == None:
+			self._push_failed("couldn't reach the server")
+			return None
+		if (status == 304) and (elapsed < self.PUSH_WAIT_SECS / 2.0):
+			# a server that doesn't know about long-polls answers straight away
+			self._push_failed("the server didn't hold on to the request")
+			return None
+		if (status in [200, 226]) and (headers.get('etag') == None) and \
+				(headers.get('last-modified') == None):
+			# without these the server can't tell us apart from a new client, so it wouldn't wait
+			self._push_failed("the server didn't send an ETag or Last-Modified")
+			return None
+		info = self._handle_response(status, headers, body)
+		if info == self.DELTA_FAILED:
+			return None		# the long-poll was fine, we just need to fetch it all
+		if info == None:
+			self._push_failed("the server sent something we can't use")
+			return None
+		if self._pushFailures > 0:
+			logging.info("Long-polling the server again")
+		self._pushFailures = 0
+		return info
+
+	def _push_failed(self, reason):
+		'''
+		Go back to polling for a while after a long-poll failed, longer each time in a row
+		'''
+		self._pushFailures = self._pushFailures + 1
+		delay = min(self.PUSH_RETRY_SECS * 2 ** (self._pushFailures - 1), self.PUSH_MAX_RETRY_SECS)
+		self._pushRetryAt = time.time() + delay
+		metrics.count('push.failures')
+		logging.warning("long-poll failed (%s), polling for %d secs instead" % (reason, delay))
+
+	def _write_status(self):
+		'''
+		Write the metrics out to the status file, for anyone on the box who wants to look
+		'''
+		if self._statusFile != None:
+			metrics.writeStatus(self._statusFile, {'status': self._status,
+												   'codeVersion': CODE_VERSION,
+												   'ports': self._signMgr.getPortStats()})
+
+	def _check_expired(self):
+		'''
+		Take down any of the content that has expired, so we don't show stale info
+		'''
+		current = self._contentCache.current(time.time())
+		if (self._shownMessage == None) or (current == self._shownMessage):
+			return
+		if current != None:
+			logging.info("some of the content expired, showing the rest")
+			self._write_to_display(current[0], current[1])
+		elif self._shownMessage[0] != "":
 			self._write_to_display("")
 			logging.warning("haven't gotten text from server for a while, disabling display")
 			self._status = self.STATUS_BLANKED_DISPLAY
+			# we aren't showing that content any more, so make sure we get it all again
+			self._etag = None
+			self._last_modified = None
+			self._localContent.invalidate()
+
+	def _handle_info(self, info):
+		'''
+		Act on the [info, actions, variables, expiry] we got from the server (None if we couldn't
+		get any)
+		'''
+		if info == self.NOT_MODIFIED:
+			# we're already showing the latest content, so there's nothing to update
+			if self._status==self.STATUS_SERVER_CONNECT_ERROR:
+				logging.info("Connected to server again happily")
+			self._status = self.STATUS_OK
+			self._contentCache.revalidate(time.time())
+			return
 
-		# now fetch normally
-		info = self._fetch_text_from_server()
-		msg = info[0]
-		act = info[1]
+		msg = None
+		act = None
+		variables = None
+		if info != None:
+			msg = info[0]
+			act = info[1]
+			variables = info[2]
                 
 		if act!= None:
 			self._do_actions(act)
@@ -621,13 +5203,18 @@ class SignController:
 			if(self._status==self.STATUS_SERVER_CONNECT_ERROR or self._status==self.STATUS_BLANKED_DISPLAY):
 				logging.info("Connected to server again happily")
 			self._status = self.STATUS_OK
-			logging.info('update: '+str(msg))
+			logging.info('update: %r', msg)
+			if variables:
+				logging.info('variables: %r', variables)
 			logging.info('...writing updated message.')
-			self._write_to_display(msg)
-			self._last_success = now
+			self._contentCache.store(info, time.time())
+			current = self._contentCache.current(time.time()) or ("", None)
+			self._write_to_display(current[0], current[1])
 		else:
 			if self._status != self.STATUS_BOOTING and self._status != self.STATUS_VERSION_MISMATCH: # make sure reboot shows up in status log
 				self._status = self.STATUS_SERVER_CONNECT_ERROR
+			self._contentCache.fetchFailed()
+			self._check_expired()
 				
 	def _do_actions(self, actions):
 		'''
@@ -635,118 +5222,533 @@ class SignController:
 		'''
 		for i in range (0, len(actions)):
 			if actions[i] == self.ACTION_RESTART:
-				f = open(NEED_TO_RESTART_FLAG_FILE,'w')
-				f.close()
+				self.requestRestart()
+
+	def _check_server_configured(self):
+		'''
+		We can't do anything without a server to talk to
+		'''
+		if self.config.serverHost == None:
+			logging.error("Error: no server host configured!")
+			sys.exit(1);
+
+	def _read_local_content(self):
+		'''
+		Load from a local file if it is there (helpful for testing or for running with static
+		content) - returns [info, actions, variables, expiry], NOT_MODIFIED if it hasn't changed
+		since last time, or None if we can't use it.  Call it only if self._localContent.exists().
+		'''
+		changed = self._localContent.hasChanged()
+		info = self._localContent.read()
+		if info != None and not changed:
+			return self.NOT_MODIFIED
+		return info
+
+	def _server_request_path(self):
+		'''
+		The path (with my info as the query string) to ask the server for content with
+		'''
+		config = self.config
+		params = dict(serial=config.serialNum, 
+					  secret=config.secret, 
+					  codeVersion=CODE_VERSION,
+					  protocolVersion=PROTOCOL_VERSION,
+					  status=self._status,
+					  metrics=metrics.summary())
+		params = urllib.urlencode(params)
+		return config.serverPath+"?"+params
 
 	def _fetch_text_from_server(self):
 		'''
 		Hit the server with my info and get the latest info to show on the sign
 		'''
 
-		# try to get the content to display		
-		if self.config.has_option('Server', 'host'):
-
-			#if (os.path.isfile("/opt/usr/lib/Realtime-Community-Sign/content.xml")):
-			if (os.path.isfile("content.xml")):
-				# load from a local file if it is there (helpful for testing or for running with static content
-				signMessage = open("content.xml",'r')
-				msg = signMessage.read()
-			else :
-				# load live content  from the server specified
-				path = "/x"
-				if config.has_option('Server', 'path'):
-					path = config.get('Server', 'path')
-				params = dict(serial=self.config.get('Server', 'serial_num'), 
-							  secret=self.config.get('Server', 'secret'), 
-							  codeVersion=CODE_VERSION,
-							  protocolVersion=PROTOCOL_VERSION,
-							  status=self._status)
-				params = urllib.urlencode(params)
-				msg = None
-				try:
-					conn = httplib.HTTPConnection( self.config.get('Server', 'host'), self.config.get('Server', 'port'))
-					#print self.config.get('Server', 'host')+":"+self.config.get('Server', 'port')+path+"?"+params
-					#sys.exit()
-					conn.request("GET", path+"?"+params)
-					response = conn.getresponse()
-					msg = response.read()
-				except Exception, e:
+		# try to get the content to display, from a local file if there is one
+		if self._localContent.exists():
+			return self._read_local_content()
+		# forget any file that was there, so it doesn't look like it keeps changing
+		self._localContent.invalidate()
+		self._check_server_configured()
+
+		info = self._fetch_from_server()
+		if info == self.DELTA_FAILED:
+			info = self._fetch_from_server()
+		if info == self.DELTA_FAILED:
+			return None
+		return info
+
+	def _fetch_from_server(self):
+		'''
+		Helper to do one fetch for _fetch_text_from_server
+		'''
+		# load live content  from the server specified, reusing the connection if we can
+		for attempt in range(2):
+			if self._conn == None:
+				self._conn = httplib.HTTPConnection( self.config.serverHost, 
+													 self.config.serverPort,
+													 timeout=self.SERVER_TIMEOUT)
+			try:
+				if self._conn.sock == None:
+					started = time.time()
+					self._conn.connect()
+					metrics.observe('fetch.connect', time.time() - started)
+				started = time.time()
+				self._conn.request("GET", self._server_request_path(), 
+								   headers=self._conditional_headers())
+				response = self._conn.getresponse()
+				metrics.observe('fetch.response', time.time() - started)
+				headers = dict(response.getheaders())
+				# parse straight off the socket rather than reading the whole body in first
+				body = CountingReader(response)
+				info = self._handle_response(response.status, headers, body)
+				self._drain(body)
+				metrics.count('fetch.bytes', body.bytesRead)
+				if response.will_close:
+					self._close_connection()
+				return info
+			except Exception, e:
+				# the server may have just dropped our idle connection, so try a fresh one once
+				self._close_connection()
+				if attempt > 0:
+					metrics.count('fetch.errors')
 					logging.warning("couldn't fetch from server "+str(e))
-					return None
-			
-			#XML parsing
+		return None
+
+	def _drain(self, response):
+		'''
+		Read whatever the parser left of a response, so the connection can be used again
+		'''
+		while response.read(self.READ_CHUNK_SIZE):
+			pass
+
+	def _close_connection(self):
+		if self._conn != None:
+			self._conn.close()
+			self._conn = None
+
+	def _conditional_headers(self):
+		'''
+		Headers that let the server answer 304 Not Modified if our content is still current, or
+		else send it compressed, or as a delta (226 IM Used) against what we have
+		'''
+		headers = {'Accept-Encoding': 'gzip, deflate'}
+		if self._etag != None:
+			headers['If-None-Match'] = self._etag
+			if (self._deltaBase != None) and (self._deltaBase[0] == self._etag):
+				headers['A-IM'] = self.DELTA_FORMAT
+		if self._last_modified != None:
+			headers['If-Modified-Since'] = self._last_modified
+		return headers
+
+	def _handle_response(self, status, headers, msg):
+		'''
+		Turn an HTTP response into [info, actions, variables, expiry], NOT_MODIFIED or None
+		(headers is a dict with lower-cased names, msg is the body or a file-like object to read
+		it from)
+		'''
+		metrics.count('fetch.requests')
+		trace.response(status, headers)
+		if status == 304:
+			metrics.count('fetch.not_modified')
+			return self.NOT_MODIFIED
+		delta = (status == 226) and (self._deltaBase != None)
+		if (status != 200) and not delta:
+			metrics.count('fetch.errors')
+			logging.warning("got HTTP status %s from server" % str(status))
+			return None
+		encoding = headers.get('content-encoding', 'identity').lower()
+		if encoding not in ['identity', 'gzip', 'x-gzip', 'deflate']:
+			metrics.count('fetch.errors')
+			logging.warning("got content encoded with %s from server" % encoding)
+			return None
+		if encoding != 'identity':
+			if isinstance(msg, basestring):
+				msg = StringIO(msg)
+			msg = DecompressingReader(msg)
+		self._etag = None
+		self._last_modified = None
+		if delta:
+			metrics.count('fetch.deltas')
+			msg = self._apply_delta(headers, msg)
+			if msg == None:
+				self._deltaBase = None
+				metrics.count('fetch.delta_failures')
+				logging.warning("the delta from the server didn't check out, fetching it all")
+				return self.DELTA_FAILED
+		elif not isinstance(msg, basestring):
+			limit = self.DELTA_BASE_MAX_BYTES
+			if trace.isRecording():
+				limit = sys.maxint		# the trace gets all of it
+			msg = KeepingReader(msg, limit)
+		started = time.time()
+		info = self._parse_server_response(msg)
+		metrics.observe('fetch.parse', time.time() - started)
+		self._deltaBase = None
+		body = None
+		if (info != None) or trace.isRecording():
+			body = self._whole_body(msg)
+			if body != None:
+				trace.content(body)
+		if info != None:
+			self._etag = headers.get('etag')
+			self._last_modified = headers.get('last-modified')
+			info[3]['ttl'] = self._max_age(headers.get('cache-control'))
+			self._keep_delta_base(body)
+		return info
+
+	def _whole_body(self, msg):
+		'''
+		Helper to return all of the response we just parsed (a string or a KeepingReader), or
+		None if it was too big to keep
+		'''
+		if isinstance(msg, basestring):
+			return msg
+		while msg.read(self.READ_CHUNK_SIZE):
+			pass		# anything after the document still counts
+		return msg.kept()
+
+	def _keep_delta_base(self, body):
+		'''
+		Hold on to the response we just parsed, if it isn't too big, so the server can send the
+		next one as a delta against it
+		'''
+		if self._etag == None:
+			return
+		if (body != None) and (len(body) <= self.DELTA_BASE_MAX_BYTES):
+			self._deltaBase = (self._etag, body)
+
+	def _apply_delta(self, headers, msg):
+		'''
+		The response a 226 IM Used makes of the last full one we got, or None if it isn't a
+		delta against that one, doesn't apply or doesn't match the md5 in its Digest header
+		'''
+		if ((headers.get('im', '').strip().lower() != self.DELTA_FORMAT) or
+				(headers.get('delta-base') != self._deltaBase[0])):
+			return None
+		try:
+			if not isinstance(msg, basestring):
+				msg = msg.read()
+			body = self._patch(self._deltaBase[1], msg)
+		except (ValueError, zlib.error):
+			return None
+		if self._digest(headers.get('digest')) != base64.b64encode(hashlib.md5(body).digest()):
+			return None
+		return body
+
+	def _digest(self, header):
+		'''
+		The md5 in a Digest header (as base64), or None if there isn't one
+		'''
+		if header == None:
+			return None
+		for digest in header.split(','):
+			name, sep, value = digest.strip().partition('=')
+			if name.lower() == 'md5':
+				return value
+		return None
+
+	def _patch(self, base, delta):
+		'''
+		Apply a delta in our "lines" format to base.  The delta is a list of commands, each on
+		its own line: =N copies the next N lines of base, -N skips them, and +N is followed by N
+		new lines to put in.  Raises ValueError if it doesn't fit base.
+		'''
+		lines = self._lines(base)
+		commands = self._lines(delta)
+		result = []
+		pos = 0
+		i = 0
+		while i < len(commands):
+			command = commands[i].rstrip('\n')
+			i += 1
+			count = int(command[1:])
+			if count < 0:
+				raise ValueError("bad delta command %s" % command)
+			if command[0] == '=':
+				if pos + count > len(lines):
+					raise ValueError("delta copies past the end")
+				result.extend(lines[pos:pos + count])
+				pos += count
+			elif command[0] == '-':
+				pos += count
+			elif command[0] == '+':
+				if i + count > len(commands):
+					raise ValueError("delta ends in the middle of new lines")
+				result.extend(commands[i:i + count])
+				i += count
+			else:
+				raise ValueError("bad delta command %s" % command)
+		return ''.join(result)
+
+	def _lines(self, text):
+		'''
+		Split text into lines, each keeping its newline (the last one may not have one)
+		'''
+		lines = [line + '\n' for line in text.split('\n')]
+		lines[-1] = lines[-1][:-1]
+		if lines[-1] == '':
+			lines.pop()
+		return lines
+
+	def _max_age(self, cacheControl):
+		'''
+		The max-age in a Cache-Control header, or None if there isn't one we can read
+		'''
+		if cacheControl == None:
+			return None
+		for directive in cacheControl.split(','):
+			name, sep, value = directive.strip().partition('=')
+			if name.lower() == 'max-age':
+				return self._ttl(value.strip('"'), None)
+		return None
+
+	def _ttl(self, value, default):
+		'''
+		A ttl (or max-age) in secs, or default if value isn't one
+		'''
+		if value == None:
+			return default
+		try:
+			ttl = float(value)
+		except ValueError:
+			return default
+		if ttl < 0:
+			return default
+		return ttl
+
+	def _parse_server_response(self, msg):
+		'''
+		Pull the [info, actions, variables, expiry] out of the XML the server sent, or None if
+		we can't use it.  msg can be a string or a file-like object; either way it is parsed as
+		a stream, so we never hold more than the text we're keeping plus the element being read.
+		variables is a dict of the message's <variable name="..."> values for the {name}s in
+		its info.  expiry is what ContentCache needs to expire the content a piece at a time:
+		'items' is [text, ttl] for each <info>, 'variables' maps names to ttls, and 'ttl' is
+		for everything else (None here, see _handle_response).  A ttl is the element's ttl
+		attribute, else its <message>'s, else None.
+		'''
+		if isinstance(msg, basestring):
 			if(len(msg)==0):
 				logging.warning("got empty message from server")
 				return None
-			dom = xml.dom.minidom.parseString(msg)
-			information = []
-			info=""
-			actions=[]
-			#Get code version
-			version = dom.documentElement.getAttribute("version")
-			#Only update sign if version is the same as protocol version
-			if version == PROTOCOL_VERSION:
-				#Get information for this version
-				for node in dom.getElementsByTagName("message"):
-					#Get a list of all info tags
-					infoTags = node.getElementsByTagName("info")
-					info = ""
-					for nodeA in infoTags:
-						for nodeB in nodeA.childNodes:
-							if nodeB.nodeType == Node.TEXT_NODE:
-								info += nodeB.data
-				#Get commands for this version
-				for node in dom.getElementsByTagName("commandlist"):
-					#Get list of all command tags
-					commandTags = node.getElementsByTagName("command")
-					for nodeA1 in commandTags:
-						for nodeB1 in nodeA1.childNodes:
-							if nodeB1.nodeType == Node.TEXT_NODE:
-								actions.append(nodeB1.data)
-								
-				#Add info and actions
-				information = [info, actions]
-				
-				#Returning both
-				return information
-				
-			else:
-				self._status = self.STATUS_VERSION_MISMATCH
-				logging.error("Error: version mismatch")
+			msg = StringIO(msg)
+		root = None
+		depth = 0
+		inMessage = 0
+		inCommandlist = 0
+		info = ""
+		actions = []
+		variables = {}
+		items = []
+		ttls = {}
+		messageTtl = None
+		try:
+			for event, elem in ET.iterparse(msg, events=('start', 'end')):
+				if event == 'start':
+					if root == None:
+						root = elem
+						#Only update sign if version is the same as protocol version, and don't
+						#bother reading the rest if it isn't
+						if elem.get("version") != PROTOCOL_VERSION:
+							self._status = self.STATUS_VERSION_MISMATCH
+							logging.error("Error: version mismatch")
+							return None
+					depth += 1
+					if elem.tag == "message":
+						#only the last message's info gets shown
+						inMessage += 1
+						info = ""
+						variables = {}
+						items = []
+						ttls = {}
+						messageTtl = self._ttl(elem.get("ttl"), None)
+					elif elem.tag == "commandlist":
+						inCommandlist += 1
+					continue
+				depth -= 1
+				if elem.tag == "info" and inMessage > 0:
+					text = "".join(self._direct_text(elem))
+					info += text
+					items.append([text, self._ttl(elem.get("ttl"), messageTtl)])
+				elif elem.tag == "variable" and inMessage > 0 and elem.get("name"):
+					variables[elem.get("name")] = "".join(self._direct_text(elem))
+					ttls[elem.get("name")] = self._ttl(elem.get("ttl"), messageTtl)
+				elif elem.tag == "command" and inCommandlist > 0:
+					actions.extend(self._direct_text(elem))
+				elif elem.tag == "message":
+					inMessage -= 1
+				elif elem.tag == "commandlist":
+					inCommandlist -= 1
+				if depth == 1:
+					#done with this top-level element, so let go of it
+					root.clear()
+		except (SyntaxError, expat.ExpatError, zlib.error), e:
+			logging.warning("couldn't parse message from server "+str(e))
+			return None
+		return [info, actions, variables, {'items': items, 'variables': ttls, 'ttl': None}]
+
+	def _direct_text(self, elem):
+		'''
+		The text directly inside an element (not inside its children), as a list of runs
+		'''
+		runs = []
+		if elem.text != None:
+			runs.append(elem.text)
+		for child in elem:
+			if child.tail != None:
+				runs.append(child.tail)
+		return runs
+
+	def isAsync(self):
+		'''
+		Public method to say if we should be run with runAsync instead of the update() loop
+		'''
+		return self._runtime == self.RUNTIME_ASYNC
 
+	def runAsync(self):
+		'''
+		Public method to fetch, page and talk to the signs all from one event loop, instead of
+		the update() loop plus sign threads.  Never returns.
+		'''
+		if self._localContent.fileno() != None:
+			LocalContentWatcher(self._loop, self._localContent, self._async_check_local)
 		else:
+			self._loop.callLater(LocalContentSource.POLL_INTERVAL, self._async_poll_local)
+		self._loop.callLater(LocalContentSource.POLL_INTERVAL, self._async_check_config)
+		self._loop.callLater(0, self._async_refresh)
+		self._loop.run()
 
-			logging.error("Error: no server host configured!")
-			sys.exit(1);
+	def _async_refresh(self):
+		'''
+		Event-loop version of update: check if we're offline and start fetching new content
+		'''
+		# anything still scheduled from an earlier refresh is out of date now
+		self._refreshSeq = self._refreshSeq + 1
+		seq = self._refreshSeq
+		self._check_expired()
+		cycles = self.getContentCycles()
+		if self._localContent.exists():
+			self._async_show(seq, cycles, self._read_local_content())
+			return
+		self._localContent.invalidate()
+		self._check_server_configured()
+		AsyncHttpFetch(self._loop, self.config.serverHost,
+					   self.config.serverPort, self._server_request_path(),
+					   lambda status, headers, body: self._async_fetched(seq, cycles, status, headers, body),
+					   self._conditional_headers(), self.SERVER_TIMEOUT)
 
-		return None
+	def _async_fetched(self, seq, cycles, status, headers, msg):
+		'''
+		Show what we fetched
+		'''
+		if seq != self._refreshSeq:
+			return
+		info = None
+		if status != None:
+			info = self._handle_response(status, headers, msg)
+		if info == self.DELTA_FAILED:
+			self._async_refresh()		# without the delta base, so it comes back whole
+			return
+		self._async_show(seq, cycles, info)
+
+	def _async_show(self, seq, cycles, info):
+		'''
+		Show the [info, actions, variables, expiry] we got, then schedule the next refresh
+		'''
+		self._handle_info(info)
+		self._write_status()
+		self._start_push()
+		if self.isPushing():
+			return		# the long-poll coming back is our next refresh, see _async_pushed
+		if self.refreshContentAfterOneCycle():
+			self._signMgr.whenCycleDone(cycles, lambda cycled: self._async_cycled(seq, cycled))
+		else:
+			logging.info('Sleeping...')
+			self._loop.callLater(self.REFRESH_INTERVAL, self._async_scheduled, seq)
+
+	def _async_pushed(self, started, status, headers, body):
+		'''
+		The long-poll came back: show what it brought, or go back to polling if it failed
+		'''
+		self._pushPoll = None
+		info = self._pushed(status, headers, body, time.time() - started)
+		if info == None:
+			self._async_refresh()
+			return
+		self._refreshSeq = self._refreshSeq + 1
+		self._check_expired()
+		self._async_show(self._refreshSeq, self.getContentCycles(), info)
+
+	def _async_cycled(self, seq, cycled):
+		'''
+		The signs finished showing the content (or have nothing to show), so refresh
+		'''
+		if cycled:
+			self._async_scheduled(seq)
+		else:
+			self._loop.callLater(self.REFRESH_INTERVAL, self._async_scheduled, seq)
+
+	def _async_scheduled(self, seq):
+		'''
+		Time for the refresh that refresh number seq set up, unless another one has happened since
+		'''
+		if seq == self._refreshSeq:
+			self._async_refresh()
+
+	def _async_check_local(self):
+		'''
+		Refresh straight away if the local content file has changed
+		'''
+		if self._localContent.hasChanged():
+			self._async_refresh()
+
+	def _async_poll_local(self):
+		'''
+		Check the local content file on a timer, for when we don't have inotify
+		'''
+		self._async_check_local()
+		self._loop.callLater(LocalContentSource.POLL_INTERVAL, self._async_poll_local)
+
+	def _async_check_config(self):
+		'''
+		Check on a timer if the settings need reloading, or if we got a SIGUSR1
+		'''
+		self.checkConfig()
+		self.checkRestart()
+		self._loop.callLater(LocalContentSource.POLL_INTERVAL, self._async_check_config)
 
 def loadconfig(path):
 	'''
-	Helper function to load the properties file used to configure the sign
+	Helper function to load the properties file used to configure the sign, as a SignConfig.
+	Raises ValueError if it can't be parsed, has no sections in it (it's missing, empty or cut
+	short), or a setting in it doesn't make sense.
 	'''
 	config = ConfigParser.ConfigParser()
 	try:
 		config.read(path)
-	except Exception, e:
-		logging.error("Couldn't read config: %s" % e)
-		pass
-	else:
-		pass
-	return config
+	except ConfigParser.Error, e:
+		raise ValueError("can't parse it: %s" % e)
+	if len(config.sections()) == 0:
+		raise ValueError("there are no settings in it")
+	return SignConfig(config)
 
 def update(controller):
 	'''
 	Update the sign and then sleep.  You probably want to call this repeatedly 
 	inside of a while loop.
 	'''
+	cycles = controller.getContentCycles()
 	controller.update()
-	if controller.refreshContentAfterOneCycle():
-		while controller.stillCyclingContent():
-			time.sleep(1)
-	else:
-		logging.info('Sleeping...')
-		time.sleep(controller.REFRESH_INTERVAL)
+	if not controller.restartRequested():
+		if controller.isPushing():
+			controller.waitForPush()
+		elif controller.refreshContentAfterOneCycle():
+			controller.waitForContentCycle(cycles)
+		else:
+			logging.info('Sleeping...')
+			controller.sleepUntilRefresh()
+	if controller.restartRequested():
+		controller.restart()
 
 '''
 Main Code.  This first load up the config and starts a SignController, then loops over
@@ -758,10 +5760,22 @@ if __name__ == '__main__':
 	
 	logfile = open(LOG_FILE,'w')
 	
-	config = loadconfig( CONFIG_FILE_PATH )
+	if os.path.exists(CONFIG_FILE_PATH):
+		try:
+			config = loadconfig( CONFIG_FILE_PATH )
+		except ValueError, e:
+			logging.error("Bad settings in %s: %s" % (CONFIG_FILE_PATH, e))
+			sys.exit(1)
+	else:
+		# out of the box there's only content.xml to show, which needs no settings
+		logging.warning("No %s, using the default settings" % CONFIG_FILE_PATH)
+		config = SignConfig()
 	
-	controller = SignController(config)
+	controller = SignController(config, CONFIG_FILE_PATH)
 	
+	if controller.isAsync():
+		controller.runAsync()
+
 	while True:
 		update(controller)
 
@@ -0,0 +1,1019 @@
+#!/usr/bin/python
+'''
+Micro-benchmarks for the sign controller.  Run from the top of the repo, naming the benchmark
+you want, for example:
+
+	python scripts/benchmark.py encoder
+'''
+
+import ConfigParser
+import httplib
+import imp
+import os
+import json
+import logging
+import random
+import resource
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import xml.dom.minidom
+from xml.dom.minidom import Node
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'scripts'))
+
+import stub_server
+from sign_emulator import SignEmulator
+
+# the controller is a script with a dash in its name, so load it by path
+signctrl = imp.load_source('signctrl', os.path.join(ROOT, 'lib-sign-ctrl.py'))
+LedSign = signctrl.LedSign
+
+MESSAGE_LENGTHS = [10, 50, 100, 300, 1000, 2000]
+# the latency benchmark fails if any update takes longer than this to reach the sign (when the
+# manager polled, it could take up to 2000 ms)
+LATENCY_BOUND_MS = 100
+
+
+def legacy_encode(text, displayMode, displaySpeed, pauseTime, align):
+	'''
+	The frame assembly LedSign.write used before FrameEncoder, kept here for comparison
+	'''
+	msgHeader = LedSign.COMM_CMD_START + LedSign.COMM_START_OF_HEAD + LedSign.COMM_SEND_ADDR_PC
+	msgHeader+= LedSign.COMM_RECEIVER_ADDR_BCAST
+	msgData = LedSign.COMM_START_OF_TEXT + LedSign.COMM_CMD_WRITE_TEXT + LedSign.COMM_TEXT_FILE_NAME_0
+	msgData+= displayMode + displaySpeed + pauseTime
+	msgData+= LedSign.COMM_SHOW_DATE_NONE +  LedSign.COMM_START_SHOW_TIME_NONE
+	msgData+= LedSign.COMM_END_SHOW_TIME_NONE + LedSign.COMM_PREPARATAVE_PLACEHOLDER
+	msgData+= align
+	msgData+= LedSign.COMM_TEXT_DATA_FONT_SS7 + LedSign.COMM_TEXT_DATA_COLOR_AUTO
+	[msgData.append(c) for c in text]
+	msgData+= LedSign.COMM_END_OF_TEXT
+	msgFooter = []
+	msgFooter+= LedSign.COMM_EFFICACY_START
+	checksumInt = 0
+	for c in msgData:
+		checksumInt += ord(c)
+	checksumStr = "%0.4X" % checksumInt
+	[msgFooter.append(c) for c in checksumStr]
+	msgFooter+= LedSign.COMM_END_OF_TRANSMISSION
+	return (str(''.join(msgHeader)), str(''.join(msgData)), str(''.join(msgFooter)))
+
+
+def legacy_text(text):
+	'''
+	The text handling LedSign.write used before TextTranslator: non-ascii dropped, and the rest
+	copied into the frame a character at a time
+	'''
+	chars = []
+	[chars.append(c) for c in text.encode('ascii','ignore')]
+	return ''.join(chars)
+
+
+def _best(fn, number, repeat=5):
+	'''
+	Best per-call time in microseconds
+	'''
+	return min(timeit.repeat(fn, number=number, repeat=repeat)) / number * 1e6
+
+
+def bench_encoder():
+	'''
+	Compare FrameEncoder against the old list-of-chars frame assembly
+	'''
+	encoder = signctrl.FrameEncoder()
+	args = (LedSign.COMM_DISPLAY_MODE_ROLLLEFT, LedSign.COMM_DISPLAY_SPEED_2,
+			LedSign.COMM_PAUSE_TIME_9, LedSign.COMM_ALIGN_MODE_LEFT)
+	print "%8s %12s %12s %8s" % ("chars", "legacy (us)", "encoder (us)", "speedup")
+	for length in MESSAGE_LENGTHS:
+		text = ("Bus 1 in 3 min " * (length / 15 + 1))[:length]
+		if legacy_encode(text, *args) != encoder.encode(text, *args):
+			print "MISMATCH at %d chars" % length
+			sys.exit(1)
+		number = max(10, 20000 / length)
+		legacy = _best(lambda: legacy_encode(text, *args), number)
+		current = _best(lambda: encoder.encode(text, *args), number)
+		print "%8d %12.1f %12.1f %7.1fx" % (length, legacy, current, legacy / current)
+
+
+def bench_text():
+	'''
+	Compare TextTranslator, the first time it sees a text and once it's cached, against the old
+	character-by-character copy, for plain, accented and symbol markup text
+	'''
+	texts = [('plain', u"Bus 1 in 3 min "), ('accented', u"Caf\xe9 Z\xfcrich \u2192 Gare "),
+			 ('markup', u"{clock} 9:05 {right_arrow} Bus 1 ")]
+	for kind, sample in texts:
+		print "%s: %r -> %r (was %r)" % (kind, sample, signctrl.translator.translate(sample),
+										 legacy_text(sample))
+	print "%8s %8s %12s %12s %12s %8s" % ("text", "chars", "legacy (us)", "first (us)",
+										  "cached (us)", "speedup")
+	for kind, sample in texts:
+		for length in MESSAGE_LENGTHS:
+			text = (sample * (length / len(sample) + 1))[:length]
+			translator = signctrl.TextTranslator()
+			uncached = signctrl.TextTranslator()
+			uncached.CACHE_SIZE = 0
+			number = max(10, 20000 / length)
+			legacy = _best(lambda: legacy_text(text), number)
+			first = _best(lambda: uncached.translate(text), number)
+			cached = _best(lambda: translator.translate(text), number)
+			print "%8s %8d %12.1f %12.1f %12.1f %7.1fx" % (kind, length, legacy, first, cached,
+														   legacy / cached)
+
+	# and the whole way from a server response to a sign
+	sign = SignEmulator(baud=None)
+	sign.start()
+	controller = _controller(0, Communication_serial_path=sign.portname,
+							 Communication_write_to_serial=1)
+	text = u"Caf\xe9 {clock} Bus"
+	controller._handle_info(controller._parse_server_response(_display_xml(text).encode('utf-8')))
+	frame = sign.waitForText(signctrl.translator.translate(text), 10, since=0)
+	_stop_controller(controller)
+	sign.stop()
+	if frame == None:
+		print "MISMATCH, the sign didn't show %r from the server as %r" % (
+			text, signctrl.translator.translate(text))
+		sys.exit(1)
+	print "from the server: %r -> %r" % (text, sign.shownText())
+
+
+def bench_latency(iterations=20):
+	'''
+	Time from SignManager.setContent to the first byte showing up on the serial port, exiting
+	with an error if any update took longer than LATENCY_BOUND_MS
+	'''
+	fake = SignEmulator(baud=None)
+	fake.start()
+	manager = signctrl.SignManager()
+	manager.daemon = True
+	manager.setLedSigns([LedSign(fake.portname)])
+	manager.start()
+	latencies = []
+	for i in range(iterations):
+		since = fake.frameCount()
+		start = time.time()
+		manager.setContent(u"Bus 1 in %d min" % i)
+		frame = fake.waitFor(lambda frame: True, 5, since)
+		if frame == None:
+			print "FAIL: update %d never reached the sign" % i
+			sys.exit(1)
+		latencies.append((frame.firstByte - start) * 1000)
+		while manager.getCyclesDone() <= i:		# let the ack finish before the next one
+			time.sleep(0.01)
+	manager.hold()
+	manager.waitForHold(5)
+	manager.stop()
+	fake.stop()
+	latencies.sort()
+	print "setContent -> first serial byte over %d updates:" % iterations
+	print "  min %.2f ms, median %.2f ms, max %.2f ms" % (latencies[0],
+		latencies[len(latencies) / 2], latencies[-1])
+	if latencies[-1] > LATENCY_BOUND_MS:
+		print "FAIL: slowest update took %.2f ms, over the %d ms bound" % (latencies[-1],
+																		  LATENCY_BOUND_MS)
+		sys.exit(1)
+	print "  all within the %d ms bound" % LATENCY_BOUND_MS
+
+
+def bench_variables(updates=50):
+	'''
+	Bytes and time per update for rewriting a transit message in full against keeping its
+	arrival times in sign variables, on a sign on a pseudo-terminal
+	'''
+	template = u"Bus 1 in {bus1} min  Bus 47 in {bus47} min  Red Line in {red} min"
+	results = []
+	for useVariables in [False, True]:
+		fake = SignEmulator(baud=None)
+		fake.start()
+		sign = LedSign(fake.portname)
+		for i in range(updates):
+			values = {u'bus1': str(i % 10 + 1), u'bus47': str(i * 3 % 20 + 1),
+					  u'red': str(i * 7 % 12 + 1)}
+			if useVariables:
+				sign.write(template, LedSign.COMM_DISPLAY_MODE_ROLLLEFT, variables=values)
+			else:
+				text = template
+				for name, value in values.items():
+					text = text.replace(u'{' + name + u'}', value)
+				sign.write(text, LedSign.COMM_DISPLAY_MODE_ROLLLEFT)
+		results.append(sign.getTrafficStats())
+	legacy, current = results
+	print "%d updates of a %d character message, changing only its three arrival times:" % (
+		updates, len(template))
+	print "%12s %8s %10s %14s %14s" % ("", "frames", "bytes", "9600 baud (s)", "per update (ms)")
+	for name, stats in [("full", legacy), ("variables", current)]:
+		print "%12s %8d %10d %14.2f %14.2f" % (name, stats['frames'], stats['bytes'],
+			stats['bytes'] * 10 / 9600.0, stats['updateSecs'] / max(1, stats['updates']) * 1000)
+	print "variables sent %.0f%% of the bytes of full rewrites (%d)" % (
+		100.0 * current['bytes'] / current['fullBytes'], current['fullBytes'])
+
+
+def transit_feed(arrivals=40, minute=0):
+	'''
+	A server response shaped like a busy transit display: a line per route with its next arrival
+	'''
+	return arrivals_feed([(i * 7 + minute) % 30 + 1 for i in range(arrivals)])
+
+
+def arrivals_feed(minutes):
+	'''
+	A transit display like transit_feed's, with route i+1 arriving in minutes[i]
+	'''
+	lines = []
+	for i in range(len(minutes)):
+		lines.append("Route %d to Downtown via Main St\n%d min" % (i + 1, minutes[i]))
+	return ('<?xml version="1.0" encoding="UTF-8"?>\n<display version="%s">\n<message>\n'
+			'<info>%s</info>\n</message>\n<commandlist>\n<command></command>\n</commandlist>\n'
+			'</display>\n' % (signctrl.PROTOCOL_VERSION, '\n'.join(lines)))
+
+
+def _config(**options):
+	'''
+	A SignConfig with the options given as Section_option=value
+	'''
+	parser = ConfigParser.ConfigParser()
+	for name, value in options.items():
+		section, option = name.split('_', 1)
+		if not parser.has_section(section):
+			parser.add_section(section)
+		parser.set(section, option, str(value))
+	return signctrl.SignConfig(parser)
+
+
+def _controller(port, **options):
+	'''
+	A SignController talking to a stub server on this port, with no sign attached
+	'''
+	settings = dict(Communication_serial_path='/dev/null-sign', Communication_write_to_serial=0,
+					Server_host='localhost', Server_port=port, Server_serial_num='benchmark',
+					Server_secret='benchmark', Debug_status_file='')
+	settings.update(options)
+	# the controller prefers a local content.xml, so run from somewhere without one
+	os.chdir(tempfile.mkdtemp())
+	return signctrl.SignController(_config(**settings))
+
+
+def _stop_controller(controller):
+	'''
+	Close a controller from _controller's connection and stop its sign manager thread, so it
+	isn't left to run into interpreter exit
+	'''
+	controller._close_connection()
+	controller._signMgr.stop()
+
+
+def bench_fetch(fetches=120):
+	'''
+	Connections and bytes per hour for the old fetch (new connection, full download every time)
+	against the keep-alive conditional GET, at the default 30 sec refresh interval
+	'''
+	server = stub_server.StubServer(0).start()
+	server.setContent(transit_feed())
+	controller = _controller(server.getPort())
+	hourly = 3600.0 / controller.REFRESH_INTERVAL / fetches
+
+	for i in range(fetches):
+		conn = httplib.HTTPConnection('localhost', server.getPort())
+		conn.request("GET", controller._server_request_path())
+		controller._parse_server_response(conn.getresponse().read())
+	legacy = server.getStats()
+
+	server.resetStats()
+	for i in range(fetches):
+		controller._handle_info(controller._fetch_text_from_server())
+	current = server.getStats()
+	_stop_controller(controller)
+	server.stop()
+
+	print "%d fetches of unchanged content, scaled to one sign refreshing every %d secs for an hour" % (
+		fetches, controller.REFRESH_INTERVAL)
+	print "(bytes are HTTP requests plus responses, not counting TCP/IP overhead):"
+	print "%10s %12s %12s %12s %12s" % ("", "connections", "full", "304s", "bytes")
+	for name, stats in [("legacy", legacy), ("keep-alive", current)]:
+		print "%10s %12.0f %12.0f %12.0f %12.0f" % (name, stats['connections'] * hourly,
+			stats['full'] * hourly, stats['not_modified'] * hourly,
+			(stats['bytes_in'] + stats['bytes_out']) * hourly)
+
+
+def bench_delta(fetches=60, arrivals=40):
+	'''
+	Bytes per fetch of a transit feed where a few arrival times change between fetches, sent in
+	full, gzipped, as deltas and as gzipped deltas, and the requests it takes when a delta doesn't
+	match its checksum (the client's copy is corrupted before each fetch) and it fetches it all
+	'''
+	random.seed(1)
+	minutes = [random.randint(1, 30) for i in range(arrivals)]
+	feeds = []
+	for i in range(fetches + 1):
+		for route in random.sample(range(arrivals), arrivals / 5):
+			minutes[route] = (minutes[route] - 2) % 30 + 1
+		feeds.append(arrivals_feed(minutes))
+	server = stub_server.StubServer(0).start()
+	print "%d fetches of a %d-route feed, %d arrival times changing between fetches," % (
+		fetches, arrivals, arrivals / 5)
+	print "scaled to one sign refreshing every 30 secs for an hour (bytes are HTTP responses):"
+	print "%-22s %10s %10s %12s %12s" % ("", "requests", "deltas", "bytes/fetch", "bytes/hour")
+	for name, compression, deltas, corrupt in [("full", False, False, False),
+											   ("gzip", True, False, False),
+											   ("delta", False, True, False),
+											   ("gzip + delta", True, True, False),
+											   ("delta, bad checksum", True, True, True)]:
+		server.setCompression(compression)
+		server.setDeltas(deltas)
+		server.setContent(feeds[0])
+		controller = _controller(server.getPort())
+		controller._handle_info(controller._fetch_text_from_server())
+		server.resetStats()
+		for i in range(fetches):
+			server.setContent(feeds[i + 1])
+			if corrupt and (controller._deltaBase != None):
+				controller._deltaBase = (controller._deltaBase[0],
+										 controller._deltaBase[1].replace("min", "mins", 1))
+			logging.disable(logging.WARNING)	# one for every bad checksum
+			info = controller._fetch_text_from_server()
+			logging.disable(logging.NOTSET)
+			expected = controller._parse_server_response(feeds[i + 1])
+			if (info == None) or (info[0] != expected[0]):
+				print "MISMATCH for %s on fetch %d" % (name, i)
+				sys.exit(1)
+		_stop_controller(controller)
+		stats = server.getStats()
+		print "%-22s %10d %10d %12.0f %12.0f" % (name, stats['requests'], stats['deltas'],
+												 stats['bytes_out'] / float(fetches),
+												 stats['bytes_out'] * 120.0 / fetches)
+	server.stop()
+
+
+def _percentiles(values):
+	'''
+	(min, median, max) of some values, or Nones if there aren't any
+	'''
+	if len(values) == 0:
+		return (None, None, None)
+	values = sorted(values)
+	return (values[0], values[len(values) / 2], values[-1])
+
+
+def _ms(value):
+	if value == None:
+		return "%8s" % "-"
+	return "%8.1f" % (value * 1000)
+
+
+def _report_e2e(name, signs, elapsed, latencies):
+	'''
+	Print a line of frames per minute, content change to display and ack wait for a run
+	'''
+	frames = []
+	for sign in signs:
+		frames.extend(sign.frames)
+	ackWaits = [frame.acked - frame.received for frame in frames if frame.acked != None]
+	row = ["%-16s %8.1f" % (name, len(frames) * 60.0 / elapsed)]
+	row.extend([_ms(value) for value in _percentiles(latencies)])
+	row.extend([_ms(value) for value in _percentiles(ackWaits)])
+	print ' '.join(row)
+
+
+def _e2e_manager(manager, signs, updates, lines):
+	'''
+	Set new content updates times on a manager, timing how long until its first line shows on
+	the top sign - returns (elapsed secs, latencies)
+	'''
+	latencies = []
+	started = time.time()
+	for i in range(updates):
+		marker = "Update %d" % i
+		since = signs[0].frameCount()
+		start = time.time()
+		manager.setContent('\n'.join([marker] + lines))
+		frame = signs[0].waitForText(marker, 30, since=since)
+		if frame != None:
+			latencies.append(frame.displayed - start)
+	return (time.time() - started, latencies)
+
+
+def _display_xml(text):
+	'''
+	A server response showing text
+	'''
+	return ('<?xml version="1.0" encoding="UTF-8"?>\n<display version="%s"><message><info>%s'
+			'</info></message><commandlist><command></command></commandlist></display>\n' %
+			(signctrl.PROTOCOL_VERSION, text))
+
+
+def _write_content(text):
+	'''
+	Swap in a new content.xml in the current directory, the way rsync would
+	'''
+	f = open('content.xml.tmp', 'w')
+	f.write(_display_xml(text))
+	f.close()
+	os.rename('content.xml.tmp', 'content.xml')
+
+
+def bench_e2e(updates=10, baud=9600):
+	'''
+	Whole-path timing against emulated signs at 9600 baud: frames per minute, content change to
+	the sign showing it, and how long the client waited on each ack
+	'''
+	config = _config(Communication_min_display_secs=0.5, Communication_secs_per_char=0.02)
+	print "%d content changes per setup at %d baud, pages held for at least 0.5 secs" % (updates,
+																						   baud)
+	print "%-16s %8s %26s %26s" % ("", "frames/", "change -> display (ms)", "ack wait (ms)")
+	print "%-16s %8s %8s %8s %8s %8s %8s %8s" % ("setup", "minute", "min", "median", "max",
+												 "min", "median", "max")
+
+	sign = SignEmulator(baud)
+	sign.start()
+	manager = signctrl.SignManager(config)
+	manager.setLedSigns([LedSign(sign.portname)])
+	manager.start()
+	elapsed, latencies = _e2e_manager(manager, [sign], updates, [])
+	manager.stop()
+	sign.stop()
+	_report_e2e("SignManager", [sign], elapsed, latencies)
+
+	signs = [SignEmulator(baud), SignEmulator(baud)]
+	for sign in signs:
+		sign.start()
+	manager = signctrl.TwoSignManager(config)
+	manager.setLedSigns([LedSign(sign.portname) for sign in signs])
+	manager.start()
+	lines = ["Route %d" % i for i in range(1, 6)] + ["%d min" % i for i in range(1, 5)]
+	elapsed, latencies = _e2e_manager(manager, signs, updates, lines)
+	manager.stop()
+	for sign in signs:
+		sign.stop()
+	_report_e2e("TwoSignManager", signs, elapsed, latencies)
+
+	# the controller shows content.xml if it is there, so drive it with that rather than a server
+	sign = SignEmulator(baud)
+	sign.start()
+	controller = _controller(0, Communication_serial_path=sign.portname,
+							 Communication_write_to_serial=1)
+	_write_content("Starting")
+	stopping = threading.Event()
+	def keepUpdating():
+		while not stopping.is_set():
+			signctrl.update(controller)
+	loop = threading.Thread(target=keepUpdating)
+	loop.daemon = True
+	loop.start()
+	sign.waitForText("Starting", 30, since=0)
+	sign.resetStats()
+	latencies = []
+	started = time.time()
+	for i in range(updates):
+		marker = "Update %d" % i
+		since = sign.frameCount()
+		start = time.time()
+		_write_content(marker)
+		frame = sign.waitForText(marker, 30, since=since)
+		if frame != None:
+			latencies.append(frame.displayed - start)
+	elapsed = time.time() - started
+	stopping.set()
+	_write_content("Stopping")		# cuts short the wait for the content to cycle
+	loop.join()
+	_stop_controller(controller)
+	sign.stop()
+	_report_e2e("SignController", [sign], elapsed, latencies)
+
+
+def _pipeline_run(runtime, depth, pages, baud):
+	'''
+	Cycle pages through two emulated signs with pipeline_pages set to depth, and return the
+	display.page_gap histogram once that many gaps have gone by
+	'''
+	config = _config(Communication_min_display_secs=0.3, Communication_secs_per_char=0.001,
+					 Communication_pipeline_pages=depth)
+	signs = [SignEmulator(baud), SignEmulator(baud)]
+	for sign in signs:
+		sign.start()
+	ledSigns = [LedSign(sign.portname) for sign in signs]
+	lines = []
+	for i in range(pages):
+		lines.extend(["Route %d" % i, "Stop %d is in %d min" % (i, i % 9 + 1)])
+	signctrl.metrics.reset()
+	if runtime == 'async':
+		# run the loop from here, so it stops for good once we're done with it
+		loop = signctrl.EventLoop()
+		manager = signctrl.AsyncTwoSignManager(loop, config)
+		manager.setLedSigns(ledSigns)
+		manager.setContent('\n'.join(lines))
+		wait = loop.runOnce
+	else:
+		manager = signctrl.TwoSignManager(config)
+		manager.setLedSigns(ledSigns)
+		manager.setContent('\n'.join(lines))
+		manager.start()
+		wait = lambda: time.sleep(0.1)
+	deadline = time.time() + 120
+	while time.time() < deadline:
+		gaps = signctrl.metrics.snapshot()['histograms'].get('display.page_gap')
+		if (gaps != None) and (gaps['count'] >= pages):
+			break
+		wait()
+	manager.clear()
+	manager.stop()
+	for sign in signs:
+		sign.stop()
+	return signctrl.metrics.snapshot()['histograms']
+
+
+def bench_pipeline(pages=20, baud=9600):
+	'''
+	Host time between one page's dwell ending and the next page starting out to the signs, with
+	the next pages encoded during the dwell and without
+	'''
+	print "%d page changes on two signs at %d baud" % (pages, baud)
+	print "%-8s %10s %10s %19s %14s" % ("", "pages", "", "page gap (ms)", "")
+	print "%-8s %10s %10s %8s %10s %14s" % ("runtime", "ready", "gaps", "mean", "max",
+											"encodes/page")
+	for runtime in ['threads', 'async']:
+		for depth in [0, signctrl.MultiSignManager.PIPELINE_PAGES]:
+			histograms = _pipeline_run(runtime, depth, pages, baud)
+			gaps = histograms['display.page_gap']
+			encodes = histograms.get('serial.encode', {'count': 0})['count']
+			print "%-8s %10d %10d %s %10s %14.1f" % (runtime, depth, gaps['count'],
+													 _ms(gaps['mean']), _ms(gaps['max']).strip(),
+													 encodes / float(gaps['count'] + 1))
+
+
+class LegacyTwoSignManager(signctrl.TwoSignManager):
+	'''
+	A TwoSignManager that pages content the way it did before PageLayout, kept here for
+	comparison: lines as they come, scrolling any lower line over 13 characters
+	'''
+
+	def _laidOut(self, lines, variables):
+		return list(lines)
+
+	def _lineTransition(self, index, line):
+		if (index == 0) or (len(line) <= 13):
+			return LedSign.COMM_DISPLAY_MODE_HOLD
+		return LedSign.COMM_DISPLAY_MODE_ROLLLEFT
+
+
+def _layout_run(manager, lines):
+	'''
+	Lay lines out on a manager's two signs and return (secs to show them all, secs to lay them
+	out the first time, secs to lay them out again)
+	'''
+	started = time.time()
+	manager.setContent('\n'.join(lines))
+	first = time.time() - started
+	started = time.time()
+	manager.setContent('\n'.join(lines))
+	again = time.time() - started
+	content = manager._content
+	total = 0.0
+	for start in range(0, len(content) - 1, 2):
+		total += manager._pageDuration([manager._rendered(line, None)
+										for line in content[start:start + 2]])
+	return (total, first, again)
+
+
+def bench_layout(arrivals=40):
+	'''
+	Characters shown per minute for a transit feed paged the old way (scrolling lines over 13
+	characters) against PageLayout, and how long laying it out takes with and without the cache
+	'''
+	lines = []
+	for i in range(arrivals):
+		lines.extend(["Route %d" % (i + 1), ["%d min" % (i % 30 + 1), "Main St & 1st in %d min" %
+											 (i % 30 + 1), "Downtown via Main St %d min" % i][i % 3]])
+	chars = sum([len(line) for line in lines])
+	# nothing gets written, the signs are only there for their display settings
+	signctrl.logging.disable(signctrl.logging.WARNING)
+	signs = [LedSign('/dev/null-sign', False) for i in range(2)]
+	signctrl.logging.disable(signctrl.logging.NOTSET)
+	print "%d pages, %d characters, shown on two signs" % (arrivals, chars)
+	print "%-26s %10s %12s %12s %12s" % ("", "cycle", "", "layout", "cached")
+	print "%-26s %10s %12s %12s %12s" % ("setup", "(s)", "chars/min", "(us)", "(us)")
+	for speed, minSecs in [('2', '5'), ('5', '2')]:
+		config = _config(Communication_display_speed=speed, Communication_min_display_secs=minSecs)
+		for name, managerClass in [("legacy", LegacyTwoSignManager),
+								   ("PageLayout", signctrl.TwoSignManager)]:
+			manager = managerClass(config)
+			manager._assignSigns(signs)
+			total, first, again = _layout_run(manager, lines)
+			print "%-26s %10.1f %12.0f %12.0f %12.0f" % (
+				"%s, speed %s, %s s min" % (name, speed, minSecs), total, chars * 60 / total,
+				first * 1e6, again * 1e6)
+
+
+def _page_switches(sign, since):
+	'''
+	(when it reached the sign, page number) for each new page on a sign, from its since'th
+	frame on
+	'''
+	switches = []
+	for frame in sign.frames[since:]:
+		if frame.valid and (frame.command == 'A') and (frame.acked != None):
+			switches.append((frame.displayed, int(frame.data.split('Page ')[1].split()[0])))
+	return switches
+
+
+def _watch_pages(sign, since, secs, pages):
+	'''
+	Wait secs, then return the longest a page stayed up on a sign meanwhile (from its since'th
+	frame on) and whether the pages kept their order
+	'''
+	time.sleep(secs)
+	switches = _page_switches(sign, since)
+	longest = max([switches[i + 1][0] - switches[i][0] for i in range(len(switches) - 1)])
+	inOrder = len([i for i in range(len(switches) - 1)
+				   if switches[i + 1][1] != switches[i][1] % pages + 1]) == 0
+	return (longest, {True: "yes", False: "no"}[inOrder])
+
+
+def _start_client(directory):
+	return subprocess.Popen([sys.executable, os.path.join(ROOT, 'lib-sign-ctrl.py')],
+							cwd=directory)
+
+
+def bench_restart(restarts=3, pages=6, baud=9600):
+	'''
+	How long pages stay up on two emulated signs across a restart: normally, with the
+	in-process restart (SIGUSR1, same as the server's restart command) and with the old kill
+	and start over.  The client runs as its own process, showing a content.xml.
+	'''
+	directory = tempfile.mkdtemp()
+	signs = [SignEmulator(baud), SignEmulator(baud)]
+	for sign in signs:
+		sign.start()
+	statusPath = os.path.join(directory, 'status.json')
+	f = open(os.path.join(directory, 'config.ini'), 'w')
+	f.write('[Communication]\nserial_path_1=%s\nserial_path_2=%s\nmin_display_secs=2\n'
+			'secs_per_char=0.01\n[Server]\nhost=localhost\n[Debug]\nstatus_file=%s\n' % (
+				signs[0].portname,
+				signs[1].portname, statusPath))
+	f.close()
+	os.chdir(directory)
+	lines = []
+	for i in range(pages):
+		lines.extend(["Page %d" % (i + 1), "Stop %d in %d min" % (i, i % 9 + 1)])
+	_write_content('\n'.join(lines))
+	client = _start_client(directory)
+	try:
+		signs[0].waitForText("Page", 30, since=0)
+		print "%d pages held for 2 secs on two signs at %d baud" % (pages, baud)
+		print "%-20s %18s %14s %14s" % ("", "longest page (s)", "pages in order", "restart (ms)")
+		since = signs[0].frameCount()
+		longest, inOrder = _watch_pages(signs[0], since, 10, pages)
+		print "%-20s %18.2f %14s %14s" % ("no restart", longest, inOrder, "")
+		for i in range(restarts):
+			since = signs[0].frameCount()
+			time.sleep(1 + i * 0.7)		# land in a different part of a page each time
+			client.send_signal(signal.SIGUSR1)
+			longest, inOrder = _watch_pages(signs[0], since, 10, pages)
+			f = open(statusPath)
+			restart = json.load(f)['histograms'].get('restart.duration', {'max': None})['max']
+			f.close()
+			print "%-20s %18.2f %14s %14s" % ("in-process", longest, inOrder, _ms(restart).strip())
+		for i in range(restarts):
+			# what scripts/restart.sh does
+			since = signs[0].frameCount()
+			time.sleep(1 + i * 0.7)
+			client.kill()
+			client.wait()
+			time.sleep(5)
+			client = _start_client(directory)
+			longest, inOrder = _watch_pages(signs[0], since, 10, pages)
+			print "%-20s %18.2f %14s %14s" % ("kill -9 and start", longest, inOrder, "")
+	finally:
+		client.kill()
+		client.wait()
+		for sign in signs:
+			sign.stop()
+
+
+def _time_to_text(sign, client, started, timeout=20):
+	'''
+	Secs from started until the sign showed a route, or None if it didn't within timeout secs
+	'''
+	try:
+		frame = sign.waitForText("Route 1 ", timeout, since=sign.frameCount())
+	finally:
+		client.kill()
+		client.wait()
+	if frame == None:
+		return None
+	return frame.displayed - started
+
+
+def bench_boot(baud=9600):
+	'''
+	Time from starting the client to the first content on an emulated sign: with the server up,
+	then with it hung (as in an outage), with and without the content saved from last time.
+	The client runs as its own process.
+	'''
+	directory = tempfile.mkdtemp()
+	sign = SignEmulator(baud)
+	sign.start()
+	server = stub_server.StubServer(0).start()
+	server.setContent(transit_feed(4))
+	f = open(os.path.join(directory, 'config.ini'), 'w')
+	f.write('[Communication]\nserial_path=%s\n[Server]\nhost=localhost\nport=%d\n'
+			'[Debug]\nstatus_file=\n' % (sign.portname, server.getPort()))
+	f.close()
+	cachePath = os.path.join(directory, signctrl.CONTENT_CACHE_FILE)
+	print "%-30s %18s" % ("", "first content (s)")
+	try:
+		for name, delay, cached in [("server up, nothing saved", 0, False),
+									("server hung, content saved", 120, True),
+									("server hung, nothing saved", 120, False)]:
+			if not cached and os.path.exists(cachePath):
+				os.remove(cachePath)
+			server.setDelay(delay)
+			started = time.time()
+			secs = _time_to_text(sign, _start_client(directory), started)
+			if secs == None:
+				print "%-30s %18s" % (name, "not within 20")
+			else:
+				print "%-30s %18.2f" % (name, secs)
+	finally:
+		server.stop()
+		sign.stop()
+
+
+def _recover(sign, fake, files, variables, readback):
+	'''
+	Put files back on a sign that just lost power, rewriting everything or reading back what it
+	still has first - returns (frames, bytes, secs) and checks the sign shows it all again
+	'''
+	before = sign.getTrafficStats()
+	started = time.time()
+	if readback:
+		sign.suspect()
+	else:
+		sign.invalidateCache()
+	if not sign.writeFiles(files, variables):
+		print "The sign didn't take the files"
+		sys.exit(1)
+	secs = time.time() - started
+	after = sign.getTrafficStats()
+	for i in range(len(files)):
+		if fake.shownText(LedSign.COMM_TEXT_FILE_NAMES[i][0]) != "Route %d in %s min" % (
+				i + 1, variables[u'route%d' % (i + 1)]):
+			print "MISMATCH in file %d" % i
+			sys.exit(1)
+	if not fake.showingAllFiles:
+		print "MISMATCH, the sign isn't showing all its files"
+		sys.exit(1)
+	return (after['frames'] - before['frames'], after['bytes'] - before['bytes'], secs)
+
+
+def bench_readback(pages=12, baud=9600):
+	'''
+	Frames, bytes and time to put resident pages back on an emulated sign after it loses power,
+	rewriting them all blind against asking it what it still holds first, and the cost of a
+	status read as a liveness probe against rewriting one page
+	'''
+	fake = SignEmulator(baud)
+	fake.start()
+	sign = LedSign(fake.portname, config=_config(Communication_readback=1))
+	files = [(u"Route %d in {route%d} min" % (i + 1, i + 1), LedSign.COMM_DISPLAY_MODE_HOLD)
+			 for i in range(pages)]
+	variables = dict([(u'route%d' % (i + 1), str(i * 7 % 30 + 1)) for i in range(pages)])
+	sign.writeFiles(files, variables)
+	print "%d resident pages, each with an arrival time in a sign variable, at %d baud" % (
+		pages, baud)
+	print "%-28s %8s %8s %10s" % ("after a power blip", "frames", "bytes", "secs")
+	for name, keepFiles in [("files kept", True), ("files lost", False)]:
+		for strategy, readback in [("rewrite all", False), ("read back", True)]:
+			fake.powerBlip(keepFiles)
+			frames, bytes, secs = _recover(sign, fake, files, variables, readback)
+			print "%-28s %8d %8d %10.2f" % ("%s, %s" % (name, strategy), frames, bytes, secs)
+
+	before = sign.getTrafficStats()
+	started = time.time()
+	if not sign.probe():
+		print "The sign didn't answer the probe"
+		sys.exit(1)
+	probeSecs = time.time() - started
+	probeBytes = sign.getTrafficStats()['bytes'] - before['bytes']
+	before = sign.getTrafficStats()
+	sign.invalidateCache()
+	started = time.time()
+	sign.write(u"Route 1 in 5 min", LedSign.COMM_DISPLAY_MODE_HOLD, LedSign.COMM_TEXT_FILE_NAMES[0])
+	writeSecs = time.time() - started
+	writeBytes = sign.getTrafficStats()['bytes'] - before['bytes']
+	print "probe: %d bytes in %.0f ms, against %d bytes in %.0f ms to rewrite one page" % (
+		probeBytes, probeSecs * 1000, writeBytes, writeSecs * 1000)
+	fake.stop()
+
+
+def bench_push(publishes=3, baud=9600):
+	'''
+	Time from new content being published on the stub server to its first byte reaching an
+	emulated sign, with the client polling every 30 secs, long-polling, and long-polling a server
+	that doesn't hold requests (so it falls back to polling).  The client runs as its own
+	process.
+	'''
+	directory = tempfile.mkdtemp()
+	sign = SignEmulator(baud)
+	sign.start()
+	server = stub_server.StubServer(0).start()
+	print "%d publishes per setup, one sign at %d baud" % (publishes, baud)
+	print "%-24s %26s %10s" % ("", "publish -> first byte (ms)", "requests/")
+	print "%-24s %8s %8s %8s %10s" % ("setup", "min", "median", "max", "minute")
+	try:
+		for name, push, longPoll in [("polling", 0, True), ("long-poll", 1, True),
+									 ("long-poll, no support", 1, False)]:
+			f = open(os.path.join(directory, 'config.ini'), 'w')
+			f.write('[Communication]\nserial_path=%s\n[Server]\nhost=localhost\nport=%d\n'
+					'push=%d\ncontent_cache=\n[Debug]\nstatus_file=\n' % (sign.portname,
+																			server.getPort(), push))
+			f.close()
+			server.setLongPoll(longPoll)
+			server.setContent(_display_xml("Starting up"))
+			client = _start_client(directory)
+			latencies = []
+			try:
+				sign.waitForText("Starting up", 30, since=sign.frameCount())
+				time.sleep(2)
+				server.resetStats()
+				for i in range(publishes):
+					time.sleep(3 + i * 4.3)		# land at a different point between polls each time
+					since = sign.frameCount()
+					published = time.time()
+					server.setContent(_display_xml("Alert %d from %s" % (i, name)))
+					frame = sign.waitForText("Alert %d from" % i, 45, since=since)
+					if frame != None:
+						latencies.append(frame.firstByte - published)
+				stats = server.getStats()
+			finally:
+				client.kill()
+				client.wait()
+			latencies.sort()
+			if len(latencies) < publishes:
+				print "%-24s %d of %d publishes never showed up" % (name, publishes - len(latencies),
+																	 publishes)
+				continue
+			print "%-24s %s %s %s %10.1f" % (name, _ms(latencies[0]),
+											 _ms(latencies[len(latencies) / 2]),
+											 _ms(latencies[-1]), stats['requests_per_hour'] / 60)
+	finally:
+		server.stop()
+		sign.stop()
+
+
+def legacy_parse(msg):
+	'''
+	The minidom parsing SignController used before it streamed, kept here for comparison
+	'''
+	dom = xml.dom.minidom.parseString(msg)
+	info = ""
+	actions = []
+	if dom.documentElement.getAttribute("version") != signctrl.PROTOCOL_VERSION:
+		return None
+	for node in dom.getElementsByTagName("message"):
+		info = ""
+		for nodeA in node.getElementsByTagName("info"):
+			for nodeB in nodeA.childNodes:
+				if nodeB.nodeType == Node.TEXT_NODE:
+					info += nodeB.data
+	for node in dom.getElementsByTagName("commandlist"):
+		for nodeA in node.getElementsByTagName("command"):
+			for nodeB in nodeA.childNodes:
+				if nodeB.nodeType == Node.TEXT_NODE:
+					actions.append(nodeB.data)
+	return [info, actions]
+
+
+def _rss_kb(field):
+	'''
+	Current (VmRSS) or peak (VmHWM) resident memory of this process in KB, from /proc
+	'''
+	f = open('/proc/self/status')
+	try:
+		for line in f:
+			if line.startswith(field + ':'):
+				return int(line.split()[1])
+	finally:
+		f.close()
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _reset_peak_rss():
+	'''
+	Start VmHWM again from the current RSS, rather than the peak inherited from our parent
+	'''
+	try:
+		f = open('/proc/self/clear_refs', 'w')
+		try:
+			f.write('5')
+		finally:
+			f.close()
+	except IOError:
+		pass
+
+
+def _in_child(fn):
+	'''
+	Run fn in a forked process and return (its result, how far it pushed peak RSS up in KB), so
+	each measurement starts from the same memory footprint
+	'''
+	readEnd, writeEnd = os.pipe()
+	pid = os.fork()
+	if pid == 0:
+		os.close(readEnd)
+		_reset_peak_rss()
+		before = _rss_kb('VmRSS')
+		result = fn()
+		peak = _rss_kb('VmHWM') - before
+		os.write(writeEnd, repr((result, peak)))
+		os._exit(0)
+	os.close(writeEnd)
+	data = ''
+	while True:
+		chunk = os.read(readEnd, 4096)
+		if not chunk:
+			break
+		data += chunk
+	os.close(readEnd)
+	os.waitpid(pid, 0)
+	return eval(data)
+
+
+def bench_parse(repeat=3):
+	'''
+	Peak memory and parse time for the old minidom parse (read the body, build a DOM) against
+	the streaming parser, reading each response from a file the way it comes off the socket
+	'''
+	controller = _controller(0)
+	directory = tempfile.mkdtemp()
+	print "%8s %14s %14s %14s %14s" % ("size", "minidom (ms)", "stream (ms)", "minidom (KB)",
+									   "stream (KB)")
+	for size in [1024, 100 * 1024, 5 * 1024 * 1024]:
+		body = transit_feed(size / 45)
+		path = os.path.join(directory, "%d.xml" % size)
+		f = open(path, 'w')
+		f.write(body)
+		f.close()
+		del body
+
+		def legacy():
+			f = open(path)
+			try:
+				start = time.time()
+				info = legacy_parse(f.read())
+				return time.time() - start, len(info[0])
+			finally:
+				f.close()
+
+		def current():
+			f = open(path)
+			try:
+				start = time.time()
+				info = controller._parse_server_response(f)
+				return time.time() - start, len(info[0])
+			finally:
+				f.close()
+
+		results = []
+		for fn in [legacy, current]:
+			runs = [_in_child(fn) for i in range(repeat)]
+			results.append((min([run[0][0] for run in runs]) * 1000, min([run[1] for run in runs]),
+							runs[0][0][1]))
+		if results[0][2] != results[1][2]:
+			print "MISMATCH at %d bytes" % size
+			sys.exit(1)
+		print "%8s %14.1f %14.1f %14d %14d" % ("%dK" % (size / 1024), results[0][0], results[1][0],
+											   results[0][1], results[1][1])
+	_stop_controller(controller)
+
+
+BENCHMARKS = {
+	'boot': bench_boot,
+	'delta': bench_delta,
+	'e2e': bench_e2e,
+	'encoder': bench_encoder,
+	'fetch': bench_fetch,
+	'latency': bench_latency,
+	'layout': bench_layout,
+	'parse': bench_parse,
+	'pipeline': bench_pipeline,
+	'push': bench_push,
+	'readback': bench_readback,
+	'restart': bench_restart,
+	'text': bench_text,
+	'variables': bench_variables,
+}
+
+if __name__ == '__main__':
+	names = sys.argv[1:] or sorted(BENCHMARKS.keys())
+	for name in names:
+		if name not in BENCHMARKS:
+			print "Unknown benchmark '%s', pick from: %s" % (name, ', '.join(sorted(BENCHMARKS.keys())))
+			sys.exit(1)
+		print "== %s ==" % name
+		BENCHMARKS[name]()
@@ -0,0 +1,110 @@
+#!/usr/bin/python
+'''
+Measures how long a real sign takes to scroll lines across, and saves the scroll timing table
+MultiSignManager (TwoSignManager for two signs) uses to decide how long to leave each page up.
+For each display mode and speed it sends lines of a few lengths to the sign and you press Enter
+the moment each one has finished going by; it then fits a line through what you timed.  Run it from the top of the repo with the
+sign plugged in:
+
+	python scripts/calibrate_timing.py [config file] [timing file]
+
+The sign's port, pause time and timing file come from the [Communication] section of the config
+(config.ini by default).  Entries already in the timing file are kept unless they're measured
+again.
+'''
+
+import ConfigParser
+import imp
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the controller is a script with a dash in its name, so load it by path
+signctrl = imp.load_source('signctrl', os.path.join(ROOT, 'lib-sign-ctrl.py'))
+LedSign = signctrl.LedSign
+
+MODES = [('scroll left', LedSign.COMM_DISPLAY_MODE_ROLLLEFT)]
+SPEEDS = ['1', '2', '3', '4', '5']
+LENGTHS = [15, 30, 60]
+TRIALS = 2						# times each length is timed
+SAMPLE_CHARS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+
+
+def sampleText(length, trial):
+	'''
+	A line of length chars, different on every trial so the sign doesn't skip it as already sent
+	'''
+	chars = SAMPLE_CHARS[trial % len(SAMPLE_CHARS):] + SAMPLE_CHARS
+	return (chars * (length / len(chars) + 1))[:length]
+
+
+def timeLine(sign, text, displayMode):
+	'''
+	Show text on the sign and return the secs until the operator says it's done, or None if the
+	sign didn't take it
+	'''
+	raw_input("Press Enter to send a %d char line, then Enter again once it's gone by: " %
+			  len(text))
+	if not sign.write(text, displayMode):
+		print "The sign didn't acknowledge it"
+		return None
+	started = time.time()
+	raw_input()
+	return time.time() - started
+
+
+def calibrate(sign, parser, timing, displayMode, speed, pause):
+	'''
+	Time every sample length at this mode and speed, and fit the timing table entry for it
+	'''
+	parser.set('Communication', 'display_speed', speed)
+	sign.setConfig(signctrl.SignConfig(parser))
+	samples = []
+	for length in LENGTHS:
+		for trial in range(TRIALS):
+			secs = timeLine(sign, sampleText(length, len(samples)), displayMode)
+			if secs != None:
+				samples.append((length, secs))
+	if len(samples) < 2:
+		print "Not enough lines timed, skipping"
+		return
+	fixed, perChar = timing.calibrate(displayMode, speed, pause, samples)
+	print "%.2f secs + %.3f secs per char" % (fixed, perChar)
+
+
+if __name__ == '__main__':
+	configPath = os.path.join(ROOT, 'config.ini')
+	if len(sys.argv) > 1:
+		configPath = sys.argv[1]
+	parser = ConfigParser.ConfigParser()
+	parser.read(configPath)
+	if not parser.has_section('Communication'):
+		parser.add_section('Communication')
+	try:
+		config = signctrl.SignConfig(parser)
+	except ValueError, e:
+		print "Bad setting in %s: %s" % (configPath, e)
+		sys.exit(1)
+	timingFile = config.timingFile or signctrl.MultiSignManager.TIMING_FILE
+	if len(sys.argv) > 2:
+		timingFile = sys.argv[2]
+	portname = config.serialPaths[0]
+	sign = LedSign(portname, True, config)
+	if not sign.isWorking():
+		print "Couldn't open the sign on %s" % portname
+		sys.exit(1)
+	pause = sign.displaySettings()[1]
+
+	timing = signctrl.ScrollTimingModel()
+	timing.load(timingFile)
+	try:
+		for name, displayMode in MODES:
+			for speed in SPEEDS:
+				print "Timing %s at speed %s" % (name, speed)
+				calibrate(sign, parser, timing, displayMode, speed, pause)
+	except (KeyboardInterrupt, EOFError):
+		print
+	timing.save(timingFile)
+	print "Saved the scroll timings to %s" % timingFile
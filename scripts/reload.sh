@@ -0,0 +1,4 @@
+#!/bin/sh
+# make the running client read config.ini again, without restarting it
+prid=$(pidof python2.6 lib-sign-ctrl.py)
+kill -HUP $prid
@@ -0,0 +1,278 @@
+#!/usr/bin/python
+'''
+Plays back a trace the client recorded (set trace_file in the [Debug] section of config.ini),
+so a change to the fetch, parse, page and serial path can be timed against the same content
+and the same timing every time.  Run it from the top of the repo:
+
+	python scripts/replay_trace.py summary <trace>
+	python scripts/replay_trace.py replay <trace> <new trace> [speed] [config file]
+	python scripts/replay_trace.py compare <trace> <other trace>
+
+replay starts scripts/stub_server.py and an emulated sign (scripts/sign_emulator.py) for each
+serial port in the trace, then runs a SignController against them.  At the time each response
+was recorded (sped up by speed, 1 by default) the stub server is given the content that response
+had and the controller fetches it (a response that was an error plays back as no change).  The
+replay records its own trace, so compare it with the original, or with a replay of the same
+trace from another version of the client.  The other settings come from the config file
+(config.ini by default), but the replay always uses the threaded runtime and doesn't long-poll.
+
+summary and compare report the serial throughput, how long the signs took to ack, and how long
+new content took to start going out to the signs.
+'''
+
+import ConfigParser
+import gzip
+import imp
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import zlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'scripts'))
+
+import stub_server
+from sign_emulator import SignEmulator
+
+# the controller is a script with a dash in its name, so load it by path
+signctrl = imp.load_source('signctrl', os.path.join(ROOT, 'lib-sign-ctrl.py'))
+
+DEFAULT_BAUD = 9600
+SETTLE_SECS = 2					# secs to let the signs finish after the last recorded event
+
+
+def readTrace(path):
+	'''
+	Load the events in a trace, in order, with each run's times moved on so they carry on from
+	the first run's start, and every content event given its body.  A trace cut off by a crash
+	is read up to where it stops.
+	'''
+	events = []
+	first = None
+	offset = 0
+	bodies = []
+	f = gzip.open(path, 'rb')
+	try:
+		while True:
+			try:
+				line = f.readline()
+			except (IOError, EOFError, zlib.error):
+				break
+			if not line:
+				break
+			try:
+				event = json.loads(line)
+			except ValueError:
+				break		# the last line of a crashed run
+			if event['e'] == 'start':
+				if first == None:
+					first = event['at']
+				offset = event['at'] - first
+				bodies = []
+			event['t'] = event['t'] + offset
+			if event['e'] == 'content':
+				if 'body' in event:
+					event['body'] = event['body'].encode('latin-1')
+					bodies.append(event['body'])
+				else:
+					event['body'] = bodies[event['ref']]
+			elif event['e'] == 'frame':
+				event['frame'] = event['frame'].encode('latin-1')
+				if 'reply' in event:
+					event['reply'] = event['reply'].encode('latin-1')
+			events.append(event)
+	finally:
+		f.close()
+	return events
+
+
+def _percentile(values, fraction):
+	if len(values) == 0:
+		return None
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summarize(events):
+	'''
+	The numbers to compare runs by, as a list of (name, value) with None for a value there
+	was nothing to work out from
+	'''
+	responses = [event for event in events if event['e'] == 'response']
+	frames = [event for event in events if event['e'] == 'frame']
+	duration = 0
+	if len(events) > 0:
+		duration = max(events[-1]['t'] - events[0]['t'], 0.001)
+	frameBytes = sum([len(event['frame']) for event in frames])
+	ackSecs = [event['secs'] for event in frames if event['ack']]
+
+	# how long from new content arriving to the first frame after it going out
+	changes = []
+	last = None
+	for event in events:
+		if event['e'] == 'content' and event['body'] != last:
+			changes.append(event['t'])
+			last = event['body']
+	firstFrames = []
+	frameTimes = sorted([event['t'] for event in frames])
+	for changed in changes:
+		later = [t for t in frameTimes if t >= changed]
+		if len(later) > 0:
+			firstFrames.append(later[0] - changed)
+
+	def ms(value):
+		if value == None:
+			return None
+		return value * 1000
+	return [('duration (s)', duration),
+			('responses', len(responses)),
+			('not modified', len([event for event in responses if event['status'] == 304])),
+			('content changes', len(changes)),
+			('frames', len(frames)),
+			('bytes', frameBytes),
+			('frames/min', len(frames) * 60.0 / duration),
+			('bytes/min', frameBytes * 60.0 / duration),
+			('ack failures', len([event for event in frames if not event['ack']])),
+			('ack p50 (ms)', ms(_percentile(ackSecs, 0.5))),
+			('ack p95 (ms)', ms(_percentile(ackSecs, 0.95))),
+			('content -> frame p50 (ms)', ms(_percentile(firstFrames, 0.5))),
+			('content -> frame p95 (ms)', ms(_percentile(firstFrames, 0.95)))]
+
+
+def _format(value):
+	if value == None:
+		return '-'
+	if isinstance(value, float):
+		return "%.1f" % value
+	return str(value)
+
+
+def printSummary(path):
+	for name, value in summarize(readTrace(path)):
+		print "%-28s %12s" % (name, _format(value))
+
+
+def printComparison(pathA, pathB):
+	summaryA = summarize(readTrace(pathA))
+	summaryB = summarize(readTrace(pathB))
+	print "%-28s %12s %12s %10s" % ("", "A", "B", "B vs A")
+	for i in range(len(summaryA)):
+		name, valueA = summaryA[i]
+		valueB = summaryB[i][1]
+		change = ''
+		if (valueA != None) and (valueB != None) and (valueA != 0):
+			change = "%+.1f%%" % ((valueB - valueA) * 100.0 / valueA)
+		print "%-28s %12s %12s %10s" % (name, _format(valueA), _format(valueB), change)
+	print "A is %s, B is %s" % (pathA, pathB)
+
+
+def _replayConfig(configPath, ports, serverPort, tracePath):
+	'''
+	The settings from configPath, pointed at the emulated signs and the stub server
+	'''
+	parser = ConfigParser.ConfigParser()
+	parser.read(configPath)
+	for section in ['Communication', 'Server', 'Debug']:
+		if not parser.has_section(section):
+			parser.add_section(section)
+	for option in parser.options('Communication'):
+		if option.startswith('serial_path'):
+			parser.remove_option('Communication', option)
+	for i in range(len(ports)):
+		parser.set('Communication', 'serial_path_%d' % (i + 1), ports[i])
+	parser.set('Communication', 'write_to_serial', '1')
+	parser.set('Communication', 'runtime', 'threaded')
+	parser.set('Server', 'host', 'localhost')
+	parser.set('Server', 'port', str(serverPort))
+	parser.set('Server', 'push', '0')
+	parser.set('Server', 'content_cache', '')
+	parser.set('Debug', 'status_file', '')
+	parser.set('Debug', 'trace_file', tracePath)
+	return signctrl.SignConfig(parser)
+
+
+def replay(path, newPath, speed=1.0, configPath=None, baud=DEFAULT_BAUD):
+	'''
+	Play the trace at path back through a SignController, recording to newPath
+	'''
+	events = readTrace(path)
+	starts = [event for event in events if event['e'] == 'start']
+	if len(starts) == 0:
+		print "%s has nothing in it" % path
+		sys.exit(1)
+	newPath = os.path.abspath(newPath)
+	if os.path.exists(newPath):
+		os.remove(newPath)
+	configPath = os.path.abspath(configPath or os.path.join(ROOT, 'config.ini'))
+
+	signs = [SignEmulator(baud) for port in (starts[0]['ports'] or [None])]
+	for sign in signs:
+		sign.start()
+	server = stub_server.StubServer(0).start()
+	# the controller prefers a local content.xml, so run from somewhere without one
+	os.chdir(tempfile.mkdtemp())
+	config = _replayConfig(configPath, [sign.portname for sign in signs], server.getPort(),
+						   newPath)
+	logging.disable(logging.WARNING)
+
+	# each response the controller got, with the content it had (None if it had none)
+	fetches = []
+	for event in events:
+		if event['e'] == 'response':
+			fetches.append([event['t'], event['status'], None])
+		elif (event['e'] == 'content') and (len(fetches) > 0):
+			fetches[-1][2] = event['body']
+	print "Replaying %d responses and %d frames from %s at %gx" % (
+		len(fetches), len([event for event in events if event['e'] == 'frame']), path, speed)
+
+	started = time.time()
+	firstAt = events[0]['t']
+	server.setContent(fetches[0][2] or '')
+	controller = signctrl.SignController(config)
+	try:
+		for at, status, body in fetches:
+			wait = started + (at - firstAt) / speed - time.time()
+			if wait > 0:
+				time.sleep(wait)
+			if body != None:
+				server.setContent(body)
+			controller.update()
+		wait = started + (events[-1]['t'] - firstAt) / speed + SETTLE_SECS - time.time()
+		if wait > 0:
+			time.sleep(wait)
+	finally:
+		# let the signs finish what they're on, so nothing is cut off at exit
+		controller._signMgr.hold()
+		controller._signMgr.waitForHold(controller.DRAIN_TIMEOUT)
+		controller._signMgr.stop()
+		controller._close_connection()
+		signctrl.trace.close()
+		server.stop()
+		for sign in signs:
+			sign.stop()
+	print "Recorded the replay to %s" % newPath
+
+
+if __name__ == '__main__':
+	if len(sys.argv) < 3:
+		print __doc__
+		sys.exit(1)
+	command = sys.argv[1]
+	if command == 'summary':
+		printSummary(sys.argv[2])
+	elif command == 'compare' and len(sys.argv) > 3:
+		printComparison(sys.argv[2], sys.argv[3])
+	elif command == 'replay' and len(sys.argv) > 3:
+		speed = 1.0
+		if len(sys.argv) > 4:
+			speed = float(sys.argv[4])
+		configPath = None
+		if len(sys.argv) > 5:
+			configPath = sys.argv[5]
+		replay(sys.argv[2], sys.argv[3], speed, configPath)
+	else:
+		print __doc__
+		sys.exit(1)
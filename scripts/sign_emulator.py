@@ -0,0 +1,377 @@
+#!/usr/bin/python
+'''
+A software MovingSign (v2.1 protocol) on a pseudo-terminal, for running the client without a
+real sign.  It parses every frame the client sends, checks the checksum, keeps the text files
+and variables it was sent, and answers with the EOT/SOH ack, or for a status read, with EOT and
+a frame listing what it holds.  It can also act like a real sign on a slow line: taking 10 bits
+per byte at 9600 baud to receive a frame, being slow to ack, dropping acks now and then, losing
+power for a moment, or being unplugged.  Run it from the top of the repo:
+
+	python scripts/sign_emulator.py [baud]
+
+then set serial_path in the [Communication] section of config.ini to the port it prints.
+'''
+
+import os
+import pty
+import random
+import select
+import sys
+import threading
+import time
+import tty
+
+DEFAULT_BAUD = 9600
+BITS_PER_BYTE = 10				# 8N1: a start bit, 8 data bits and a stop bit
+POLL_INTERVAL = 0.1				# secs between checks for stop() while waiting for bytes
+
+NUL = '\x00'
+SOH = '\x01'
+STX = '\x02'
+ETX = '\x03'
+EOT = '\x04'
+
+CMD_WRITE_TEXT = 'A'
+CMD_WRITE_VAR = 'C'
+CMD_WRITE_SPECIAL = 'W'
+CMD_READ_SPECIAL = 'R'
+
+SPECIAL_DISPLAY_MODE = 'F'
+SPECIAL_CLEAR_ALL = 'L'
+READ_STATUS = 'S'
+REPLY_ADDRESS = '00FF'			# from us to the PC
+
+# bytes in a write text frame between the file name and the text: display mode, speed, pause,
+# show date (2), start time (4), end time (4), preparative (3) and alignment
+TEXT_ATTRIBUTES_LENGTH = 17
+TEXT_CONTROL = '\xfe\xfd'		# font and colour codes, each followed by one byte
+VARIABLE_REFERENCE = '\xfb'		# followed by the variable name
+
+
+class SignFrame:
+	'''
+	One frame the emulator received, with when it arrived, showed and was acked
+	'''
+
+	def __init__(self, command, data, length, firstByte):
+		self.command = command		# the command code, eg. 'A' for write text
+		self.data = data			# everything between the command code and <ETX>
+		self.length = length		# bytes in the whole frame, <NUL>s to <EOT>
+		self.firstByte = firstByte	# when its first byte arrived
+		self.received = None		# when its last byte arrived
+		self.displayed = None		# when a sign at our baud rate would have all of it
+		self.acked = None			# when we finished acking it (None if we didn't)
+		self.valid = False			# if the checksum matched
+		self.checksum = None		# the checksum it was sent with, as 4 hex digits
+
+
+class SignEmulator(threading.Thread):
+	'''
+	The emulated sign - use start() to run it in a background thread, then open portname
+	'''
+
+	def __init__(self, baud=DEFAULT_BAUD, ackDelay=0, commandDelay=0, dropAcks=0, seed=None,
+				 readback=True):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self._master, self._slave = pty.openpty()
+		tty.setraw(self._slave)
+		self.portname = os.ttyname(self._slave)
+		self._baud = baud					# None to take frames in as fast as they come
+		self._ackDelay = ackDelay			# secs to wait before acking a frame
+		self._commandDelay = commandDelay	# extra secs a special function command takes
+		self._dropAcks = dropAcks			# chance of not acking a good frame at all
+		self._readback = readback			# False to ack a status read like any other frame
+		self._random = random.Random(seed)
+		self._cond = threading.Condition()
+		self._stopped = False
+		self._buffer = ''
+		self._frameStart = None
+		self.frames = []			# every SignFrame we've received, in order
+		self.files = {}				# text file name -> (display mode, text)
+		self.variables = {}			# variable name -> value
+		self.checksums = {}			# ('T', file name) or ('V', variable name) -> checksum of the
+									# frame that wrote it
+		self.showingAllFiles = False
+		self.resetStats()
+
+	def resetStats(self):
+		with self._cond:
+			self.frames = []
+			self._stats = {'frames': 0, 'bytes': 0, 'bad_checksums': 0, 'dropped_acks': 0,
+						   'junk_bytes': 0}
+
+	def getStats(self):
+		with self._cond:
+			return dict(self._stats)
+
+	def setAckDelay(self, secs):
+		self._ackDelay = secs
+
+	def setDropAcks(self, chance):
+		self._dropAcks = chance
+
+	def powerBlip(self, keepFiles=True):
+		'''
+		Act like the sign lost power for a moment, without the port going away: the variables
+		and the setting to show every file are lost, and the text files too unless keepFiles
+		'''
+		with self._cond:
+			self.variables = {}
+			self.showingAllFiles = False
+			if not keepFiles:
+				self.files = {}
+			self.checksums = dict([(key, checksum) for key, checksum in self.checksums.items()
+								   if (key[0] == 'T') and keepFiles])
+
+	def run(self):
+		while not self._stopped:
+			try:
+				ready = select.select([self._master], [], [], POLL_INTERVAL)[0]
+				if not ready:
+					continue
+				data = os.read(self._master, 4096)
+			except (OSError, select.error, ValueError):
+				break
+			if not data:
+				break
+			self._received(data)
+
+	def stop(self):
+		'''
+		Stop answering, but leave the port open.  Waits for the thread to finish what it's on, so
+		it isn't left to run into interpreter exit.
+		'''
+		self._stopped = True
+		if self.is_alive() and (threading.current_thread() is not self):
+			self.join()
+
+	def disconnect(self):
+		'''
+		Act like the sign was unplugged: the port goes away under the client
+		'''
+		self._stopped = True
+		for fd in [self._master, self._slave]:
+			try:
+				os.close(fd)
+			except OSError:
+				pass
+
+	def _received(self, data):
+		'''
+		Add bytes to what we've got so far and handle every whole frame in there
+		'''
+		now = time.time()
+		if self._frameStart == None:
+			self._frameStart = now
+		self._buffer += data
+		while True:
+			frame = self._nextFrame(now)
+			if frame == None:
+				break
+			self._handle(frame)
+		if len(self._buffer) == 0:
+			self._frameStart = None
+
+	def _nextFrame(self, now):
+		'''
+		Take the first whole frame off the buffer, or return None if there isn't one yet.  Bytes
+		before a frame's <SOH> are thrown away (the <NUL>s that start a frame included).
+		'''
+		start = self._buffer.find(SOH)
+		if start < 0:
+			self._skip(len(self._buffer.replace(NUL, '')), len(self._buffer))
+			return None
+		self._skip(len(self._buffer[:start].replace(NUL, '')), start)
+		# <SOH>, send and receiver addresses, <STX>, command code ... <ETX>, <NUL>, checksum, <EOT>
+		if len(self._buffer) < 6:
+			return None
+		if self._buffer[5] != STX:
+			self._skip(1, 1)
+			return self._nextFrame(now)
+		end = self._buffer.find(ETX, 6)
+		if (end < 0) or (len(self._buffer) < end + 7):
+			return None
+		payload = self._buffer[5:end + 1]
+		checksum = self._buffer[end + 2:end + 6]
+		if self._buffer[end + 6] != EOT:
+			self._skip(1, 1)
+			return self._nextFrame(now)
+		frame = SignFrame(payload[1], payload[2:-1], end + 7 + 5, self._frameStart)
+		frame.received = now
+		frame.valid = checksum == ("%0.4X" % sum([ord(c) for c in payload]))
+		frame.checksum = checksum
+		self._buffer = self._buffer[end + 7:]
+		self._frameStart = now
+		return frame
+
+	def _skip(self, junk, count):
+		if junk > 0:
+			with self._cond:
+				self._stats['junk_bytes'] += junk
+		self._buffer = self._buffer[count:]
+
+	def _handle(self, frame):
+		'''
+		Take in a frame like the sign would, then ack it
+		'''
+		if self._baud != None:
+			frame.displayed = frame.firstByte + frame.length * BITS_PER_BYTE / float(self._baud)
+			wait = frame.displayed - time.time()
+			if wait > 0:
+				time.sleep(wait)
+		else:
+			frame.displayed = time.time()
+		with self._cond:
+			self.frames.append(frame)
+			self._stats['frames'] += 1
+			self._stats['bytes'] += frame.length
+			if not frame.valid:
+				# a real sign ignores a frame with a bad checksum, so the client times out
+				self._stats['bad_checksums'] += 1
+				self._cond.notifyAll()
+				return
+			self._apply(frame)
+			dropped = self._random.random() < self._dropAcks
+			if dropped:
+				self._stats['dropped_acks'] += 1
+			self._cond.notifyAll()
+		if dropped:
+			return
+		if self._ackDelay > 0:
+			time.sleep(self._ackDelay)
+		self._write(EOT)
+		if (frame.command == CMD_WRITE_SPECIAL) and (self._commandDelay > 0):
+			time.sleep(self._commandDelay)
+		if (frame.command == CMD_READ_SPECIAL) and (frame.data == READ_STATUS) and self._readback:
+			self._write(self._statusReply())
+		else:
+			self._write(SOH)
+		with self._cond:
+			frame.acked = time.time()
+			self._cond.notifyAll()
+
+	def _write(self, data):
+		try:
+			os.write(self._master, data)
+		except OSError:
+			pass
+
+	def _apply(self, frame):
+		'''
+		Update what the sign holds from a frame - call with _cond held
+		'''
+		if frame.command == CMD_WRITE_TEXT:
+			fileName = frame.data[0]
+			displayMode = frame.data[1]
+			text = frame.data[1 + TEXT_ATTRIBUTES_LENGTH:]
+			while (len(text) > 1) and (text[0] in TEXT_CONTROL):
+				text = text[2:]
+			self.files[fileName] = (displayMode, text)
+			self.checksums[('T', fileName)] = frame.checksum
+		elif frame.command == CMD_WRITE_VAR:
+			self.variables[frame.data[0]] = frame.data[1:]
+			self.checksums[('V', frame.data[0])] = frame.checksum
+		elif frame.command == CMD_WRITE_SPECIAL:
+			if frame.data[0] == SPECIAL_CLEAR_ALL:
+				self.files = {}
+				self.checksums = dict([(key, checksum) for key, checksum in self.checksums.items()
+									   if key[0] != 'T'])
+				self.showingAllFiles = False
+			elif frame.data[0] == SPECIAL_DISPLAY_MODE:
+				self.showingAllFiles = frame.data[1:2] == 'A'
+
+	def _statusReply(self):
+		'''
+		The frame we answer a status read with: whether we show every file, then the kind, name
+		and checksum of every text file and variable we hold.  This is the layout
+		LedSign.parseStatus expects, not one checked against a real sign.
+		'''
+		with self._cond:
+			showing = '-'
+			if self.showingAllFiles:
+				showing = 'A'
+			data = CMD_READ_SPECIAL + READ_STATUS + showing
+			for key in sorted(self.checksums.keys()):
+				data += key[0] + key[1] + self.checksums[key]
+		payload = STX + data + ETX
+		return SOH + REPLY_ADDRESS + payload + NUL + ("%0.4X" % sum([ord(c) for c in payload])) + EOT
+
+	def shownText(self, fileName='0'):
+		'''
+		Public method to return the text in a file as the sign would show it, with the variables
+		filled in (None if there's no such file)
+		'''
+		with self._cond:
+			if fileName not in self.files:
+				return None
+			text = self.files[fileName][1]
+			parts = text.split(VARIABLE_REFERENCE)
+			shown = parts[0]
+			for part in parts[1:]:
+				shown += self.variables.get(part[:1], '') + part[1:]
+			return shown
+
+	def frameCount(self):
+		'''
+		Public method to return how many frames we've received, to pass to waitFor as since
+		'''
+		with self._cond:
+			return len(self.frames)
+
+	def waitFor(self, test, timeout, since=None):
+		'''
+		Public method to block until test(frame) is true for a frame received after the first
+		since frames (from now on if since is None), or until timeout secs pass - returns that
+		frame, or None
+		'''
+		deadline = time.time() + timeout
+		with self._cond:
+			seen = since
+			if seen == None:
+				seen = len(self.frames)
+			while True:
+				for frame in self.frames[seen:]:
+					if test(frame):
+						return frame
+				seen = len(self.frames)
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					return None
+				self._cond.wait(remaining)
+
+	def waitForText(self, text, timeout, fileName='0', since=None):
+		'''
+		Public method to block until the sign shows text (or something containing it) in a
+		file - returns the frame that did it, or None if it doesn't within timeout secs
+		'''
+		return self.waitFor(lambda frame: frame.valid and frame.command != CMD_WRITE_SPECIAL and
+							text in (self.shownText(fileName) or ''), timeout, since)
+
+
+def formatFrame(frame):
+	state = 'acked'
+	if not frame.valid:
+		state = 'BAD CHECKSUM'
+	elif frame.acked == None:
+		state = 'not acked'
+	return "%s %-12s %4d bytes %r" % (frame.command, state, frame.length, frame.data[:60])
+
+
+if __name__ == '__main__':
+	baud = DEFAULT_BAUD
+	if len(sys.argv) > 1:
+		baud = int(sys.argv[1])
+	sign = SignEmulator(baud)
+	sign.start()
+	print "Emulating a sign at %d baud on %s" % (baud, sign.portname)
+	shown = 0
+	try:
+		while True:
+			time.sleep(POLL_INTERVAL)
+			frames = sign.frames
+			for frame in frames[shown:]:
+				print formatFrame(frame)
+			shown = len(frames)
+	except KeyboardInterrupt:
+		print sign.getStats()
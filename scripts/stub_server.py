@@ -0,0 +1,393 @@
+#!/usr/bin/python
+'''
+A stand-in for the Community Sign Server, for testing the client without a real server.  It
+serves one XML file (content.xml by default) to every GET, with keep-alive, ETag/Last-Modified
+and 304 Not Modified support, and counts the connections and bytes it sees so you can check
+how much traffic a sign would use per hour.  It also long-polls like a server that pushes: a
+GET with wait=<secs> in its query string and an If-None-Match for the current content is held
+until the content changes (edit the file to publish) or the secs run out.  It gzips (or
+deflates) what it sends if the client accepts that, and answers an A-IM: lines request with a
+226 IM Used delta against the version the client has, if it still remembers that one.  Run it
+from the top of the repo:
+
+	python scripts/stub_server.py [port] [content file]
+
+then point the [Server] section of config.ini at it (host=localhost, port=8080 by default)
+and delete or rename content.xml so the client actually fetches.
+'''
+
+import BaseHTTPServer
+import SocketServer
+import base64
+import difflib
+import email.utils
+import hashlib
+import os
+import socket
+import sys
+import threading
+import time
+import urlparse
+import zlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_PORT = 8080
+DEFAULT_CONTENT = os.path.join(ROOT, 'content.xml')
+REPORT_INTERVAL = 60			# secs between stats lines when run from the command line
+FILE_CHECK_INTERVAL = 0.5		# secs between checks of the content file while holding a long-poll
+HISTORY_SIZE = 8				# versions of the content to remember, to send deltas against
+DELTA_FORMAT = 'lines'			# the only delta we know, see makeDelta
+
+
+def lines(text):
+	'''
+	Split text into lines, each keeping its newline (the last one may not have one)
+	'''
+	result = [line + '\n' for line in text.split('\n')]
+	result[-1] = result[-1][:-1]
+	if result[-1] == '':
+		result.pop()
+	return result
+
+
+def makeDelta(old, new):
+	'''
+	A "lines" delta that turns old into new: =N copies the next N lines of old, -N skips them,
+	and +N is followed by N new lines to put in
+	'''
+	a = lines(old)
+	b = lines(new)
+	delta = []
+	for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, a, b, False).get_opcodes():
+		if tag == 'equal':
+			delta.append('=%d\n' % (i2 - i1))
+			continue
+		if i2 > i1:
+			delta.append('-%d\n' % (i2 - i1))
+		if j2 > j1:
+			delta.append('+%d\n' % (j2 - j1))
+			delta.extend(b[j1:j2])
+	return ''.join(delta)
+
+
+class CountingFile:
+	'''
+	Wraps a socket file object to count the bytes that go through it
+	'''
+
+	def __init__(self, f, count):
+		self._f = f
+		self._count = count		# called with the number of bytes read or written
+
+	def read(self, *args):
+		data = self._f.read(*args)
+		self._count(len(data))
+		return data
+
+	def readline(self, *args):
+		data = self._f.readline(*args)
+		self._count(len(data))
+		return data
+
+	def write(self, data):
+		self._count(len(data))
+		return self._f.write(data)
+
+	def __getattr__(self, name):
+		return getattr(self._f, name)
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	'''
+	One of these handles each connection, so keep-alive clients reuse the same one
+	'''
+
+	protocol_version = 'HTTP/1.1'
+
+	def setup(self):
+		BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+		self.server.count('connections')
+		self.rfile = CountingFile(self.rfile, lambda n: self.server.count('bytes_in', n))
+		self.wfile = CountingFile(self.wfile, lambda n: self.server.count('bytes_out', n))
+
+	def do_GET(self):
+		self.server.count('requests')
+		self.server.delay()
+		wait = urlparse.parse_qs(urlparse.urlparse(self.path).query).get('wait')
+		if wait != None:
+			body, etag, lastModified = self.server.waitForChange(self.headers.get('If-None-Match'),
+																 float(wait[0]))
+		else:
+			body, etag, lastModified = self.server.getContent()
+		if self.headers.get('If-None-Match') == etag:
+			self.server.count('not_modified')
+			self.send_response(304)
+			self.send_header('ETag', etag)
+			self.end_headers()
+			return
+		status = 200
+		headers = [('ETag', etag), ('Last-Modified', lastModified)]
+		base = None
+		if DELTA_FORMAT in [im.strip() for im in self.headers.get('A-IM', '').split(',')]:
+			base = self.server.getVersion(self.headers.get('If-None-Match'))
+		if base != None:
+			self.server.count('deltas')
+			status = 226
+			headers.extend([('IM', DELTA_FORMAT), ('Delta-Base', self.headers.get('If-None-Match')),
+							('Digest', 'md5=' + base64.b64encode(hashlib.md5(body).digest()))])
+			body = makeDelta(base, body)
+		else:
+			self.server.count('full')
+		encoding = self.server.encodingFor(self.headers.get('Accept-Encoding', ''))
+		if encoding == 'gzip':
+			compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+			body = compressor.compress(body) + compressor.flush()
+		elif encoding == 'deflate':
+			body = zlib.compress(body, 9)
+		if encoding != None:
+			headers.append(('Content-Encoding', encoding))
+		self.send_response(status, {200: 'OK', 226: 'IM Used'}[status])
+		self.send_header('Content-Type', 'text/xml')
+		self.send_header('Content-Length', str(len(body)))
+		for name, value in headers:
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	'''
+	The server itself - use start() to run it in a background thread from a test or benchmark
+	'''
+
+	daemon_threads = True
+	allow_reuse_address = True
+
+	COUNTERS = ['connections', 'requests', 'full', 'deltas', 'not_modified', 'held', 'bytes_in',
+				'bytes_out']
+
+	def __init__(self, port=DEFAULT_PORT, contentPath=DEFAULT_CONTENT):
+		BaseHTTPServer.HTTPServer.__init__(self, ('', port), StubHandler)
+		self._lock = threading.Lock()
+		self._contentPath = contentPath
+		self._content = None		# (body, etag, last modified) set with setContent
+		self._delay = 0
+		self._longPoll = True
+		self._compression = True
+		self._deltas = True
+		self._history = []			# (etag, body) for the last few versions of the content, newest last
+		self._changed = threading.Condition()
+		self._version = 0			# bumped by setContent, under _changed
+		self._stopping = False		# set by stop, to let go of held long-polls
+		self._requests = []			# (thread, socket) for each connection being handled
+		self.resetStats()
+
+	def start(self):
+		thread = threading.Thread(target=self.serve_forever)
+		thread.daemon = True
+		thread.start()
+		return self
+
+	def process_request(self, request, clientAddress):
+		'''
+		Overloaded to handle each connection in a thread we keep track of, for stop
+		'''
+		thread = threading.Thread(target=self.process_request_thread,
+								  args=(request, clientAddress))
+		thread.daemon = True
+		with self._lock:
+			self._requests = [(t, r) for t, r in self._requests if t.is_alive()]
+			self._requests.append((thread, request))
+		thread.start()
+
+	def stop(self):
+		'''
+		Stop serving (after start), close every connection still open and wait for the threads
+		handling them to finish, so none of them is left to run into interpreter exit
+		'''
+		self.shutdown()
+		self.server_close()
+		with self._changed:
+			self._stopping = True
+			self._changed.notifyAll()
+		with self._lock:
+			requests = self._requests
+			self._requests = []
+		for thread, request in requests:
+			try:
+				request.shutdown(socket.SHUT_RDWR)
+			except socket.error:
+				pass
+		for thread, request in requests:
+			thread.join()
+
+	def handle_error(self, request, clientAddress):
+		# a client going away (killed while we held its long-poll, say) isn't worth a traceback
+		if isinstance(sys.exc_info()[1], socket.error):
+			return
+		BaseHTTPServer.HTTPServer.handle_error(self, request, clientAddress)
+
+	def getPort(self):
+		return self.server_address[1]
+
+	def setContent(self, body):
+		'''
+		Serve this body from now on, instead of the content file
+		'''
+		with self._lock:
+			self._content = (body, '"%s"' % hashlib.md5(body).hexdigest(),
+							 email.utils.formatdate(usegmt=True))
+		with self._changed:
+			self._version = self._version + 1
+			self._changed.notifyAll()
+
+	def setDelay(self, secs):
+		'''
+		Make every request take at least this long to answer
+		'''
+		self._delay = secs
+
+	def setCompression(self, enabled):
+		'''
+		Compress what we send to clients that accept it (the default), or never
+		'''
+		self._compression = enabled
+
+	def setDeltas(self, enabled):
+		'''
+		Send deltas to clients that ask for them (the default), or always send it all
+		'''
+		self._deltas = enabled
+
+	def encodingFor(self, acceptEncoding):
+		'''
+		The Content-Encoding to send with, from a request's Accept-Encoding (None for none)
+		'''
+		if not self._compression:
+			return None
+		accepted = [encoding.split(';')[0].strip().lower() for encoding in acceptEncoding.split(',')]
+		for encoding in ['gzip', 'deflate']:
+			if encoding in accepted:
+				return encoding
+		return None
+
+	def getVersion(self, etag):
+		'''
+		The body of an older version of the content, to send a delta against, or None if we
+		don't remember that one (or don't do deltas)
+		'''
+		if not self._deltas:
+			return None
+		with self._lock:
+			for versionEtag, body in self._history:
+				if versionEtag == etag:
+					return body
+		return None
+
+	def _remember(self, body, etag):
+		with self._lock:
+			if (len(self._history) > 0) and (self._history[-1][0] == etag):
+				return
+			self._history.append((etag, body))
+			del self._history[:-HISTORY_SIZE]
+
+	def setLongPoll(self, enabled):
+		'''
+		Hold on to long-polls (the default), or answer them straight away like a server that
+		doesn't know about them
+		'''
+		self._longPoll = enabled
+
+	def waitForChange(self, etag, secs):
+		'''
+		Return (body, etag, last modified) as getContent does, but while that etag is the one
+		given, hold on for up to secs for it to change
+		'''
+		deadline = time.time() + secs
+		with self._changed:
+			version = self._version
+		content = self.getContent()
+		if self._longPoll and (content[1] == etag):
+			self.count('held')
+		while self._longPoll and (content[1] == etag) and (time.time() < deadline):
+			with self._changed:
+				if self._stopping:
+					break
+				if self._version == version:
+					self._changed.wait(min(deadline - time.time(), FILE_CHECK_INTERVAL))
+				version = self._version
+			content = self.getContent()
+		return content
+
+	def delay(self):
+		deadline = time.time() + self._delay
+		with self._changed:
+			while (not self._stopping) and (time.time() < deadline):
+				self._changed.wait(deadline - time.time())
+
+	def getContent(self):
+		'''
+		Return (body, etag, last modified) for what we're serving right now
+		'''
+		with self._lock:
+			content = self._content
+		if content == None:
+			f = open(self._contentPath, 'r')
+			try:
+				body = f.read()
+			finally:
+				f.close()
+			lastModified = email.utils.formatdate(os.path.getmtime(self._contentPath),
+												  usegmt=True)
+			content = (body, '"%s"' % hashlib.md5(body).hexdigest(), lastModified)
+		self._remember(content[0], content[1])
+		return content
+
+	def count(self, name, amount=1):
+		with self._lock:
+			self._stats[name] = self._stats[name] + amount
+
+	def resetStats(self):
+		with self._lock:
+			self._stats = dict([(name, 0) for name in self.COUNTERS])
+			self._statsStart = time.time()
+
+	def getStats(self):
+		'''
+		Return the counters so far, plus each one scaled up to a per-hour rate
+		'''
+		with self._lock:
+			stats = dict(self._stats)
+			elapsed = max(time.time() - self._statsStart, 0.001)
+		stats['elapsed_secs'] = elapsed
+		for name in self.COUNTERS:
+			stats[name + '_per_hour'] = stats[name] * 3600.0 / elapsed
+		return stats
+
+
+def formatStats(stats):
+	return ("%(connections)d connections, %(requests)d requests (%(full)d full, %(not_modified)d "
+			"not modified, %(deltas)d deltas, %(held)d held), %(bytes_in)d bytes in, %(bytes_out)d bytes out = "
+			"%(connections_per_hour).0f connections/hour, %(bytes_in_per_hour).0f+"
+			"%(bytes_out_per_hour).0f bytes/hour" % stats)
+
+
+if __name__ == '__main__':
+	port = DEFAULT_PORT
+	contentPath = DEFAULT_CONTENT
+	if len(sys.argv) > 1:
+		port = int(sys.argv[1])
+	if len(sys.argv) > 2:
+		contentPath = sys.argv[2]
+	server = StubServer(port, contentPath).start()
+	print "Serving %s on port %d" % (contentPath, server.getPort())
+	try:
+		while True:
+			time.sleep(REPORT_INTERVAL)
+			print formatStats(server.getStats())
+	except KeyboardInterrupt:
+		print formatStats(server.getStats())